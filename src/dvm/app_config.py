@@ -31,6 +31,18 @@ class AppConfig:
     SQLALCHEMY_DATABASE_URI = "postgresql://postgres:example@db:5432/postgres"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     data_dir = Path("/app_data").resolve()
+    # Number of videos whose log and calibration are kept in memory.
+    video_context_cache_size = 16
+    # Number of processes used to export several projects at once.
+    export_workers = 4
+    # Number of threads searching calibration images for the chessboard at once.
+    calibration_workers = 4
+    # Write the debug images of every nth calibration image, 0 to write none.
+    calibration_debug_every = 0
+    # Search calibration images for chessboard corners downscaled to this size
+    # along the longest side and refine the corners at full resolution, None
+    # to search at full resolution.
+    calibration_max_detection_size: int | None = None
 
 
 class TestConfig(AppConfig):
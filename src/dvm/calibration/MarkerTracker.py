@@ -6,15 +6,21 @@ Marker tracker for locating n-fold edges in images using convolution.
 
 from __future__ import annotations
 
+import functools
+
 import cv2
 import numpy as np
 
+# Kernels of at least this size are applied by multiplying spectra.
+DFT_MIN_KERNEL_SIZE = 11
+
 
 class MarkerTracker:
     """Purpose: Locate a certain marker in an image."""
 
     def __init__(self, order: int, kernel_size: int, scale_factor: float) -> None:
         self.kernel_size = kernel_size
+        self.scale_factor = scale_factor
         (kernel_real, kernel_imag) = self.generate_symmetry_detector_kernel(order, kernel_size)
 
         self.order = order
@@ -38,13 +44,57 @@ class MarkerTracker:
         return np.real(kernel), np.imag(kernel)
 
     def apply_convolution_with_complex_kernel(self, frame: np.ndarray) -> np.ndarray:
-        self.frame_real = frame.copy()
-        self.frame_imag = frame.copy()
-
         # Calculate convolution and determine response strength.
-        self.frame_real = cv2.filter2D(self.frame_real, cv2.CV_32F, self.mat_real)
-        self.frame_imag = cv2.filter2D(self.frame_imag, cv2.CV_32F, self.mat_imag)
+        if self.kernel_size >= DFT_MIN_KERNEL_SIZE:
+            self.frame_real, self.frame_imag = self.correlate_with_dft(frame)
+        else:
+            self.frame_real = cv2.filter2D(frame, cv2.CV_32F, self.mat_real)
+            self.frame_imag = cv2.filter2D(frame, cv2.CV_32F, self.mat_imag)
         frame_real_squared = cv2.multiply(self.frame_real, self.frame_real, dtype=cv2.CV_32F)
         frame_imag_squared = cv2.multiply(self.frame_imag, self.frame_imag, dtype=cv2.CV_32F)
         self.frame_sum_squared = cv2.add(frame_real_squared, frame_imag_squared, dtype=cv2.CV_32F)
         return self.frame_sum_squared
+
+    def correlate_with_dft(self, frame: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The real and imaginary responses of the kernel as computed by
+        cv2.filter2D, found by transforming the frame once and multiplying
+        its spectrum with the cached spectra of the two kernels.
+        """
+        half = self.kernel_size // 2
+        height, width = frame.shape[:2]
+        padded_size = (height + 2 * half, width + 2 * half)
+        dft_size = (cv2.getOptimalDFTSize(padded_size[0]), cv2.getOptimalDFTSize(padded_size[1]))
+        padded = np.zeros(dft_size, dtype=np.float32)
+        padded[: padded_size[0], : padded_size[1]] = cv2.copyMakeBorder(
+            frame, half, half, half, half, cv2.BORDER_REFLECT_101
+        )
+        spectrum = cv2.dft(padded, nonzeroRows=padded_size[0])
+        spectrum_real, spectrum_imag = get_kernel_spectra(self.order, self.kernel_size, self.scale_factor, dft_size)
+        responses = []
+        for kernel_spectrum in (spectrum_real, spectrum_imag):
+            response = cv2.idft(
+                cv2.mulSpectrums(spectrum, kernel_spectrum, 0), flags=cv2.DFT_SCALE | cv2.DFT_REAL_OUTPUT
+            )
+            # The response to the frame starts kernel_size - 1 pixels into the padded result.
+            responses.append(response[2 * half : 2 * half + height, 2 * half : 2 * half + width])
+        return responses[0], responses[1]
+
+
+@functools.lru_cache(maxsize=8)
+def get_kernel_spectra(
+    order: int, kernel_size: int, scale_factor: float, dft_size: tuple[int, int]
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The spectra of the flipped real and imaginary kernels padded to the
+    size of the transform, such that multiplying spectra correlates with
+    the kernels.
+    """
+    spectra = []
+    for kernel in MarkerTracker.generate_symmetry_detector_kernel(order, kernel_size):
+        padded = np.zeros(dft_size, dtype=np.float32)
+        padded[:kernel_size, :kernel_size] = kernel[::-1, ::-1] / scale_factor
+        spectrum: np.ndarray = cv2.dft(padded, nonzeroRows=kernel_size)
+        spectrum.flags.writeable = False
+        spectra.append(spectrum)
+    return spectra[0], spectra[1]
@@ -1,25 +1,103 @@
 from __future__ import annotations
 
+import contextlib
+import copy
 import logging
+import queue
+import threading
+from collections import deque
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, TypeVar
 
 import cv2
 import numpy as np
 
 from dvm.app_config import AppConfig
 from dvm.calibration.corner_detector import ChessBoardCornerDetector
+from dvm.calibration.debug_images import DebugImageSink
 
 logger = logging.getLogger("app." + __name__)
 
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def iter_in_thread(items: Generator[T, None, None], max_size: int) -> Iterator[T]:
+    """
+    Take the items from the generator in a background thread and yield them,
+    keeping at most max_size items ahead of the consumer. Errors of the
+    generator are raised in the consumer.
+    """
+    items_queue: queue.Queue[tuple[bool, Any]] = queue.Queue(max_size)
+    stop = threading.Event()
+
+    def put(done: bool, value: Any) -> None:
+        while not stop.is_set():
+            try:
+                items_queue.put((done, value), timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def produce() -> None:
+        try:
+            for item in items:
+                put(False, item)
+                if stop.is_set():
+                    break
+            put(True, None)
+        except BaseException as e:
+            put(True, e)
+        finally:
+            items.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            done, value = items_queue.get()
+            if done:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop.set()
+        thread.join()
+
 
 class CalibrateCamera:
     def __init__(
-        self, temp_output_folder: Path | None = None, coverage: int | None = None, n_images: int | None = None
+        self,
+        temp_output_folder: Path | None = None,
+        coverage: int | None = None,
+        n_images: int | None = None,
+        workers: int | None = None,
     ) -> None:
         self.min_percentage_coverage = coverage if coverage is not None else 15
         self.n_images = n_images if n_images is not None else 30
+        self.workers = workers if workers is not None else AppConfig.calibration_workers
+        # Score this many candidate frames per image to extract on a low
+        # resolution copy and only search the frames adding most coverage.
+        # None to search evenly spaced frames.
+        self.candidates_per_image: int | None = 3
+        # Longest side of the low resolution copy the candidates are scored on.
+        self.scoring_size = 480
+        # Stop searching frames once this many cells of the 10x10 grid are
+        # covered and the standard deviations of the focal lengths are below
+        # this fraction of them, checked every few images from min_images_before_stop.
+        self.target_coverage = 80
+        self.target_relative_std = 0.005
+        self.min_images_before_stop = 10
         self.detector = ChessBoardCornerDetector()
+        self.detector.max_detection_size = AppConfig.calibration_max_detection_size
+        # Debug images are written to the temporary output folder only when enabled.
+        self.debug_sink: DebugImageSink | None = None
+        if AppConfig.calibration_debug_every > 0:
+            self.debug_sink = DebugImageSink(every=AppConfig.calibration_debug_every)
+        self.detector.debug_sink = self.debug_sink
         if temp_output_folder is None:
             self.temp_output_folder = AppConfig.data_dir.joinpath("calibrationtemp")
         else:
@@ -28,9 +106,11 @@ class CalibrateCamera:
     def detect_calibration_pattern_in_image(
         self, img: np.ndarray, filename: Path
     ) -> tuple[np.ndarray, np.ndarray, int]:
-        corners, coverage, _ = self.detector.detect_chess_board_corners(
+        # The detector keeps the points of the last image, so each image gets its own copy.
+        detector = copy.copy(self.detector)
+        corners, coverage, _ = detector.detect_chess_board_corners(
             img,
-            debug=True,
+            debug=self.debug_sink is not None,
             path_to_image=Path(filename),
             path_to_output_folder=self.temp_output_folder,
         )
@@ -46,26 +126,54 @@ class CalibrateCamera:
             coverage,
         )
 
+    def map_in_threads(self, function: Callable[[T], R], items: Iterable[T]) -> Generator[R, None, None]:
+        """
+        Apply the function to the items in a pool of self.workers threads and
+        yield the results in the order of the items. At most two items per
+        thread are taken from the items before their results are yielded.
+        """
+        if self.workers <= 1:
+            yield from map(function, items)
+            return
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending: deque[Future[R]] = deque()
+            for item in items:
+                pending.append(pool.submit(function, item))
+                if len(pending) >= 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def detect_calibration_pattern_in_file(
+        self, image_file: Path
+    ) -> tuple[tuple[int, int], tuple[np.ndarray, np.ndarray, int] | None]:
+        img = cv2.imread(str(image_file))
+        image_size = (img.shape[1], img.shape[0])
+        try:
+            return image_size, self.detect_calibration_pattern_in_image(img, filename=image_file)
+        except Exception as e:
+            print("Something failed in calibrate_camera_from_images")
+            print(e)
+            return image_size, None
+
     def calibrate_camera_from_images(
         self, image_files: list[Path]
     ) -> tuple[np.ndarray, np.ndarray, tuple[int, int], int, np.ndarray] | None:
         obj_points_list = []
         img_points_list = []
-        for image_file in image_files:
-            img = cv2.imread(str(image_file))
-            image_size = (img.shape[1], img.shape[0])
-            try:
-                obj_points, img_points, coverage = self.detect_calibration_pattern_in_image(img, filename=image_file)
-                if coverage >= self.min_percentage_coverage:
-                    obj_points_list.append(obj_points)
-                    img_points_list.append(img_points)
-                else:
-                    logger.debug(
-                        f"{image_file} only has {coverage}% coverage minimum set to {self.min_percentage_coverage}"
-                    )
-            except Exception as e:
-                print("Something failed in calibrate_camera_from_images")
-                print(e)
+        results = self.map_in_threads(self.detect_calibration_pattern_in_file, image_files)
+        for image_file, (file_image_size, result) in zip(image_files, results, strict=True):
+            image_size = file_image_size
+            if result is None:
+                continue
+            obj_points, img_points, coverage = result
+            if coverage >= self.min_percentage_coverage:
+                obj_points_list.append(obj_points)
+                img_points_list.append(img_points)
+            else:
+                logger.debug(
+                    f"{image_file} only has {coverage}% coverage minimum set to {self.min_percentage_coverage}"
+                )
         if obj_points_list:
             mtx, dist, std_int, n_images_used_for_calibration = self.get_camera_calibration(
                 obj_points_list, img_points_list, image_size
@@ -75,47 +183,153 @@ class CalibrateCamera:
             logger.debug("No usable images found")
             return None
 
+    def read_video_frames(
+        self, video_file: Path, frame_numbers: Iterable[int] | None = None
+    ) -> Generator[tuple[int, np.ndarray], None, None]:
+        """
+        The frames of the video to search for the calibration pattern with
+        their frame numbers, n_images evenly spaced frames unless the frame
+        numbers are given. The video is decoded in one forward pass, as
+        seeking decodes from the previous keyframe for every frame.
+        """
+        cap = cv2.VideoCapture(str(video_file))
+        num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        logger.debug(f"Number of frames in video: {num_frames}")
+        if frame_numbers is None:
+            logger.debug(f"Number of images to extract: {self.n_images}")
+            frame_numbers = range(0, num_frames, max(1, int(num_frames / self.n_images)))
+        wanted = set(frame_numbers)
+        try:
+            for count in range(min(num_frames, max(wanted, default=-1) + 1)):
+                if not cap.grab():
+                    break
+                if count not in wanted:
+                    continue
+                ret_val, frame = cap.retrieve()
+                if ret_val:
+                    logger.debug(f"Extracted frame {count}")
+                    yield count, frame
+        finally:
+            cap.release()
+
+    def score_frame(self, frame: tuple[int, np.ndarray]) -> tuple[int, float, np.ndarray, np.ndarray]:
+        """
+        The sharpness (variance of the Laplacian) of a low resolution
+        greyscale copy of the frame, the copy itself and the cells of the
+        10x10 grid in which the chessboard corner detector finds peaks in the
+        copy.
+        """
+        count, img = frame
+        scale = min(1.0, self.scoring_size / max(img.shape[:2]))
+        small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        greyscale_image = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        sharpness = float(cv2.Laplacian(greyscale_image, cv2.CV_64F).var())
+        detector = copy.copy(self.detector)
+        response = detector.calculate_corner_responses_at_scale(greyscale_image, scale)
+        response_relative_to_neighbourhood = detector.local_normalization(response, detector.distance_scale * scale)
+        centers = detector.locate_centers_of_peaks(detector.threshold_responses(response_relative_to_neighbourhood))
+        grid = detector.coverage_grid(np.array(centers).reshape(-1, 2), (response.shape[1], response.shape[0]))
+        return count, sharpness, greyscale_image, grid
+
+    def select_video_frames(self, scores: Iterable[tuple[int, float, np.ndarray, np.ndarray]]) -> list[int]:
+        """
+        Select up to n_images of the scored frames. Frames which hardly
+        differ from the previous candidate, blurry frames and frames showing
+        too little of the chessboard are skipped. The remaining frames are
+        taken greedily by the number of grid cells they add to the coverage
+        of the frames already taken, then by sharpness. Only the low
+        resolution copy of the previous frame is kept while the scores are
+        consumed.
+        """
+        sharpnesses = []
+        candidates = []
+        previous = None
+        for count, sharpness, greyscale_image, grid in scores:
+            sharpnesses.append(sharpness)
+            moved = previous is None or float(cv2.absdiff(greyscale_image, previous).mean()) >= 1.0
+            previous = greyscale_image
+            # The low resolution search finds fewer peaks than the full search.
+            if moved and np.count_nonzero(grid) >= self.min_percentage_coverage / 2:
+                candidates.append((count, sharpness, grid))
+        if not candidates:
+            return []
+        median_sharpness = float(np.median(sharpnesses))
+        candidates = [candidate for candidate in candidates if candidate[1] >= 0.5 * median_sharpness]
+        covered = np.zeros((10, 10), dtype=bool)
+        selected: list[int] = []
+        while candidates and len(selected) < self.n_images:
+            best = max(candidates, key=lambda c: (np.count_nonzero(c[2] & ~covered), c[1]))
+            candidates.remove(best)
+            selected.append(best[0])
+            covered |= best[2]
+        logger.debug(f"Selected {len(selected)} of {len(sharpnesses)} candidate frames covering {covered.sum()} cells")
+        return sorted(selected)
+
+    def detect_calibration_pattern_in_frame(
+        self, frame: tuple[int, np.ndarray]
+    ) -> tuple[int, tuple[int, int], np.ndarray, np.ndarray, int]:
+        count, img = frame
+        logger.debug(f"Examining frame {count} for calibration pattern coverage")
+        image_size = (img.shape[1], img.shape[0])
+        obj_points, img_points, coverage = self.detect_calibration_pattern_in_image(
+            img, filename=Path(f"frame_from_video_{count}.png")
+        )
+        return count, image_size, obj_points, img_points, coverage
+
+    def calibration_targets_met(
+        self, calibration: tuple[np.ndarray, np.ndarray, np.ndarray, int], covered: np.ndarray
+    ) -> bool:
+        mtx, _, std_int, _ = calibration
+        if np.count_nonzero(covered) < self.target_coverage:
+            return False
+        return bool(std_int[0, 0] < self.target_relative_std * mtx[0, 0]) and bool(
+            std_int[1, 0] < self.target_relative_std * mtx[1, 1]
+        )
+
     def calibrate_camera_from_video(
         self, video_files: list[Path]
     ) -> tuple[np.ndarray, np.ndarray, tuple[int, int], int, np.ndarray] | None:
         obj_points_list = []
         img_points_list = []
+        covered = np.zeros((10, 10), dtype=bool)
+        calibration = None
         for video_file in video_files:
-            cap = cv2.VideoCapture(str(video_file))
-            num_frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-            logger.debug(f"Number of frames in video: {num_frames}")
-            logger.debug(f"Number of images to extract: {self.n_images}")
-            count = 0
-            while cap.isOpened():
-                # Set next frame to read
-                logger.debug(f"Next frame to extract is: {count}")
-                cap.set(cv2.CAP_PROP_POS_FRAMES, count)
-
-                # Read frame
-                ret_val, frame = cap.read()
-                if ret_val:
-                    logger.debug(f"Examining frame {count} for calibration pattern coverage")
-                    image_size = (frame.shape[1], frame.shape[0])
-                    obj_points, img_points, coverage = self.detect_calibration_pattern_in_image(
-                        frame, filename=Path(f"frame_from_video_{count}.png")
-                    )
-                    if coverage >= self.min_percentage_coverage:
-                        logger.debug(f"Calibration pattern coverage is fine ({coverage})")
-                        obj_points_list.append(obj_points)
-                        img_points_list.append(img_points)
-                    else:
-                        logger.debug(f"Calibration pattern coverage too low in image ({coverage})")
-                        # num_images = num_images + 1 if num_images < 30 else 30
-
-                # Calculate next frame to extract
-                count += int(num_frames / self.n_images)
-                if count > num_frames:
-                    break
-            cap.release()
+            frame_numbers = None
+            if self.candidates_per_image is not None:
+                cap = cv2.VideoCapture(str(video_file))
+                num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                cap.release()
+                n_candidates = self.n_images * self.candidates_per_image
+                candidates = range(0, num_frames, max(1, int(num_frames / n_candidates)))
+                frames = iter_in_thread(self.read_video_frames(video_file, candidates), max(1, self.workers))
+                frame_numbers = self.select_video_frames(self.map_in_threads(self.score_frame, frames)) or None
+            # The selected frames, or the evenly spaced frames without
+            # candidates worth searching, are decoded in one forward pass
+            # while the chessboard is searched for in the frames already decoded.
+            frames = iter_in_thread(self.read_video_frames(video_file, frame_numbers), max(1, self.workers))
+            with contextlib.closing(self.map_in_threads(self.detect_calibration_pattern_in_frame, frames)) as results:
+                for count, frame_size, obj_points, img_points, coverage in results:
+                    image_size = frame_size
+                    if coverage < self.min_percentage_coverage:
+                        logger.debug(f"Calibration pattern coverage too low in frame {count} ({coverage})")
+                        continue
+                    logger.debug(f"Calibration pattern coverage is fine in frame {count} ({coverage})")
+                    obj_points_list.append(obj_points)
+                    img_points_list.append(img_points)
+                    covered |= self.detector.coverage_grid(img_points, image_size)
+                    n_found = len(obj_points_list)
+                    if n_found >= self.min_images_before_stop and n_found % 5 == 0:
+                        calibration = self.get_camera_calibration(obj_points_list, img_points_list, image_size)
+                        if self.calibration_targets_met(calibration, covered):
+                            logger.debug(f"Calibration targets met after {n_found} images")
+                            break
+                        calibration = None
+            if calibration is not None:
+                break
         if obj_points_list:
-            mtx, dist, std_int, n_images_used_for_calibration = self.get_camera_calibration(
-                obj_points_list, img_points_list, image_size
-            )
+            if calibration is None:
+                calibration = self.get_camera_calibration(obj_points_list, img_points_list, image_size)
+            mtx, dist, std_int, n_images_used_for_calibration = calibration
             return mtx, dist, image_size, n_images_used_for_calibration, std_int
         else:
             logger.debug("No usable images found in the video")
@@ -176,12 +390,16 @@ class CalibrateCamera:
             "*.webm",
         ]:
             video_files.extend(in_folder.glob(file_format, case_sensitive=False))
-        if image_files:
-            res = self.calibrate_camera_from_images(image_files)
-        elif video_files:
-            res = self.calibrate_camera_from_video(video_files)
-        else:
-            return None
+        try:
+            if image_files:
+                res = self.calibrate_camera_from_images(image_files)
+            elif video_files:
+                res = self.calibrate_camera_from_video(video_files)
+            else:
+                return None
+        finally:
+            if self.debug_sink is not None:
+                self.debug_sink.close()
         if res is None:
             return -1
         else:
@@ -10,6 +10,7 @@ import cv2
 import numpy as np
 from icecream import ic
 
+from dvm.calibration.debug_images import DebugImageSink
 from dvm.calibration.MarkerTracker import MarkerTracker
 from dvm.calibration.peak_enumerator import PeakEnumerator
 
@@ -23,6 +24,14 @@ class ChessBoardCornerDetector:
         self.distance_threshold = 0.13
         self.kernel_size = 101
         self.relative_threshold_level = 0.5
+        # Search for peaks in a copy of the image downscaled to this size along
+        # its longest side and refine them at full resolution. None to search
+        # at full resolution.
+        self.max_detection_size: int | None = None
+        # Refine the peaks with cv2.cornerSubPix also when searching at full resolution.
+        self.refine_corners = False
+        # Where debug images are written, None to write them as they are made.
+        self.debug_sink: DebugImageSink | None = None
         self.calibration_points: dict[int, dict[int, np.ndarray]]
         self.centers = None
         self.centers_kdtree = None
@@ -37,16 +46,18 @@ class ChessBoardCornerDetector:
         path_to_output_folder: Path | None = None,
     ) -> tuple[dict[int, dict[int, np.ndarray]], int, list[tuple[int, float]]]:
         try:
+            scale = self.get_detection_scale(img)
             # Calculate corner response
-            response = self.calculate_corner_responses(img)
+            response = self.calculate_corner_responses(img, scale)
             # print("%8.2f, convolution" % (time.time() - t_start))
             # Localized normalization of responses
-            response_relative_to_neighbourhood = self.local_normalization(response, self.distance_scale)
+            response_relative_to_neighbourhood = self.local_normalization(response, self.distance_scale * scale)
             # print("%8.2f, relative response" % (time.time() - t_start))
             # Threshold responses
             relative_responses_thresholded = self.threshold_responses(response_relative_to_neighbourhood)
             # Locate centers of peaks
             centers = self.locate_centers_of_peaks(relative_responses_thresholded)
+            centers = self.refine_centers_of_peaks(img, centers, scale)
 
             pe = PeakEnumerator(np.array(centers))
             selected_center = pe.select_central_peak_location()
@@ -57,41 +68,30 @@ class ChessBoardCornerDetector:
         except Exception as e:
             print("Something failed in <detect_chess_board_corners>")
             ic(e)
-        if debug and path_to_image is not None and path_to_output_folder is not None:
-            # Make output folders
-            path_to_output_folder.mkdir(parents=False, exist_ok=True)
-            path_to_output_response_folder = path_to_output_folder.joinpath("1_response")
-            path_to_output_response_folder.mkdir(parents=False, exist_ok=True)
-            path_to_output_response_neighbourhood_folder = path_to_output_folder.joinpath(
-                "2_respond_relative_to_neighbourhood"
-            )
-            path_to_output_response_neighbourhood_folder.mkdir(parents=False, exist_ok=True)
-            path_to_output_response_threshold_folder = path_to_output_folder.joinpath("3_relative_response_thresholded")
-            path_to_output_response_threshold_folder.mkdir(parents=False, exist_ok=True)
-            path_to_output_located_centers_folder = path_to_output_folder.joinpath("4_located_centers")
-            path_to_output_located_centers_folder.mkdir(parents=False, exist_ok=True)
-            path_to_output_local_maxima_folder = path_to_output_folder.joinpath("5_local_maxima")
-            path_to_output_local_maxima_folder.mkdir(parents=False, exist_ok=True)
-            # Write debug images
-            path_response_1 = path_to_output_response_folder.joinpath(path_to_image.stem + "_response.png")
-            cv2.imwrite(str(path_response_1), response)
-            path_response_2 = path_to_output_response_neighbourhood_folder.joinpath(
-                path_to_image.stem + "_response_relative_to_neighbourhood.png"
-            )
-            cv2.imwrite(str(path_response_2), response_relative_to_neighbourhood * 255)
-            path_response_3 = path_to_output_response_threshold_folder.joinpath(
-                path_to_image.stem + "_relative_responses_thresholded.png"
-            )
-            cv2.imwrite(str(path_response_3), relative_responses_thresholded)
+        if (
+            debug
+            and path_to_image is not None
+            and path_to_output_folder is not None
+            and (self.debug_sink is None or self.debug_sink.sample())
+        ):
             located_centers = self.show_detected_points(img, centers)
-            path_response_4 = path_to_output_located_centers_folder.joinpath(
-                path_to_image.stem + "_located_centers.png"
-            )
-            cv2.imwrite(str(path_response_4), located_centers)
             canvas = self.show_detected_calibration_points(img, self.calibration_points)
             cv2.circle(canvas, tuple(selected_center.astype(int)), 10, (0, 0, 255), -1)
-            path_local_max = path_to_output_local_maxima_folder.joinpath(path_to_image.stem + "_local_maxima.png")
-            cv2.imwrite(str(path_local_max), canvas)
+            # Write debug images
+            for folder, suffix, debug_image in (
+                ("1_response", "_response", response),
+                (
+                    "2_respond_relative_to_neighbourhood",
+                    "_response_relative_to_neighbourhood",
+                    response_relative_to_neighbourhood * 255,
+                ),
+                ("3_relative_response_thresholded", "_relative_responses_thresholded", relative_responses_thresholded),
+                ("4_located_centers", "_located_centers", located_centers),
+                ("5_local_maxima", "_local_maxima", canvas),
+            ):
+                self.write_debug_image(
+                    path_to_output_folder.joinpath(folder, path_to_image.stem + suffix + ".png"), debug_image
+                )
 
         try:
             # Detect image coverage
@@ -104,9 +104,17 @@ class ChessBoardCornerDetector:
 
         # Not necessary to output the images when we just want the statistics after undistorting
 
+    def write_debug_image(self, path: Path, image: np.ndarray) -> None:
+        if self.debug_sink is not None:
+            self.debug_sink.write(path, image)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            cv2.imwrite(str(path), image)
+
     def make_statistics(self, img: np.ndarray, debug: bool, output: Path, fname: Path) -> list[tuple[int, float]]:
+        scale = self.get_detection_scale(img)
         # Calculate corner responses
-        response = self.calculate_corner_responses(img)
+        response = self.calculate_corner_responses(img, scale)
         if debug:
             path_to_output_undistorted_corner_response = output.parent.joinpath("91_undistorted_corner_response")
             path_to_output_undistorted_corner_response.mkdir(parents=False, exist_ok=True)
@@ -116,7 +124,7 @@ class ChessBoardCornerDetector:
             )
 
         # Localized normalization of responses
-        response_relative_to_neighbourhood = self.local_normalization(response, self.distance_scale)
+        response_relative_to_neighbourhood = self.local_normalization(response, self.distance_scale * scale)
         if debug:
             path_to_output_undistorted_response = output.parent.joinpath("92_undistorted_relative_response")
             path_to_output_undistorted_response.mkdir(parents=False, exist_ok=True)
@@ -137,6 +145,7 @@ class ChessBoardCornerDetector:
 
         # Locate centers of peaks
         centers = self.locate_centers_of_peaks(relative_responses_thresholded)
+        centers = self.refine_centers_of_peaks(img, centers, scale)
         centers = sorted(centers, key=lambda item: item[0])
         # ic(centers)
 
@@ -159,13 +168,50 @@ class ChessBoardCornerDetector:
         stats = self.statistics(calibration_points)
         return stats
 
-    def calculate_corner_responses(self, img: np.ndarray) -> np.ndarray:
-        locator = MarkerTracker(order=2, kernel_size=self.kernel_size, scale_factor=40)
+    def get_detection_scale(self, img: np.ndarray) -> float:
+        """The scale of the image the peaks are searched for in."""
+        if self.max_detection_size is None:
+            return 1.0
+        return min(1.0, self.max_detection_size / max(img.shape[:2]))
+
+    def calculate_corner_responses(self, img: np.ndarray, scale: float = 1.0) -> np.ndarray:
         greyscale_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        if scale != 1.0:
+            greyscale_image = cv2.resize(greyscale_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self.calculate_corner_responses_at_scale(greyscale_image, scale)
+
+    def calculate_corner_responses_at_scale(self, greyscale_image: np.ndarray, scale: float) -> np.ndarray:
+        """The corner response of a greyscale image already downscaled by the scale."""
+        if scale == 1.0:
+            locator = MarkerTracker(order=2, kernel_size=self.kernel_size, scale_factor=40)
+        else:
+            # The kernel shrinks with the image and the scale factor with the
+            # kernel area, such that the response keeps its magnitude.
+            kernel_size = max(11, int(round(self.kernel_size * scale)) | 1)
+            kernel_scale = kernel_size / self.kernel_size
+            locator = MarkerTracker(order=2, kernel_size=kernel_size, scale_factor=40 * kernel_scale**2)
         response = locator.apply_convolution_with_complex_kernel(greyscale_image)
         return response
 
-    def local_normalization(self, response: np.ndarray, neighbourhoodsize: int) -> np.ndarray:
+    def refine_centers_of_peaks(self, img: np.ndarray, centers: list[np.ndarray], scale: float) -> list[np.ndarray]:
+        """
+        Move the peaks found at the scale to full resolution and, when the
+        scale is below one or refine_corners is set, refine them to the
+        saddle points of the chessboard corners with cv2.cornerSubPix.
+        """
+        if not centers or (scale == 1.0 and not self.refine_corners):
+            return centers
+        points = (np.array(centers, dtype=np.float32) + 0.5) / scale - 0.5
+        # The search window is a sixth of the marker kernel and covers two pixels at the scale.
+        half_window = max(self.kernel_size // 6, int(round(2 / scale)))
+        greyscale_image = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+        refined = cv2.cornerSubPix(
+            greyscale_image, points.reshape(-1, 1, 2), (half_window, half_window), (-1, -1), criteria
+        )
+        return [point.astype(np.float64) for point in refined.reshape(-1, 2)]
+
+    def local_normalization(self, response: np.ndarray, neighbourhoodsize: float) -> np.ndarray:
         _, max_val, _, _ = cv2.minMaxLoc(response)
         response_relative_to_neighbourhood = self.peaks_relative_to_neighbourhood(
             response, neighbourhoodsize, 0.05 * max_val
@@ -265,7 +311,7 @@ class ChessBoardCornerDetector:
         return result
 
     def peaks_relative_to_neighbourhood(
-        self, response: np.ndarray, neighbourhoodsize: int, value_to_add: float
+        self, response: np.ndarray, neighbourhoodsize: float, value_to_add: float
     ) -> np.ndarray:
         local_min_image = self.minimum_image_value_in_neighbourhood(response, neighbourhoodsize)
         local_max_image = self.maximum_image_value_in_neighbourhood(response, neighbourhoodsize)
@@ -320,18 +366,22 @@ class ChessBoardCornerDetector:
         # coverage_ratio = convexHullArea / imageArea
         # ic(coverage_ratio)
 
-        score = np.zeros((10, 10))
-        for calibration_point_dict in calibration_points.values():
-            for x, y in calibration_point_dict.values():
-                (x_bin, x_rem) = divmod(x, w / 10)
-                (y_bin, y_rem) = divmod(y, h / 10)
-                if x_bin == 10:
-                    x_bin = 9
-                if y_bin == 10:
-                    y_bin = 9
-                score[int(x_bin)][int(y_bin)] += 1
-
-        return int(np.count_nonzero(score))
+        points = [
+            point for calibration_point_dict in calibration_points.values() for point in calibration_point_dict.values()
+        ]
+        return int(np.count_nonzero(ChessBoardCornerDetector.coverage_grid(np.array(points), (w, h))))
+
+    @staticmethod
+    def coverage_grid(points: np.ndarray, image_size: tuple[int, int]) -> np.ndarray:
+        """The cells of a 10x10 grid over the image which contain any of the (N, 2) points."""
+        w, h = image_size
+        grid = np.zeros((10, 10), dtype=bool)
+        if len(points) == 0:
+            return grid
+        x_bins = np.clip((points[:, 0] // (w / 10)).astype(int), 0, 9)
+        y_bins = np.clip((points[:, 1] // (h / 10)).astype(int), 0, 9)
+        grid[x_bins, y_bins] = True
+        return grid
 
     @staticmethod
     def shortest_distance(x1: float, y1: float, a: float, b: float, c: float) -> float:
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import logging
+import queue
+import threading
+from pathlib import Path
+from typing import Any
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger("app." + __name__)
+
+
+class DebugImageSink:
+    """
+    Writes the intermediate images of the chessboard corner detection from a
+    background thread, for every nth image only, downscaled to max_size
+    along the longest side and encoded with the extension.
+    """
+
+    def __init__(
+        self, every: int = 1, extension: str = ".jpg", max_size: int | None = 1024, queue_size: int = 16
+    ) -> None:
+        self.every = max(1, every)
+        self.extension = extension
+        self.max_size = max_size
+        self._queue: queue.Queue[tuple[Path, np.ndarray] | None] = queue.Queue(queue_size)
+        self._count = 0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+
+    def sample(self) -> bool:
+        """Whether the debug images of the next image should be written."""
+        with self._lock:
+            self._count += 1
+            return (self._count - 1) % self.every == 0
+
+    def write(self, path: Path, image: np.ndarray) -> None:
+        """Queue the image to be written to path with the extension of the sink."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_images, daemon=True)
+                self._thread.start()
+        self._queue.put((path, image))
+
+    def close(self) -> None:
+        """Wait until the queued images are written and stop the writer thread."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def __enter__(self) -> DebugImageSink:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def _write_images(self) -> None:
+        while (item := self._queue.get()) is not None:
+            path, image = item
+            try:
+                self.write_image(path, image)
+            except Exception as e:
+                logger.warning(f"Could not write debug image {path}: {e}")
+
+    def write_image(self, path: Path, image: np.ndarray) -> None:
+        if self.max_size is not None and max(image.shape[:2]) > self.max_size:
+            scale = self.max_size / max(image.shape[:2])
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        if image.dtype != np.uint8:
+            image = np.clip(image, 0, 255).astype(np.uint8)
+        path = path.with_suffix(self.extension)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(str(path), image)
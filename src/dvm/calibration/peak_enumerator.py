@@ -2,11 +2,16 @@ from __future__ import annotations
 
 import collections
 
-import cv2
 import numpy as np
 from icecream import ic
 from sklearn.neighbors import KDTree
 
+# The points searched for around each square of the grid, relative to its
+# lower corner, in the order they are searched for.
+NEIGHBOURS = np.array([(0, 2), (1, 2), (2, 1), (2, 0), (1, -1), (0, -1), (-1, 0), (-1, 1)])
+# The corners of the unit square in the order of the corners of a grid square.
+UNIT_SQUARE = np.array([(0, 0), (0, 1), (1, 0), (1, 1)], dtype=np.float64)
+
 
 class PeakEnumerator:
     def __init__(self, centers: np.ndarray) -> None:
@@ -16,25 +21,15 @@ class PeakEnumerator:
 
     def select_central_peak_location(self) -> np.ndarray:
         mean_position_of_centers = np.mean(self.centers, axis=0)
-
-        central_center = np.array(
-            sorted(
-                self.centers,
-                key=lambda c: np.sqrt(
-                    (c[0] - mean_position_of_centers[0]) ** 2 + (c[1] - mean_position_of_centers[1]) ** 2
-                ),
-            )
-        )
-
-        self.central_peak_location = central_center[0]
+        distances = np.linalg.norm(self.centers - mean_position_of_centers, axis=1)
+        self.central_peak_location = self.centers[np.argmin(distances)]
         return self.central_peak_location
 
     def enumerate_peaks(self) -> dict[int, dict[int, np.ndarray]]:
         self.centers_kdtree = KDTree(np.array(self.centers))
         self.calibration_points = self.initialize_calibration_points(self.central_peak_location)
         self.enumerate_central_square()
-        self.build_examination_queue()
-        self.analyse_elements_in_queue()
+        self.expand_calibration_grid()
         return self.calibration_points
 
     def initialize_calibration_points(self, selected_center: np.ndarray) -> dict[int, dict[int, np.ndarray]]:
@@ -88,59 +83,88 @@ class PeakEnumerator:
             pass
             # Throw error
 
-    def build_examination_queue(self) -> None:
-        self.points_to_examine_queue = []
-        for x_key, value in self.calibration_points.items():
-            for y_key, _ in value.items():
-                self.points_to_examine_queue.append((x_key, y_key))
-
-    def analyse_elements_in_queue(self) -> None:
-        for x_index, y_index in self.points_to_examine_queue:
-            self.expand_calibration_grid(x_index, y_index)
-
-    def expand_calibration_grid(self, x_index: int, y_index: int) -> None:
-        # This rule tries to estimate the perspective distortion of four points
-        # and then use this distortion model to locate new points of the
-        # chessboard pattern.
-        try:
-            p00 = self.calibration_points[x_index][y_index]
-            p01 = self.calibration_points[x_index][y_index + 1]
-            p10 = self.calibration_points[x_index + 1][y_index]
-            p11 = self.calibration_points[x_index + 1][y_index + 1]
-        except Exception:
-            # print(e)
-            return
-
-        reference_distance: float = float(np.linalg.norm(p01 - p00))
-
-        src = np.array([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=float)
-        dst = np.array([p00, p01, p10, p11], dtype=float)
-
-        H, _mask = cv2.findHomography(src, dst)
-
-        self.search_for_point(x_index, y_index, reference_distance, H, (0, 2))
-        self.search_for_point(x_index, y_index, reference_distance, H, (1, 2))
-        self.search_for_point(x_index, y_index, reference_distance, H, (2, 1))
-        self.search_for_point(x_index, y_index, reference_distance, H, (2, 0))
-        self.search_for_point(x_index, y_index, reference_distance, H, (1, -1))
-        self.search_for_point(x_index, y_index, reference_distance, H, (0, -1))
-        self.search_for_point(x_index, y_index, reference_distance, H, (-1, 0))
-        self.search_for_point(x_index, y_index, reference_distance, H, (-1, 1))
-
-    def search_for_point(
-        self, x_index: int, y_index: int, reference_distance: float, H: np.ndarray, point: tuple[int, int]
-    ) -> None:
-        x_idx = x_index + point[0]
-        y_idx = y_index + point[1]
-
-        if y_idx not in self.calibration_points[x_idx]:
-            pxx = H @ np.array([[point[0]], [point[1]], [1]])
-            pxx = pxx / pxx[2]
-            location, distance = self.locate_nearest_neighbour(pxx[0:2], minimum_distance_from_selected_center=-1)
-            if distance / reference_distance < self.distance_threshold:
-                # ic(distance / reference_distance)
-                self.calibration_points[x_idx][y_idx] = location
-                self.points_to_examine_queue.append((x_idx, y_idx))
+    def expand_calibration_grid(self) -> None:
+        """
+        Grow the grid from the central square. For every square of the grid
+        with four known corners, the perspective distortion of the corners is
+        used to predict the eight points next to the square, and the peaks
+        close to the predictions are added to the grid. All squares found in
+        a round are expanded together with one batched nearest neighbour
+        query, until no more squares are found.
+        """
+        # The grid is indexed by the grid indices plus the offset and grows
+        # such that the points next to the known points are always inside.
+        margin = 3
+        offset = int(np.sqrt(len(self.centers))) + margin
+        size = 2 * offset + 1
+        grid: np.ndarray = np.full((size, size, 2), np.nan)
+        for x_index, column in self.calibration_points.items():
+            for y_index, point in column.items():
+                grid[x_index + offset, y_index + offset] = point
+        expanded: np.ndarray = np.zeros((size - 1, size - 1), dtype=bool)
+        while True:
+            known = ~np.isnan(grid[:, :, 0])
+            x_known, y_known = np.nonzero(known)
+            if min(x_known.min(), y_known.min()) < margin or max(x_known.max(), y_known.max()) >= size - margin:
+                grid = np.pad(grid, ((size, size), (size, size), (0, 0)), constant_values=np.nan)
+                expanded = np.pad(expanded, size, constant_values=False)
+                offset += size
+                size = 3 * size
+                continue
+            squares = known[:-1, :-1] & known[:-1, 1:] & known[1:, :-1] & known[1:, 1:] & ~expanded
+            x_indices, y_indices = np.nonzero(squares)
+            if len(x_indices) == 0:
+                break
+            expanded[x_indices, y_indices] = True
+            corners = np.stack(
+                (
+                    grid[x_indices, y_indices],
+                    grid[x_indices, y_indices + 1],
+                    grid[x_indices + 1, y_indices],
+                    grid[x_indices + 1, y_indices + 1],
+                ),
+                axis=1,
+            )
+            reference_distances = np.linalg.norm(corners[:, 1] - corners[:, 0], axis=1)
+            predictions = self.apply_homographies(self.get_homographies(corners), NEIGHBOURS)
+            target_x = (x_indices[:, None] + NEIGHBOURS[:, 0]).reshape(-1)
+            target_y = (y_indices[:, None] + NEIGHBOURS[:, 1]).reshape(-1)
+            distances, indices = self.centers_kdtree.query(predictions.reshape(-1, 2), 1)
+            accepted = distances[:, 0] / np.repeat(reference_distances, len(NEIGHBOURS)) < self.distance_threshold
+            accepted &= ~known[target_x, target_y]
+            accepted_idx = np.flatnonzero(accepted)
+            # Of several squares predicting the same point, the first one wins.
+            _, first = np.unique(target_x[accepted_idx] * size + target_y[accepted_idx], return_index=True)
+            accepted_idx = accepted_idx[np.sort(first)]
+            grid[target_x[accepted_idx], target_y[accepted_idx]] = self.centers[indices[accepted_idx, 0]]
+        self.calibration_points = collections.defaultdict(dict)
+        for x_index, y_index in zip(*np.nonzero(~np.isnan(grid[:, :, 0])), strict=True):
+            self.calibration_points[int(x_index) - offset][int(y_index) - offset] = grid[x_index, y_index]
+
+    @staticmethod
+    def get_homographies(corners: np.ndarray) -> np.ndarray:
+        """The (N, 3, 3) homographies mapping the unit square to the (N, 4, 2) corners."""
+        n = len(corners)
+        a = np.zeros((n, 8, 8))
+        b = corners.reshape(n, 8)
+        for i, (u, v) in enumerate(UNIT_SQUARE):
+            x = corners[:, i, 0]
+            y = corners[:, i, 1]
+            a[:, 2 * i, 0:3] = (u, v, 1)
+            a[:, 2 * i, 6] = -u * x
+            a[:, 2 * i, 7] = -v * x
+            a[:, 2 * i + 1, 3:6] = (u, v, 1)
+            a[:, 2 * i + 1, 6] = -u * y
+            a[:, 2 * i + 1, 7] = -v * y
+        h = np.linalg.solve(a, b[:, :, None])[:, :, 0]
+        return np.concatenate((h, np.ones((n, 1))), axis=1).reshape(n, 3, 3)
+
+    @staticmethod
+    def apply_homographies(homographies: np.ndarray, points: np.ndarray) -> np.ndarray:
+        """The (M, 2) points mapped by each of the (N, 3, 3) homographies as an (N, M, 2) array."""
+        homogeneous = np.concatenate((points, np.ones((len(points), 1))), axis=1)
+        mapped = np.einsum("nij,mj->nmi", homographies, homogeneous)
+        return mapped[:, :, :2] / mapped[:, :, 2:]
 
     def locate_nearest_neighbour(
         self, selected_center: np.ndarray, minimum_distance_from_selected_center: float = 0
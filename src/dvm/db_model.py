@@ -13,6 +13,14 @@ class Project(db.Model):  # type: ignore[name-defined, misc]
     drone_id = db.Column(db.Integer, db.ForeignKey("drone.id"), nullable=False)
     videos = db.relationship("Video", backref="project", lazy=True)
     log_error = db.Column(db.String(), nullable=True)
+    interpolate_pose = db.Column(db.Boolean, default=False)
+    log_rows = db.Column(db.Integer, nullable=True)
+    log_start = db.Column(db.DateTime(), nullable=True)
+    log_end = db.Column(db.DateTime(), nullable=True)
+    log_videos = db.Column(db.Integer, nullable=True)
+    log_parse_duration = db.Column(db.Float, nullable=True)
+    annotation_revision = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    task = db.relationship("Task", backref="Project", lazy=True, uselist=False)
 
     def __repr__(self) -> str:
         return f"<Project {self.name}>"
@@ -33,6 +41,10 @@ class Video(db.Model):  # type: ignore[name-defined, misc]
     start_time = db.Column(db.DateTime())
     takeoff_altitude = db.Column(db.Float, default=0.0)
     json_data = db.Column(db.String())
+    annotation_key = db.Column(db.String(), nullable=True)
+    annotations = db.relationship(
+        "Annotation", backref="video", lazy=True, cascade="all, delete-orphan", order_by="Annotation.position"
+    )
     task = db.relationship("Task", backref="Video", lazy=True, uselist=False)
     task_error = db.Column(db.String(), nullable=True)
 
@@ -40,6 +52,50 @@ class Video(db.Model):  # type: ignore[name-defined, misc]
         return f"<Video {self.file}>"
 
 
+class Annotation(db.Model):  # type: ignore[name-defined, misc]
+    id = db.Column(db.Integer, primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey("video.id"), nullable=False)
+    project_id = db.Column(db.Integer, db.ForeignKey("project.id"), nullable=False)
+    object_id = db.Column(db.String(), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    type = db.Column(db.String(), nullable=False)
+    name = db.Column(db.String())
+    frame = db.Column(db.Integer, nullable=False)
+    fabric_object = db.Column(db.Text(), nullable=False)
+    image_x = db.Column(db.Float)
+    image_y = db.Column(db.Float)
+    image_x1 = db.Column(db.Float)
+    image_y1 = db.Column(db.Float)
+    image_x2 = db.Column(db.Float)
+    image_y2 = db.Column(db.Float)
+    time = db.Column(db.DateTime())
+    height = db.Column(db.Float)
+    yaw = db.Column(db.Float)
+    pitch = db.Column(db.Float)
+    roll = db.Column(db.Float)
+    length = db.Column(db.Float)
+    lat = db.Column(db.Float)
+    lon = db.Column(db.Float)
+    east = db.Column(db.Float)
+    north = db.Column(db.Float)
+    zone_number = db.Column(db.Integer)
+    zone_letter = db.Column(db.String(1))
+    start_east = db.Column(db.Float)
+    start_north = db.Column(db.Float)
+    end_east = db.Column(db.Float)
+    end_north = db.Column(db.Float)
+    heading = db.Column(db.Float)
+
+    __table_args__ = (
+        db.UniqueConstraint("video_id", "object_id", name="uq_annotation_video_id_object_id"),
+        db.Index("ix_annotation_video_id_frame", "video_id", "frame"),
+        db.Index("ix_annotation_project_id_name", "project_id", "name"),
+    )
+
+    def __repr__(self) -> str:
+        return f"<Annotation {self.type} {self.name} {self.frame}>"
+
+
 class Drone(db.Model):  # type: ignore[name-defined, misc]
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(), unique=True, nullable=False)
@@ -59,6 +115,7 @@ class Task(db.Model):  # type: ignore[name-defined, misc]
     function = db.Column(db.String())
     video_id = db.Column(db.Integer, db.ForeignKey("video.id"), nullable=True)
     drone_id = db.Column(db.Integer, db.ForeignKey("drone.id"), nullable=True)
+    project_id = db.Column(db.Integer, db.ForeignKey("project.id"), nullable=True)
 
     def __repr__(self) -> str:
         return f"<Task {self.task_id}>"
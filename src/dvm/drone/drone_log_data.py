@@ -1,21 +1,38 @@
 from __future__ import annotations
 
 import csv
+import io
 import logging
 import re
+import warnings
 from collections.abc import Generator
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
+from typing import Any, BinaryIO, TextIO
 
 import ffmpeg
 import numpy as np
 import utm
 
 from dvm.app_config import AppConfig
+from dvm.drone.log_cache import read_log_cache, write_log_cache
 
 logger = logging.getLogger("app." + __name__)
 
 
+ROTATION_DTYPE = np.dtype([("yaw", np.float64), ("pitch", np.float64), ("roll", np.float64)])
+POSITION_DTYPE = np.dtype([("lat", np.float64), ("lon", np.float64)])
+
+# Formats of the time stamps in the logs numpy can not parse itself.
+DATETIME_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S")
+
+# The pose table is only computed for a lookup of at least one in this many
+# frames of the video, smaller lookups search the log directly.
+POSE_TABLE_BATCH_RATIO = 10
+
+LogData = tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+
+
 class DroneLog:
     def __init__(self) -> None:
         logger.debug(f"Creating DroneLog instance {self}")
@@ -24,20 +41,82 @@ class DroneLog:
         self.video_size: tuple[int, int]
         self.video_pos: tuple[float, float] | None
         self.video_start_time: datetime | None = None
-        self.time_stamp: list[datetime]
-        self.height: list[float]
-        self.rotation: list[tuple[float, float, float]]
-        self.pos: list[tuple[float, float]]
-        self.is_video: list[bool]
+        # The log is stored column wise. time_stamp is datetime64[ns], height is
+        # float64, rotation (radians) and pos are structured arrays with the
+        # fields of ROTATION_DTYPE and POSITION_DTYPE and is_video is bool.
+        self.time_stamp: np.ndarray
+        self.height: np.ndarray
+        self.rotation: np.ndarray
+        self.pos: np.ndarray
+        self.is_video: np.ndarray
         self.takeoff_altitude = 0.0
+        # Interpolate the pose between log rows instead of using the closest row.
+        self.interpolate_pose = False
+        self._pose_table: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None
+        self._pose_table_key: tuple[Any, ...] | None = None
 
-    def log_data(self) -> tuple[list[datetime], list[float], list[float], list[float], list[float], list[bool]]:
+    def log_data(self) -> LogData:
         logger.debug("Getting log data")
-        yaw = [x[0] * 180 / np.pi for x in self.rotation]
-        pitch = [x[1] * 180 / np.pi for x in self.rotation]
-        roll = [x[2] * 180 / np.pi for x in self.rotation]
+        yaw = np.degrees(self.rotation["yaw"])
+        pitch = np.degrees(self.rotation["pitch"])
+        roll = np.degrees(self.rotation["roll"])
         return self.time_stamp, self.height, yaw, pitch, roll, self.is_video
 
+    def get_log_start_time(self) -> datetime:
+        return to_datetime(self.time_stamp.min())
+
+    def set_log_columns(
+        self,
+        time_stamp: np.ndarray,
+        height: np.ndarray,
+        yaw: np.ndarray,
+        pitch: np.ndarray,
+        roll: np.ndarray,
+        latitude: np.ndarray,
+        longitude: np.ndarray,
+        is_video: np.ndarray,
+    ) -> None:
+        """Store the log columns. The angles are given in degrees."""
+        self.time_stamp = np.asarray(time_stamp, dtype="datetime64[ns]")
+        self.height = np.asarray(height, dtype=np.float64)
+        self.rotation = np.empty(len(self.time_stamp), dtype=ROTATION_DTYPE)
+        self.rotation["yaw"] = np.radians(yaw)
+        self.rotation["pitch"] = np.radians(pitch)
+        self.rotation["roll"] = np.radians(roll)
+        self.pos = np.empty(len(self.time_stamp), dtype=POSITION_DTYPE)
+        self.pos["lat"] = latitude
+        self.pos["lon"] = longitude
+        self.is_video = np.asarray(is_video, dtype=bool)
+        self._build_time_index()
+
+    def get_columns(self) -> dict[str, np.ndarray]:
+        return {
+            "time_stamp": self.time_stamp,
+            "height": self.height,
+            "rotation": self.rotation,
+            "pos": self.pos,
+            "is_video": self.is_video,
+        }
+
+    def set_columns(self, columns: dict[str, np.ndarray]) -> None:
+        """Restore the columns as returned by get_columns."""
+        self.time_stamp = columns["time_stamp"]
+        self.height = columns["height"]
+        self.rotation = columns["rotation"]
+        self.pos = columns["pos"]
+        self.is_video = columns["is_video"]
+        self._build_time_index()
+
+    def _build_time_index(self) -> None:
+        """Sort the time stamps once, such that lookups can use binary search."""
+        self._time_order = np.argsort(self.time_stamp, kind="stable")
+        self._sorted_time_stamp = self.time_stamp[self._time_order]
+        # Rows with unique time stamps (the first of any duplicates) used for interpolation.
+        unique_time_stamp, first_idx = np.unique(self._sorted_time_stamp, return_index=True)
+        self._unique_time_rows = self._time_order[first_idx]
+        self._unique_seconds = (unique_time_stamp - unique_time_stamp[:1]) / np.timedelta64(1, "s")
+        self._pose_table = None
+
     @staticmethod
     def test_log(log: Path) -> bool:
         res = DroneLog.test_log_txt_to_log_csv_file(log)
@@ -63,9 +142,8 @@ class DroneLog:
             "gimbal_roll(degrees)",
             "altitude(meters)",
         ]
-        # remove_null_bytes(log)
         logger.debug(f'Opening log "{log}" to test - assuming it contains data from airdata.com ')
-        with log.open(encoding="iso8859_10") as csv_file:
+        with open_log(log) as csv_file:
             reader = csv.DictReader(csv_file)
             row = next(reader)
             for idx in indexes:
@@ -87,9 +165,8 @@ class DroneLog:
             "OSD.latitude",
             "OSD.longitude",
         ]
-        remove_null_bytes(log)
         logger.debug(f'Opening log "{log}" to test - assuming it contains data from TXTlogToCSVtool.exe')
-        with log.open(encoding="iso8859_10") as csv_file:
+        with open_log(log) as csv_file:
             reader = csv.DictReader(csv_file)
             row = next(reader)
             for idx in indexes:
@@ -99,7 +176,17 @@ class DroneLog:
             logger.debug("Found all expected columns in the log file (TXTlogToCSVtool.exe)")
             return True
 
-    def get_log_data(self, log: Path) -> None:
+    def get_log_data(self, log: Path, use_cache: bool = True) -> None:
+        if use_cache:
+            columns = read_log_cache(log)
+            if columns is not None:
+                self.set_columns(columns)
+                return
+        self.parse_log(log)
+        if use_cache:
+            write_log_cache(log, self.get_columns())
+
+    def parse_log(self, log: Path) -> None:
         try:
             self.get_log_data_txt_to_log_csv_file(log)
             return
@@ -115,11 +202,6 @@ class DroneLog:
 
     def get_log_data_air_data_com(self, log: Path) -> None:
         logger.debug(f"Getting log data for {log}")
-        self.time_stamp = []
-        self.height = []
-        self.rotation = []
-        self.pos = []
-        self.is_video = []
         time_idx = "datetime(utc)"
         time_milliseconds_idx = "time(millisecond)"
         yaw_idx = "gimbal_heading(degrees)"
@@ -129,42 +211,42 @@ class DroneLog:
         is_video_idx = "isVideo"
         latitude_idx = "latitude"
         longitude_idx = "longitude"
-        remove_null_bytes(log)
-        number_of_parsed_lines = 0
-        first_row = None
-        with log.open(encoding="iso8859_10") as csv_file:
-            reader = csv.DictReader(csv_file)
-            for row in reader:
-                if row[time_idx]:
-                    if first_row is None:
-                        first_row = row[time_idx]
-                        date_time_first_row = datetime.strptime(row[time_idx], "%Y-%m-%d %H:%M:%S")
-                    try:
-                        self.time_stamp.append(
-                            date_time_first_row + timedelta(milliseconds=float(row[time_milliseconds_idx]))
-                        )
-                        self.height.append(float(row[height_idx]))
-                        yaw = float(row[yaw_idx]) * np.pi / 180
-                        pitch = float(row[pitch_idx]) * np.pi / 180
-                        roll = float(row[roll_idx]) * np.pi / 180
-                        self.rotation.append((yaw, pitch, roll))
-                        latitude = float(row[latitude_idx])
-                        longitude = float(row[longitude_idx])
-                        self.pos.append((latitude, longitude))
-                        self.is_video.append(row[is_video_idx] == "1")
-                    except ValueError as VE:
-                        logger.debug(f"Row skipped because of value error ({VE}).")
-                        continue
-                    number_of_parsed_lines += 1
-        logger.debug(f"Number of parsed lines: {number_of_parsed_lines}")
+        columns = read_log_columns(
+            log,
+            [
+                time_idx,
+                time_milliseconds_idx,
+                yaw_idx,
+                pitch_idx,
+                roll_idx,
+                height_idx,
+                is_video_idx,
+                latitude_idx,
+                longitude_idx,
+            ],
+        )
+        columns = {key: value[columns[time_idx] != ""] for key, value in columns.items()}
+        milliseconds = to_float(columns[time_milliseconds_idx])
+        if len(milliseconds):
+            date_time_first_row = to_datetime64(columns[time_idx][:1])[0]
+            offset = np.round(milliseconds * 1e6)
+            time_stamp = date_time_first_row + np.nan_to_num(offset).astype("timedelta64[ns]")
+            time_stamp[np.isnan(offset)] = np.datetime64("NaT")
+        else:
+            time_stamp = np.array([], dtype="datetime64[ns]")
+        self._set_parsed_columns(
+            time_stamp,
+            to_float(columns[height_idx]),
+            to_float(columns[yaw_idx]),
+            to_float(columns[pitch_idx]),
+            to_float(columns[roll_idx]),
+            to_float(columns[latitude_idx]),
+            to_float(columns[longitude_idx]),
+            columns[is_video_idx] == "1",
+        )
 
     def get_log_data_txt_to_log_csv_file(self, log: Path) -> None:
         logger.debug(f"Getting log data for {log}")
-        self.time_stamp = []
-        self.height = []
-        self.rotation = []
-        self.pos = []
-        self.is_video = []
         time_idx = "CUSTOM.updateTime"
         yaw_idx = "GIMBAL.yaw"
         pitch_idx = "GIMBAL.pitch"
@@ -173,31 +255,48 @@ class DroneLog:
         is_video_idx = "CUSTOM.isVideo"
         latitude_idx = "OSD.latitude"
         longitude_idx = "OSD.longitude"
-        remove_null_bytes(log)
-        number_of_parsed_lines = 0
-        with log.open(encoding="iso8859_10") as csv_file:
-            reader = csv.DictReader(csv_file)
-            for row in reader:
-                if row[time_idx]:
-                    try:
-                        self.time_stamp.append(datetime.strptime(row[time_idx], "%Y/%m/%d %H:%M:%S.%f"))
-                    except ValueError:
-                        self.time_stamp.append(datetime.strptime(row[time_idx], "%Y/%m/%d %H:%M:%S"))
-                    try:
-                        self.height.append(float(row[height_idx]))
-                        yaw = float(row[yaw_idx]) * np.pi / 180
-                        pitch = float(row[pitch_idx]) * np.pi / 180
-                        roll = float(row[roll_idx]) * np.pi / 180
-                        self.rotation.append((yaw, pitch, roll))
-                        latitude = float(row[latitude_idx])
-                        longitude = float(row[longitude_idx])
-                        self.pos.append((latitude, longitude))
-                        self.is_video.append(bool(row[is_video_idx]))
-                    except ValueError as VE:
-                        logger.debug(f"Row skipped because of value error ({VE}).")
-                        continue
-                    number_of_parsed_lines += 1
-        logger.debug(f"Number of parsed lines: {number_of_parsed_lines}")
+        columns = read_log_columns(
+            log, [time_idx, yaw_idx, pitch_idx, roll_idx, height_idx, is_video_idx, latitude_idx, longitude_idx]
+        )
+        columns = {key: value[columns[time_idx] != ""] for key, value in columns.items()}
+        self._set_parsed_columns(
+            to_datetime64(np.char.replace(columns[time_idx], "/", "-")),
+            to_float(columns[height_idx]),
+            to_float(columns[yaw_idx]),
+            to_float(columns[pitch_idx]),
+            to_float(columns[roll_idx]),
+            to_float(columns[latitude_idx]),
+            to_float(columns[longitude_idx]),
+            columns[is_video_idx] != "",
+        )
+
+    def _set_parsed_columns(
+        self,
+        time_stamp: np.ndarray,
+        height: np.ndarray,
+        yaw: np.ndarray,
+        pitch: np.ndarray,
+        roll: np.ndarray,
+        latitude: np.ndarray,
+        longitude: np.ndarray,
+        is_video: np.ndarray,
+    ) -> None:
+        """Drop rows where a value could not be parsed and store the remaining."""
+        values = np.column_stack((height, yaw, pitch, roll, latitude, longitude))
+        valid = ~np.isnat(time_stamp) & np.all(np.isfinite(values), axis=1)
+        if not np.all(valid):
+            logger.debug(f"{np.count_nonzero(~valid)} rows skipped because of value errors.")
+        self.set_log_columns(
+            time_stamp[valid],
+            height[valid],
+            yaw[valid],
+            pitch[valid],
+            roll[valid],
+            latitude[valid],
+            longitude[valid],
+            is_video[valid],
+        )
+        logger.debug(f"Number of parsed lines: {len(self.time_stamp)}")
 
     def get_video_data(self, project: str, video_file: str) -> None:
         logger.debug(f"Reading video data for video {video_file} in {project}")
@@ -245,11 +344,11 @@ class DroneLog:
         if self.video_start_time is not None:
             logger.debug(f"self.video_start_time: {self.video_start_time}")
             return self.video_start_time, None
-        video_ranges = list(get_video_ranges(self.is_video, self.time_stamp))
+        message = None
+        video_ranges = get_video_range_indices(self.is_video)
         if len(video_ranges) == 0:
             message = "Warning: No video recordings found in the logfile. You need to manually specify when the video recording started relative to the start of the logfile."
-            minimum_log = min([(x, x) for x in self.time_stamp], key=lambda z: z[0])
-            self.video_start_time = minimum_log[1]
+            self.video_start_time = self.get_log_start_time()
         elif self.video_pos is not None and self.video_pos[0] is not None:
             minimum_pos = self.locate_best_match_based_on_location(video_ranges)
             self.video_start_time = minimum_pos[1]
@@ -263,37 +362,81 @@ class DroneLog:
         logger.debug(f"Matching message: {message}")
         return self.video_start_time, message
 
-    def locate_best_match_based_on_location(
-        self, video_ranges: list[tuple[datetime, datetime]]
-    ) -> tuple[float, datetime]:
+    def locate_best_match_based_on_location(self, video_ranges: np.ndarray) -> tuple[float, datetime]:
+        """Find the video range in the log starting closest to the video position."""
         video_utm_pos = utm.from_latlon(*self.video_pos)
-        start_utm_pos = [utm.from_latlon(*self.pos[self.time_stamp.index(y[0])]) for y in video_ranges]
-        minimum = min(
-            [
-                (abs(video_utm_pos[0] - x[0]) + abs(video_utm_pos[1] - x[1]), y[0])
-                for x, y in zip(start_utm_pos, video_ranges, strict=False)
-            ],
-            key=lambda z: z[0],
-        )
-        return minimum
+        start_pos = self.pos[video_ranges[:, 0]]
+        start_utm_pos = [utm.from_latlon(lat, lon) for lat, lon in start_pos.tolist()]
+        distances = [abs(video_utm_pos[0] - x[0]) + abs(video_utm_pos[1] - x[1]) for x in start_utm_pos]
+        best = int(np.argmin(distances))
+        return distances[best], to_datetime(self.time_stamp[video_ranges[best, 0]])
 
-    def locate_best_match_based_on_duration(
-        self, video_ranges: list[tuple[datetime, datetime]]
-    ) -> tuple[float, datetime]:
-        absolute_time_differences = [
-            (abs((x[1] - x[0]).total_seconds() - self.video_duration), x[0]) for x in video_ranges
-        ]
-        minimum = min(absolute_time_differences, key=lambda y: y[0])
-        return minimum
+    def locate_best_match_based_on_duration(self, video_ranges: np.ndarray) -> tuple[float, datetime]:
+        """Find the video range in the log with duration closest to the video duration."""
+        durations = (self.time_stamp[video_ranges[:, 1]] - self.time_stamp[video_ranges[:, 0]]) / np.timedelta64(1, "s")
+        absolute_time_differences = np.abs(durations - self.video_duration)
+        best = int(np.argmin(absolute_time_differences))
+        return float(absolute_time_differences[best]), to_datetime(self.time_stamp[video_ranges[best, 0]])
 
     def get_log_data_from_frame(
         self, frame: int
     ) -> tuple[datetime, float, tuple[float, float, float], tuple[float, float]]:
         logger.debug(f"Getting log data for frame {frame}")
-        delta_time = timedelta(seconds=frame / self.video_nb_frames * self.video_duration)
-        if self.video_start_time is not None:
-            time = self.video_start_time + delta_time
-        idx = self.get_time_idx(time)
+        time_stamp, height, rotation, pos = self.get_log_data_from_frames(np.array([frame]))
+        return (
+            to_datetime(time_stamp[0]),
+            float(height[0]),
+            rotation[0].item(),
+            pos[0].item(),
+        )
+
+    def get_log_data_from_frames(self, frames: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Vectorized version of get_log_data_from_frame. Returns the time stamps,
+        heights (including the takeoff altitude), rotations and positions for
+        each of the frames. Frames of the video are read from the pose table
+        if it is already computed or the frames are a large part of the video,
+        otherwise they are looked up directly.
+        """
+        frames = np.asarray(frames)
+        use_pose_table = (
+            self._pose_table is not None and self._pose_table_key == self._get_pose_table_key()
+        ) or frames.size * POSE_TABLE_BATCH_RATIO >= self.video_nb_frames
+        if (
+            use_pose_table
+            and np.issubdtype(frames.dtype, np.integer)
+            and np.all((frames >= 0) & (frames <= self.video_nb_frames))
+        ):
+            time_stamp, height, rotation, pos = self.get_pose_table()
+            return time_stamp[frames], height[frames], rotation[frames], pos[frames]
+        return self.get_log_data_at_times(self.get_frame_times(frames))
+
+    def get_pose_table(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The pose for every frame of the video (0 to video_nb_frames). The
+        table is computed once and reused until the video settings change.
+        """
+        key = self._get_pose_table_key()
+        if self._pose_table is None or self._pose_table_key != key:
+            logger.debug("Computing pose table")
+            frame_times = self.get_frame_times(np.arange(self.video_nb_frames + 1))
+            self._pose_table = self.get_log_data_at_times(frame_times)
+            self._pose_table_key = key
+        return self._pose_table
+
+    def _get_pose_table_key(self) -> tuple[Any, ...]:
+        return (
+            self.video_start_time,
+            self.video_nb_frames,
+            self.video_duration,
+            self.takeoff_altitude,
+            self.interpolate_pose,
+        )
+
+    def get_log_data_at_times(self, times: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        if self.interpolate_pose:
+            return self.interpolate_log_data(times)
+        idx = self.get_time_indices(times)
         return (
             self.time_stamp[idx],
             self.height[idx] + self.takeoff_altitude,
@@ -301,32 +444,185 @@ class DroneLog:
             self.pos[idx],
         )
 
+    def interpolate_log_data(self, times: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Linear interpolation of height, rotation and position between log
+        rows. The angles are unwrapped before interpolation and wrapped to
+        [-pi, pi) afterwards. Times outside the log use the first or last row.
+        """
+        times = np.asarray(times, dtype="datetime64[ns]")
+        rows = self._unique_time_rows
+        log_seconds = self._unique_seconds
+        seconds = (times - self._sorted_time_stamp[0]) / np.timedelta64(1, "s")
+        height = np.interp(seconds, log_seconds, self.height[rows]) + self.takeoff_altitude
+        rotation = np.empty(len(times), dtype=ROTATION_DTYPE)
+        for name in ROTATION_DTYPE.names or ():
+            angle = np.interp(seconds, log_seconds, np.unwrap(self.rotation[name][rows]))
+            rotation[name] = (angle + np.pi) % (2 * np.pi) - np.pi
+        pos = np.empty(len(times), dtype=POSITION_DTYPE)
+        for name in POSITION_DTYPE.names or ():
+            pos[name] = np.interp(seconds, log_seconds, self.pos[name][rows])
+        return times, height, rotation, pos
+
+    def get_frame_times(self, frames: np.ndarray) -> np.ndarray:
+        """The time of each frame as datetime64 given the video start time."""
+        if self.video_start_time is None:
+            raise ValueError("The video start time is not set.")
+        seconds = np.asarray(frames, dtype=np.float64) / self.video_nb_frames * self.video_duration
+        delta_time = np.round(seconds * 1e6).astype("timedelta64[us]")
+        frame_times: np.ndarray = np.datetime64(self.video_start_time, "ns") + delta_time
+        return frame_times
+
     def get_time_idx(self, time: datetime) -> int:
-        idx_and_absolute_time_difference = [
-            (abs((x - time).total_seconds()), idx) for idx, x in enumerate(self.time_stamp)
-        ]
-        minimum = min(idx_and_absolute_time_difference, key=lambda y: y[0])
-        return minimum[1]
+        return int(self.get_time_indices(np.array([time], dtype="datetime64[ns]"))[0])
+
+    def get_time_indices(self, times: np.ndarray) -> np.ndarray:
+        """
+        Index of the log row closest in time to each of the given times.
+        If several rows share the closest time stamp the first one is used.
+        """
+        times = np.asarray(times, dtype="datetime64[ns]")
+        sorted_time_stamp = self._sorted_time_stamp
+        right = np.clip(np.searchsorted(sorted_time_stamp, times, side="left"), 1, len(sorted_time_stamp) - 1)
+        left = right - 1
+        use_right = (sorted_time_stamp[right] - times) < (times - sorted_time_stamp[left])
+        nearest = np.where(use_right, right, left)
+        nearest = np.searchsorted(sorted_time_stamp, sorted_time_stamp[nearest], side="left")
+        indices: np.ndarray = self._time_order[nearest]
+        return indices
+
+
+def read_log_columns(log: Path, columns: list[str]) -> dict[str, np.ndarray]:
+    """
+    Read the named columns of a csv log file into arrays of strings.
+    Raises KeyError if one of the columns is not in the header.
+    """
+    with open_log(log, newline="") as csv_file:
+        header = next(csv.reader([csv_file.readline()]), [])
+        try:
+            indexes = [header.index(column) for column in columns]
+        except ValueError as e:
+            raise KeyError(str(e)) from e
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                data = np.loadtxt(
+                    csv_file, delimiter=",", quotechar='"', comments=None, usecols=indexes, dtype=str, ndmin=2
+                )
+        except ValueError:
+            logger.debug("Log has rows with missing columns, reading it row by row")
+            data = read_complete_rows(log, indexes)
+    data = data.reshape(-1, len(columns))
+    return {column: data[:, i] for i, column in enumerate(columns)}
+
+
+def read_complete_rows(log: Path, indexes: list[int]) -> np.ndarray:
+    """The values at the indexes of the rows after the header which have all of them."""
+    with open_log(log, newline="") as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader, None)
+        row_length = max(indexes) + 1
+        rows = [[row[idx] for idx in indexes] for row in reader if len(row) >= row_length]
+    return np.array(rows, dtype=str)
+
+
+def to_float(values: np.ndarray) -> np.ndarray:
+    """Convert an array of strings to float64. Values that can not be parsed become nan."""
+    try:
+        return values.astype(np.float64)
+    except ValueError:
+        return np.array([_parse_float(value) for value in values], dtype=np.float64)
+
+
+def _parse_float(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def to_datetime64(values: np.ndarray) -> np.ndarray:
+    """
+    Convert an array of ISO like time strings to datetime64[ns]. Values
+    which numpy can not parse, such as dates and times without zero
+    padding, are parsed with DATETIME_FORMATS. Values that can not be
+    parsed become NaT.
+    """
+    try:
+        return values.astype("datetime64[ns]")
+    except ValueError:
+        return np.array([_parse_datetime64(value) for value in values], dtype="datetime64[ns]")
+
+
+def _parse_datetime64(value: str) -> np.datetime64:
+    try:
+        return np.datetime64(value, "ns")
+    except ValueError:
+        pass
+    for date_format in DATETIME_FORMATS:
+        try:
+            return np.datetime64(datetime.strptime(value, date_format), "ns")
+        except ValueError:
+            continue
+    return np.datetime64("NaT", "ns")
+
+
+def to_datetime(time_stamp: np.datetime64) -> datetime:
+    """Convert a datetime64 to a python datetime with microsecond resolution."""
+    result: datetime = time_stamp.astype("datetime64[us]").item()
+    return result
+
+
+class NullByteFilter(io.RawIOBase):
+    """
+    Read only stream which drops null bytes from the wrapped binary stream.
+    Some logs contain null bytes which the csv module can not handle.
+    """
+
+    def __init__(self, raw: BinaryIO, chunk_size: int = 1 << 16) -> None:
+        self._raw = raw
+        self._chunk_size = chunk_size
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        size = min(len(buffer), self._chunk_size)
+        while True:
+            chunk = self._raw.read(size)
+            if not chunk:
+                return 0
+            chunk = chunk.replace(b"\x00", b"")
+            if chunk:
+                break
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self) -> None:
+        self._raw.close()
+        super().close()
 
 
-def remove_null_bytes(log: Path) -> None:
-    logger.debug(f"Removing null bytes from log: {log}")
-    with log.open("rb") as fi:
-        data = fi.read()
-    with log.open("wb") as fo:
-        fo.write(data.replace(b"\x00", b""))
+def open_log(log: Path, newline: str | None = None) -> TextIO:
+    """Open a log file for reading as text with null bytes filtered out while reading."""
+    return io.TextIOWrapper(io.BufferedReader(NullByteFilter(log.open("rb"))), encoding="iso8859_10", newline=newline)
 
 
-def get_video_ranges(is_video: list[bool], time_stamp: list[datetime]) -> Generator[tuple[datetime, datetime]]:
-    last_state = False
-    for k, t in zip(is_video, time_stamp, strict=False):
-        if k and not last_state:
-            video_begin = t
-        if not k and last_state:
-            yield video_begin, t
-        last_state = k
-    if last_state:
-        yield video_begin, t
+def get_video_range_indices(is_video: np.ndarray) -> np.ndarray:
+    """
+    Return the start and end index of each video recording in the log as
+    an (N, 2) array. The end index is the first row after the recording
+    or the last row of the log if the recording never ended.
+    """
+    state = np.concatenate(([False], np.asarray(is_video, dtype=bool))).astype(np.int8)
+    changes = np.diff(state)
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    if len(ends) < len(starts):
+        ends = np.append(ends, len(is_video) - 1)
+    return np.column_stack((starts, ends))
 
 
-drone_log = DroneLog()
+def get_video_ranges(is_video: np.ndarray, time_stamp: np.ndarray) -> Generator[tuple[datetime, datetime]]:
+    for start, end in get_video_range_indices(is_video):
+        yield to_datetime(time_stamp[start]), to_datetime(time_stamp[end])
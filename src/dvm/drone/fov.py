@@ -1,7 +1,10 @@
 from __future__ import annotations
 
+import functools
+import hashlib
 import logging
 from collections import defaultdict
+from collections.abc import Generator
 from typing import Any
 
 import cv2
@@ -11,11 +14,6 @@ import utm
 logger = logging.getLogger("app." + __name__)
 
 
-# https://stackoverflow.com/a/2150512/185475
-def shift(seq: list[Any], n: int) -> list[Any]:
-    return seq[n:] + seq[:n]
-
-
 class Fov:
     def __init__(self) -> None:
         logger.debug(f"Creating instance of Fov {self}")
@@ -43,6 +41,14 @@ class Fov:
         self.horizontal_fov = horizontal_fov * np.pi / 180
         self.vertical_fov = vertical_fov * np.pi / 180
 
+    @property
+    def calibration_key(self) -> str:
+        """Identifies the calibration and image size, e.g. for caching results computed from them."""
+        digest = hashlib.sha256(f"{self.image_size[0]}x{self.image_size[1]}".encode())
+        digest.update(np.ascontiguousarray(self.camera_matrix, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(self.dist_coefficients, dtype=np.float64).tobytes())
+        return digest.hexdigest()
+
     @staticmethod
     def roll(roll: float) -> np.ndarray:
         return np.array(
@@ -70,25 +76,52 @@ class Fov:
     def rotation(self, yaw: float, pitch: float, roll: float) -> np.ndarray:
         return np.matmul(self.yaw(yaw), np.matmul(self.pitch(pitch), self.roll(roll)))
 
+    @staticmethod
+    def rotations(yaw: np.ndarray, pitch: np.ndarray, roll: np.ndarray) -> np.ndarray:
+        """Stack of rotation matrices with shape (N, 3, 3) for arrays of angles."""
+        zeros = np.zeros_like(yaw)
+        ones = np.ones_like(yaw)
+        yaw_matrices = np.stack(
+            [np.cos(yaw), -np.sin(yaw), zeros, np.sin(yaw), np.cos(yaw), zeros, zeros, zeros, ones], axis=-1
+        ).reshape(-1, 3, 3)
+        pitch_matrices = np.stack(
+            [ones, zeros, zeros, zeros, np.cos(pitch), -np.sin(pitch), zeros, np.sin(pitch), np.cos(pitch)], axis=-1
+        ).reshape(-1, 3, 3)
+        roll_matrices = np.stack(
+            [np.cos(roll), zeros, np.sin(roll), zeros, ones, zeros, -np.sin(roll), zeros, np.cos(roll)], axis=-1
+        ).reshape(-1, 3, 3)
+        rotation_matrices: np.ndarray = yaw_matrices @ pitch_matrices @ roll_matrices
+        return rotation_matrices
+
     def get_unit_vector(self, image_point: tuple[float, float]) -> np.ndarray:
-        if self.camera_matrix is not None:
-            undist_point = cv2.undistortPoints(
-                np.array([[image_point]], dtype=np.float32),
-                self.camera_matrix,
-                self.dist_coefficients,
-                P=self.camera_matrix,
-            )[0][0]
+        unit_vector: np.ndarray = self.get_unit_vectors(np.array([image_point]))[0]
+        return unit_vector
+
+    def undistort_points(self, image_points: np.ndarray) -> np.ndarray:
+        undist_points: np.ndarray = cv2.undistortPoints(
+            image_points.astype(np.float32).reshape(-1, 1, 2),
+            self.camera_matrix,
+            self.dist_coefficients,
+            P=self.camera_matrix,
+        ).reshape(-1, 2)
+        return undist_points.astype(np.float64)
+
+    def get_unit_vectors(self, image_points: np.ndarray | list[tuple[float, float]]) -> np.ndarray:
+        """Unit vectors in the camera frame for an (N, 2) array of image points."""
+        image_points = np.asarray(image_points, dtype=np.float64).reshape(-1, 2)
+        if self.camera_matrix is not None and len(image_points):
+            undist_points = self.undistort_points(image_points)
         else:
-            undist_point = image_point
+            undist_points = image_points
         image_center = np.array([self.image_size[0] / 2, self.image_size[1] / 2])
-        image_point_from_center = undist_point - image_center
+        image_points_from_center = undist_points - image_center
         image_plane_width_in_meters = np.tan(self.horizontal_fov / 2) * 2
         image_plane_height_in_meters = np.tan(self.vertical_fov / 2) * 2
-        x = image_point_from_center[0] / self.image_size[0] * image_plane_width_in_meters
-        y = 1
-        z = -image_point_from_center[1] / self.image_size[1] * image_plane_height_in_meters
-        vector = np.array([x, y, z])
-        return vector
+        x = image_points_from_center[:, 0] / self.image_size[0] * image_plane_width_in_meters
+        y = np.ones(len(image_points_from_center))
+        z = -image_points_from_center[:, 1] / self.image_size[1] * image_plane_height_in_meters
+        vectors: np.ndarray = np.column_stack((x, y, z))
+        return vectors
 
     def get_horizon_and_world_corners(
         self, world_point_dict: dict[Any, Any], yaw_pitch_roll: tuple[float, float, float]
@@ -96,32 +129,35 @@ class Fov:
         margin = 200
         yaw_pitch_roll = (-yaw_pitch_roll[0], yaw_pitch_roll[1], yaw_pitch_roll[2])
         rotation_matrix = self.rotation(*yaw_pitch_roll)
-        image_points = defaultdict(list)
+        projection = self.camera_matrix @ self.rotation(0, np.pi / 2, 0)
+        image_points: defaultdict[Any, list[dict[str, int]]] = defaultdict(list)
         for direction, world_points in world_point_dict.items():
-            temp_image_points_x = []
-            temp_image_points_y = []
-            for world_point in world_points:
-                world_rotated_vector = np.matmul(np.transpose(rotation_matrix), world_point)
-                if world_rotated_vector[1] >= 0:
-                    vector = self.camera_matrix @ self.rotation(0, np.pi / 2, 0) @ world_rotated_vector
-                    image_point_x = int(vector[0] / vector[2])
-                    image_point_y = int(vector[1] / vector[2])
-                    if (
-                        -margin <= image_point_x <= self.image_size[0] + margin
-                        and -margin <= image_point_y <= self.image_size[1] + margin
-                    ):
-                        temp_image_points_x.append(image_point_x)
-                        temp_image_points_y.append(image_point_y)
-            if temp_image_points_x != []:
-                # Find last occurrence of the maximum x value
-                name_id = len(temp_image_points_x) - 1 - temp_image_points_x[::-1].index(max(temp_image_points_x))
-                # Reorder temp_image_points such that the largest x value is the first in the list.
-                temp_image_points_x = shift(temp_image_points_x, name_id)
-                temp_image_points_y = shift(temp_image_points_y, name_id)
-            left = min(temp_image_points_x, default=0)
-            top = min(temp_image_points_y, default=0)
-            for x, y in zip(temp_image_points_x, temp_image_points_y, strict=False):
-                image_points[direction].append({"x": x - left, "y": y - top})
+            # Row vectors times the rotation matrix is the transposed rotation of each point.
+            world_rotated_vectors = np.asarray(world_points, dtype=np.float64).reshape(-1, 3) @ rotation_matrix
+            world_rotated_vectors = world_rotated_vectors[world_rotated_vectors[:, 1] >= 0]
+            vectors = world_rotated_vectors @ projection.T
+            image_points_x = np.trunc(vectors[:, 0] / vectors[:, 2]).astype(np.int64)
+            image_points_y = np.trunc(vectors[:, 1] / vectors[:, 2]).astype(np.int64)
+            in_view = (
+                (-margin <= image_points_x)
+                & (image_points_x <= self.image_size[0] + margin)
+                & (-margin <= image_points_y)
+                & (image_points_y <= self.image_size[1] + margin)
+            )
+            image_points_x = image_points_x[in_view]
+            image_points_y = image_points_y[in_view]
+            if len(image_points_x):
+                # Reorder the points such that the last occurrence of the largest x value is first.
+                name_id = len(image_points_x) - 1 - int(np.argmax(image_points_x[::-1]))
+                image_points_x = np.roll(image_points_x, -name_id)
+                image_points_y = np.roll(image_points_y, -name_id)
+                left = int(image_points_x.min())
+                top = int(image_points_y.min())
+                for x, y in zip((image_points_x - left).tolist(), (image_points_y - top).tolist(), strict=True):
+                    image_points[direction].append({"x": x, "y": y})
+            else:
+                left = 0
+                top = 0
             image_points[direction + "_pos"].append({"top": top, "left": left})
         return image_points
 
@@ -133,30 +169,45 @@ class Fov:
         pos: tuple[float, float],
         return_zone: bool = False,
     ) -> tuple[np.ndarray, tuple[int, str]] | np.ndarray:
-        unit_vector = self.get_unit_vector(image_point)
-        yaw_pitch_roll = (-yaw_pitch_roll[0], yaw_pitch_roll[1], yaw_pitch_roll[2])
-        rotation_matrix = self.rotation(*yaw_pitch_roll)
-        rotated_vector = np.matmul(rotation_matrix, unit_vector)
-        ground_vector = rotated_vector / rotated_vector[2] * -drone_height
-        east_north_zone = self.convert_gps(*pos)
-        world_point: np.ndarray = ground_vector[:2] + np.array(east_north_zone[:2])
+        world_points, zone_numbers, zone_letters = self.get_world_points(
+            np.array([image_point]), drone_height, yaw_pitch_roll, pos, return_zone=True
+        )
+        world_point: np.ndarray = world_points[0]
         if return_zone:
-            return world_point, east_north_zone[2:]
+            return world_point, (int(zone_numbers[0]), str(zone_letters[0]))
         else:
             return world_point
 
     def get_world_points(
         self,
-        image_points: list[tuple[int, int]],
-        drone_height: float,
-        yaw_pitch_roll: tuple[float, float, float],
-        pos: tuple[float, float],
-    ) -> list[np.ndarray | tuple[np.ndarray, str]]:
-        world_points = []
-        for image_point in image_points:
-            world_point = self.get_world_point(image_point, drone_height, yaw_pitch_roll, pos)
-            world_points.append(world_point)
-        return world_points
+        image_points: np.ndarray | list[tuple[float, float]],
+        drone_height: float | np.ndarray,
+        yaw_pitch_roll: tuple[float, float, float] | np.ndarray,
+        pos: tuple[float, float] | np.ndarray,
+        return_zone: bool = False,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray] | np.ndarray:
+        """
+        Project an (N, 2) array of image points to the ground. The pose is
+        either a single pose used for all points or arrays with one pose per
+        point, where yaw_pitch_roll and pos are (N,) structured arrays with the
+        fields of ROTATION_DTYPE and POSITION_DTYPE or (N, 3) and (N, 2) arrays.
+        Returns an (N, 2) array of UTM east and north and optionally the zone
+        number and zone letter of each point.
+        """
+        unit_vectors = self.get_unit_vectors(image_points)
+        n_points = len(unit_vectors)
+        yaw, pitch, roll = get_pose_columns(yaw_pitch_roll, ("yaw", "pitch", "roll"), n_points)
+        lat, lon = get_pose_columns(pos, ("lat", "lon"), n_points)
+        height = np.broadcast_to(np.asarray(drone_height, dtype=np.float64), (n_points,))
+        rotation_matrices = self.rotations(-yaw, pitch, roll)
+        rotated_vectors = np.einsum("nij,nj->ni", rotation_matrices, unit_vectors)
+        ground_vectors = rotated_vectors[:, :2] / rotated_vectors[:, 2:] * -height[:, np.newaxis]
+        east, north, zone_numbers, zone_letters = self.convert_gps_points(lat, lon)
+        world_points: np.ndarray = ground_vectors + np.column_stack((east, north))
+        if return_zone:
+            return world_points, zone_numbers, zone_letters
+        else:
+            return world_points
 
     def get_gps_point(
         self,
@@ -174,10 +225,79 @@ class Fov:
         east_north_zone: tuple[float, float, int, str] = utm.from_latlon(lat, lon)
         return east_north_zone
 
+    @staticmethod
+    def convert_gps_points(lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Convert arrays of positions to UTM. The positions are grouped by zone
+        and each zone is converted with a single vectorized call.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        zone_numbers, zone_letters = get_utm_zones(lat, lon)
+        east = np.empty(len(lat))
+        north = np.empty(len(lat))
+        for (zone_number, zone_letter), mask in group_by_zone(zone_numbers, zone_letters):
+            east[mask], north[mask], _, _ = utm.from_latlon(
+                lat[mask], lon[mask], force_zone_number=zone_number, force_zone_letter=zone_letter
+            )
+        return east, north, zone_numbers, zone_letters
+
+    @staticmethod
+    def convert_utm_points(
+        east: np.ndarray, north: np.ndarray, zone_numbers: np.ndarray, zone_letters: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Convert arrays of UTM coordinates to latitude and longitude with one call per zone."""
+        east = np.asarray(east, dtype=np.float64)
+        north = np.asarray(north, dtype=np.float64)
+        lat = np.empty(len(east))
+        lon = np.empty(len(east))
+        for (zone_number, zone_letter), mask in group_by_zone(zone_numbers, zone_letters):
+            lat[mask], lon[mask] = utm.to_latlon(east[mask], north[mask], zone_number, zone_letter)
+        return lat, lon
+
     @staticmethod
     def convert_utm(east: float, north: float, zone: tuple[int, str]) -> tuple[float, float]:
         lat, lon = utm.to_latlon(east, north, *zone)
         return lat, lon
 
 
-fov = Fov()
+@functools.lru_cache(maxsize=4096)
+def get_utm_zone(lat: float, lon: float) -> tuple[int, str]:
+    return utm.latlon_to_zone_number(lat, lon), utm.latitude_to_zone_letter(lat)
+
+
+def get_utm_zones(lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The UTM zone number and letter of each position. Zones are only looked up
+    once per distinct position and remembered across calls, as nearly all
+    positions of a project share a handful of drone positions and one zone.
+    """
+    positions, inverse = np.unique(np.column_stack((lat, lon)), axis=0, return_inverse=True)
+    zones = [get_utm_zone(position_lat, position_lon) for position_lat, position_lon in positions.tolist()]
+    zone_numbers = np.array([zone[0] for zone in zones], dtype=np.int64)[inverse.reshape(-1)]
+    zone_letters = np.array([zone[1] for zone in zones], dtype="<U1")[inverse.reshape(-1)]
+    return zone_numbers, zone_letters
+
+
+def group_by_zone(zone_numbers: np.ndarray, zone_letters: np.ndarray) -> Generator[tuple[tuple[int, str], np.ndarray]]:
+    """Yield each distinct zone with a boolean mask of the points in that zone."""
+    zone_numbers = np.asarray(zone_numbers)
+    zone_letters = np.asarray(zone_letters)
+    zones, inverse = np.unique(np.char.add(zone_numbers.astype(str), zone_letters), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    for i in range(len(zones)):
+        mask = inverse == i
+        first = int(np.argmax(mask))
+        yield (int(zone_numbers[first]), str(zone_letters[first])), mask
+
+
+def get_pose_columns(values: Any, names: tuple[str, ...], n_points: int) -> list[np.ndarray]:
+    """
+    Split a single pose tuple, a structured array or an (N, len(names)) array
+    into one float array of length n_points per name.
+    """
+    array = np.asarray(values)
+    if array.dtype.names:
+        return [np.broadcast_to(array[name].astype(np.float64), (n_points,)) for name in names]
+    array = array.astype(np.float64)
+    return [np.broadcast_to(array[..., i], (n_points,)) for i in range(len(names))]
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import tempfile
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from dvm.app_config import AppConfig
+
+logger = logging.getLogger("app." + __name__)
+
+# Bump when the layout of the cached columns changes.
+CACHE_VERSION = 1
+LOG_COLUMNS = ("time_stamp", "height", "rotation", "pos", "is_video")
+
+_hash_memo: dict[tuple[str, int, int], str] = {}
+
+
+def log_file_hash(log: Path) -> str:
+    """
+    The sha256 of the log file content. The hash is remembered for as long
+    as the size and modification time of the file are unchanged.
+    """
+    stat = log.stat()
+    key = (str(log), stat.st_size, stat.st_mtime_ns)
+    if key not in _hash_memo:
+        digest = hashlib.sha256()
+        with log.open("rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                digest.update(chunk)
+        if len(_hash_memo) > 128:
+            _hash_memo.clear()
+        _hash_memo[key] = digest.hexdigest()
+    return _hash_memo[key]
+
+
+def get_cache_file(log: Path) -> Path:
+    return AppConfig.data_dir / "log_cache" / f"{log_file_hash(log)}.npz"
+
+
+def read_log_cache(log: Path) -> dict[str, np.ndarray] | None:
+    """Return the cached columns of the parsed log or None if they are not cached."""
+    try:
+        cache_file = get_cache_file(log)
+        if not cache_file.exists():
+            return None
+        with np.load(cache_file, allow_pickle=False) as data:
+            if int(data["version"]) != CACHE_VERSION:
+                return None
+            columns = {column: data[column] for column in LOG_COLUMNS}
+    except Exception as e:
+        logger.debug(f"Could not read log cache for {log}: {e}")
+        return None
+    logger.debug(f"Using cached log data from {cache_file}")
+    return columns
+
+
+def write_log_cache(log: Path, columns: dict[str, np.ndarray]) -> None:
+    """
+    Save the parsed columns next to the other data files. The file is
+    written to a temporary name and moved in place, such that other
+    workers never read a partially written cache.
+    """
+    try:
+        cache_file = get_cache_file(log)
+        cache_file.parent.mkdir(exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=cache_file.parent, suffix=".tmp")
+        arrays: dict[str, Any] = {column: columns[column] for column in LOG_COLUMNS}
+        try:
+            with os.fdopen(fd, "wb") as file:
+                np.savez(file, version=np.array(CACHE_VERSION), **arrays)
+            Path(temp_name).replace(cache_file)
+        except BaseException:
+            Path(temp_name).unlink(missing_ok=True)
+            raise
+    except OSError as e:
+        logger.debug(f"Could not write log cache for {log}: {e}")
+        return
+    logger.debug(f"Saved parsed log data to {cache_file}")
+
+
+def remove_log_cache(log: Path) -> None:
+    """Remove the cached columns of the log. Must be called before the log itself is removed."""
+    try:
+        cache_file = get_cache_file(log)
+    except OSError:
+        return
+    cache_file.unlink(missing_ok=True)
+    logger.debug(f"Removed log cache {cache_file}")
@@ -4,18 +4,20 @@ import logging
 from datetime import datetime
 from typing import Any
 
+import numpy as np
 from bokeh.embed import components
 from bokeh.layouts import gridplot
 from bokeh.models import BoxAnnotation, CustomJS, DatetimeTickFormatter, Span
 from bokeh.plotting import figure
 
-from dvm.drone.drone_log_data import get_video_ranges
+from dvm.drone.drone_log_data import LogData, get_video_ranges
+from dvm.drone.fov import Fov
 
 logger = logging.getLogger("app." + __name__)
 
 
 def get_log_plot(
-    log_data: tuple[list[datetime], list[float], list[float], list[float], list[float], list[bool]],
+    log_data: LogData,
 ) -> tuple[str, str]:
     logger.debug("Getting log plot")
     height_plot, yaw_plot, pitch_plot, roll_plot = _get_log_plots(log_data)
@@ -29,7 +31,7 @@ def get_log_plot(
 
 
 def get_log_plot_with_video(
-    log_data: tuple[list[datetime], list[float], list[float], list[float], list[float], list[bool]],
+    log_data: LogData,
     video_start: datetime,
     video_duration: float,
     video_frames: int,
@@ -86,8 +88,25 @@ def get_log_plot_with_video(
     return script, div
 
 
+def get_drone_path(pos: np.ndarray, resolution: float = 0.5) -> list[list[float]]:
+    """
+    Latitude and longitude of the drone path for the map. Consecutive
+    positions within the same resolution by resolution meter UTM cell are
+    left out, as the drone hovering adds thousands of identical points.
+    """
+    if len(pos) == 0:
+        return []
+    east, north, zone_numbers, _ = Fov.convert_gps_points(pos["lat"], pos["lon"])
+    cells = np.column_stack((np.floor(east / resolution), np.floor(north / resolution), zone_numbers))
+    keep = np.ones(len(pos), dtype=bool)
+    keep[1:] = np.any(cells[1:] != cells[:-1], axis=1)
+    keep[-1] = True
+    drone_path: list[list[float]] = np.column_stack((pos["lat"][keep], pos["lon"][keep])).tolist()
+    return drone_path
+
+
 def _get_log_plots(
-    log_data: tuple[list[datetime], list[float], list[float], list[float], list[float], list[bool]],
+    log_data: LogData,
 ) -> tuple[figure, figure, figure, figure]:
     """Make plots for visualizing data from the drone log file."""
     time_stamp = log_data[0]
@@ -137,17 +156,11 @@ def _update_video_plot(dict_arguments: dict[Any, Any]) -> CustomJS:
     )
 
 
-def _shift_yaw(yaw: list[float]) -> list[float]:
-    new_yaw = []
-    last_point = 0.0
-    shift = 0.0
-    for point in yaw:
-        if (last_point > 150 and point < -150) or (last_point < -150 and point > 150):
-            if point < 0:
-                shift += 360
-            else:
-                shift -= 360
-        new_point = point + shift
-        last_point = point
-        new_yaw.append(new_point)
+def _shift_yaw(yaw: np.ndarray) -> np.ndarray:
+    """Remove the jumps of 360 degrees when the yaw crosses +-180 degrees."""
+    last_point = np.concatenate(([0.0], yaw[:-1]))
+    wraps_positive = (last_point > 150) & (yaw < -150)
+    wraps_negative = (last_point < -150) & (yaw > 150)
+    shift = np.cumsum(360.0 * wraps_positive - 360.0 * wraps_negative)
+    new_yaw: np.ndarray = yaw + shift
     return new_yaw
@@ -19,6 +19,7 @@ class NewProjectForm(flask_wtf.FlaskForm):  # type: ignore[misc]
     fixed_cam_drone_yaw = wtforms.fields.DecimalField("Camera yaw:", default=0.0)
     fixed_cam_drone_pitch = wtforms.fields.DecimalField("Camera pitch:", default=-90.0)
     fixed_cam_drone_roll = wtforms.fields.DecimalField("Camera roll:", default=0.0)
+    interpolate_pose = wtforms.fields.BooleanField("Interpolate drone pose between log samples", default=False)
     submit = wtforms.fields.SubmitField("Add Project")
 
 
@@ -38,6 +39,7 @@ class EditProjectForm(flask_wtf.FlaskForm):  # type: ignore[misc]
     edit_fixed_cam_drone_yaw = wtforms.fields.DecimalField("Camera yaw:", default=0.0)
     edit_fixed_cam_drone_pitch = wtforms.fields.DecimalField("Camera pitch:", default=-90.0)
     edit_fixed_cam_drone_roll = wtforms.fields.DecimalField("Camera roll:", default=0.0)
+    edit_interpolate_pose = wtforms.fields.BooleanField("Interpolate drone pose between log samples", default=False)
     edit_submit = wtforms.fields.SubmitField("Edit Project")
 
 
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import zipfile
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import IO, Any
+
+import flask
+import numpy as np
+
+from dvm.app_config import AppConfig, TestConfig
+from dvm.db_model import Annotation, Drone, Project, Video, db
+from dvm.drone.log_cache import log_file_hash
+from dvm.helper_functions import get_annotation_row, iter_annotations, iter_annotations_csv
+from dvm.projects.export_formats import (
+    EXPORT_FORMATS,
+    AnnotationRecords,
+    iter_geojson,
+    write_arrow,
+    write_parquet,
+)
+
+logger = logging.getLogger("app." + __name__)
+
+# Bump when the content of the exported files changes.
+EXPORT_VERSION = 1
+
+
+def bump_annotation_revision(project_id: int) -> None:
+    """
+    Mark the annotations of the project as changed, such that the next
+    export is computed again. The change is committed with the session.
+    """
+    db.session.execute(
+        db.update(Project)
+        .where(Project.id == project_id)
+        .values(annotation_revision=db.func.coalesce(Project.annotation_revision, 0) + 1)
+    )
+
+
+def get_export_key(project: Project, pro_version: str) -> str:
+    """Hash of the annotation revision, log, calibration and names the export is computed from."""
+    drone = db.get_or_404(Drone, project.drone_id)
+    settings = (
+        EXPORT_VERSION,
+        pro_version,
+        project.name,
+        project.annotation_revision or 0,
+        bool(project.interpolate_pose),
+        log_file_hash(AppConfig.data_dir.joinpath(project.log_file)),
+        sorted((video.id, video.name) for video in project.videos),
+    )
+    digest = hashlib.sha256(repr(settings).encode())
+    for value in drone.calibration[:2]:
+        digest.update(np.ascontiguousarray(value, dtype=np.float64).tobytes())
+    return digest.hexdigest()[:32]
+
+
+def get_export_file(project_id: int, key: str, export_format: str = "csv") -> Path:
+    suffix, _ = EXPORT_FORMATS[export_format]
+    return AppConfig.data_dir / "exports" / f"{project_id}-{key}{suffix}"
+
+
+def write_export_content(file: IO[bytes], records: AnnotationRecords, export_format: str) -> None:
+    """Write the annotation records to the binary file in the export format."""
+    if export_format == "parquet":
+        write_parquet(file, records)
+    elif export_format == "arrow":
+        write_arrow(file, records)
+    elif export_format == "geojson":
+        for chunk in iter_geojson(records):
+            file.write(chunk.encode())
+    else:
+        rows = (
+            [*get_annotation_row(annotation), video.name, project_name, pro_version]
+            for annotation, video, project_name, pro_version in records
+        )
+        for chunk in iter_annotations_csv(rows):
+            file.write(chunk.encode())
+
+
+def write_export(
+    project: Project,
+    pro_version: str,
+    key: str,
+    progress: Callable[[int, int], Any] | None = None,
+    export_format: str = "csv",
+) -> Path:
+    """
+    Write the annotations of the project to the export file of the key and
+    remove older exports of the project in the same format. progress is
+    called with the number of videos done and the total number of videos.
+    """
+    videos = list(project.videos)
+
+    def get_records() -> Iterator[tuple[Annotation, Video, str, str]]:
+        for i, video in enumerate(videos):
+            if progress is not None:
+                progress(i, len(videos))
+            for annotation, _ in iter_annotations(project, video):
+                yield annotation, video, project.name, pro_version
+        if progress is not None:
+            progress(len(videos), len(videos))
+
+    export_file = get_export_file(project.id, key, export_format)
+    export_file.parent.mkdir(exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=export_file.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write_export_content(file, get_records(), export_format)
+        Path(temp_name).replace(export_file)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+    for old_export_file in export_file.parent.glob(f"{project.id}-*{export_file.suffix}"):
+        if old_export_file != export_file:
+            old_export_file.unlink(missing_ok=True)
+    logger.debug(f"Saved export of project {project.id} to {export_file}")
+    return export_file
+
+
+def export_projects(project_ids: list[int], pro_version: str, export_format: str) -> list[tuple[int, str]]:
+    """
+    Export the projects unless their exports are up to date. Returns the
+    project ids with the paths of their export files.
+    """
+    export_files = []
+    for project_id in project_ids:
+        project = db.get_or_404(Project, project_id)
+        key = get_export_key(project, pro_version)
+        export_file = get_export_file(project.id, key, export_format)
+        if not export_file.exists():
+            write_export(project, pro_version, key, export_format=export_format)
+        export_files.append((project.id, str(export_file)))
+    return export_files
+
+
+_worker_app: Any = None
+
+
+def _init_export_worker(testing: bool, database_uri: str, data_dir: str) -> None:
+    """Create the app of a spawned export worker with the database and data directory of the parent app."""
+    global _worker_app
+    from dvm import create_app
+
+    config = TestConfig if testing else AppConfig
+    config.SQLALCHEMY_DATABASE_URI = database_uri
+    config.data_dir = Path(data_dir)
+    _worker_app = create_app(testing=testing)
+
+
+def _export_projects_in_worker(project_ids: list[int], pro_version: str, export_format: str) -> list[tuple[int, str]]:
+    with _worker_app.app_context():
+        return export_projects(project_ids, pro_version, export_format)
+
+
+def iter_bulk_export_files(
+    projects: list[Project], pro_version: str, export_format: str
+) -> Iterator[tuple[Project, Path]]:
+    """
+    Export the projects and yield each project with its export file as soon
+    as it is done. The projects are grouped by drone and the groups are
+    exported in parallel in a process pool, such that each worker reuses the
+    loaded calibration of its drone across the projects.
+    Groups larger than an even share of the projects are split.
+    """
+    projects_by_id = {project.id: project for project in projects if project.log_file}
+    drone_groups: dict[int, list[int]] = {}
+    for project in projects_by_id.values():
+        drone_groups.setdefault(project.drone_id, []).append(project.id)
+    group_size = max(1, math.ceil(len(projects_by_id) / max(1, AppConfig.export_workers)))
+    groups = [
+        project_ids[i : i + group_size]
+        for project_ids in drone_groups.values()
+        for i in range(0, len(project_ids), group_size)
+    ]
+    max_workers = min(AppConfig.export_workers, len(groups))
+    if max_workers <= 1:
+        for project_ids in groups:
+            for project_id, export_file in export_projects(project_ids, pro_version, export_format):
+                yield projects_by_id[project_id], Path(export_file)
+        return
+    logger.debug(f"Exporting {len(projects_by_id)} projects in {len(groups)} groups with {max_workers} processes")
+    app = flask.current_app
+    with ProcessPoolExecutor(
+        max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_export_worker,
+        initargs=(app.testing, app.config["SQLALCHEMY_DATABASE_URI"], str(AppConfig.data_dir)),
+    ) as pool:
+        futures = [
+            pool.submit(_export_projects_in_worker, project_ids, pro_version, export_format) for project_ids in groups
+        ]
+        for future in as_completed(futures):
+            for project_id, export_file in future.result():
+                yield projects_by_id[project_id], Path(export_file)
+
+
+class _ZipOutput(io.RawIOBase):
+    """Unseekable output which collects the bytes written by zipfile until they are taken."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: Any) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip_archive(files: Iterable[tuple[str, Path]], chunk_size: int = 1 << 20) -> Iterator[bytes]:
+    """A zip archive of the files, yielded while it is written."""
+    output = _ZipOutput()
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, file in files:
+            with file.open("rb") as source, archive.open(name, "w", force_zip64=True) as target:
+                while chunk := source.read(chunk_size):
+                    target.write(chunk)
+                    yield output.take()
+            yield output.take()
+    yield output.take()
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import itertools
+import json
+import logging
+import math
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+from typing import IO, Any
+
+import numpy as np
+
+from dvm.db_model import Annotation, Video
+from dvm.drone.fov import Fov
+from dvm.helper_functions import ANNOTATION_EXPORT_COLUMNS
+
+logger = logging.getLogger("app." + __name__)
+
+# File suffix and mimetype of each export format.
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "arrow": (".arrow", "application/vnd.apache.arrow.file"),
+    "geojson": (".geojson", "application/geo+json"),
+}
+# The formats which require the optional pyarrow package.
+ARROW_FORMATS = ("parquet", "arrow")
+# The columns of the columnar exports, the annotation columns followed by
+# the names of the video and project and the program version.
+EXPORT_COLUMNS = (*ANNOTATION_EXPORT_COLUMNS, "video", "project", "pro_version")
+INTEGER_COLUMNS = ("frame", "zone_number")
+STRING_COLUMNS = ("name", "zone_letter", "video", "project", "pro_version")
+BATCH_SIZE = 10_000
+
+AnnotationRecords = Iterable[tuple[Annotation, Video, str, str]]
+
+
+def has_pyarrow() -> bool:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_record(annotation: Annotation, video: Video, project_name: str, pro_version: str) -> dict[str, Any]:
+    """The export values of an annotation, with None for the values which do not apply."""
+    record = {column: getattr(annotation, column) for column in ANNOTATION_EXPORT_COLUMNS}
+    record.update(video=video.name, project=project_name, pro_version=pro_version)
+    return record
+
+
+def get_arrow_schema() -> Any:
+    import pyarrow as pa
+
+    fields = []
+    for column in EXPORT_COLUMNS:
+        if column == "time":
+            data_type = pa.timestamp("us")
+        elif column in INTEGER_COLUMNS:
+            data_type = pa.int32()
+        elif column in STRING_COLUMNS:
+            data_type = pa.string()
+        else:
+            data_type = pa.float64()
+        fields.append(pa.field(column, data_type))
+    return pa.schema(fields)
+
+
+def iter_record_batches(records: AnnotationRecords, schema: Any) -> Iterator[Any]:
+    """The annotations as arrow record batches of at most BATCH_SIZE rows."""
+    import pyarrow as pa
+
+    records = iter(records)
+    while batch := list(itertools.islice(records, BATCH_SIZE)):
+        rows = [get_record(*record) for record in batch]
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+def write_parquet(file: IO[bytes], records: AnnotationRecords) -> None:
+    import pyarrow.parquet as pq
+
+    schema = get_arrow_schema()
+    with pq.ParquetWriter(file, schema, compression="zstd") as writer:
+        for batch in iter_record_batches(records, schema):
+            writer.write_batch(batch)
+
+
+def write_arrow(file: IO[bytes], records: AnnotationRecords) -> None:
+    import pyarrow as pa
+
+    schema = get_arrow_schema()
+    with pa.ipc.new_file(file, schema) as writer:
+        for batch in iter_record_batches(records, schema):
+            writer.write_batch(batch)
+
+
+def get_json_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def get_geometries(annotations: list[Annotation]) -> list[dict[str, Any] | None]:
+    """
+    Point geometries of the points and line geometries of the lines in
+    longitude and latitude, None for annotations without world coordinates.
+    """
+    geometries: list[dict[str, Any] | None] = [
+        None if annotation.lat is None else {"type": "Point", "coordinates": [annotation.lon, annotation.lat]}
+        for annotation in annotations
+    ]
+    line_idx = [
+        i for i, annotation in enumerate(annotations) if annotation.type == "FrameLine" and annotation.lat is not None
+    ]
+    if not line_idx:
+        return geometries
+    lines = [annotations[i] for i in line_idx]
+    lat, lon = Fov.convert_utm_points(
+        np.array([(line.start_east, line.end_east) for line in lines], dtype=np.float64).reshape(-1),
+        np.array([(line.start_north, line.end_north) for line in lines], dtype=np.float64).reshape(-1),
+        np.repeat([line.zone_number for line in lines], 2),
+        np.repeat([line.zone_letter for line in lines], 2),
+    )
+    for j, i in enumerate(line_idx):
+        coordinates = [[lon[2 * j], lat[2 * j]], [lon[2 * j + 1], lat[2 * j + 1]]]
+        geometries[i] = {"type": "LineString", "coordinates": coordinates}
+    return geometries
+
+
+def iter_geojson(records: AnnotationRecords) -> Iterator[str]:
+    """
+    The annotations as a GeoJSON feature collection with a point for each
+    point and a line for each line, yielded in chunks of BATCH_SIZE features.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ""
+    records = iter(records)
+    while batch := list(itertools.islice(records, BATCH_SIZE)):
+        geometries = get_geometries([annotation for annotation, *_ in batch])
+        features = []
+        for record, geometry in zip(batch, geometries, strict=True):
+            properties = {key: get_json_value(value) for key, value in get_record(*record).items()}
+            feature = {"type": "Feature", "geometry": geometry, "properties": properties}
+            features.append(json.dumps(feature, allow_nan=False))
+        yield separator + ",".join(features)
+        separator = ","
+    yield "]}"
@@ -3,18 +3,37 @@ from __future__ import annotations
 import csv
 import logging
 import random
+import time
 from pathlib import Path
 
 import flask
+from celery import Task as CeleryTask
+from celery import shared_task
+from werkzeug.utils import secure_filename
 from werkzeug.wrappers.response import Response
 
 import dvm
 from dvm.app_config import AppConfig, get_random_filename
-from dvm.db_model import Drone, Project, db
+from dvm.db_model import Drone, Project, Task, db
 from dvm.drone import plot_log_data
-from dvm.drone.drone_log_data import drone_log
+from dvm.drone.drone_log_data import DroneLog, get_video_range_indices, to_datetime
+from dvm.drone.log_cache import remove_log_cache
 from dvm.forms import EditProjectForm, NewProjectForm
-from dvm.helper_functions import get_all_annotations, save_annotations_csv
+from dvm.helper_functions import (
+    get_all_annotations,
+    get_annotations_csv_response,
+    get_streamed_attachment,
+    iter_annotations,
+)
+from dvm.projects.export import (
+    get_export_file,
+    get_export_key,
+    iter_bulk_export_files,
+    iter_zip_archive,
+    write_export,
+)
+from dvm.projects.export_formats import ARROW_FORMATS, EXPORT_FORMATS, has_pyarrow, iter_geojson
+from dvm.video.pose_track import remove_pose_tracks
 
 logger = logging.getLogger("app." + __name__)
 projects_view = flask.Blueprint("projects", __name__)
@@ -36,6 +55,7 @@ def projects() -> str | Response:
         "random_int": random_int,
         "new_project_form": new_project_form,
         "edit_project_form": edit_project_form,
+        "export_parquet": has_pyarrow(),
     }
     logger.debug("Render index")
     return flask.render_template("projects/projects.html", **arguments)
@@ -75,8 +95,8 @@ def get_new_project_form() -> tuple[Response | None, NewProjectForm]:
         else:
             logger.debug(f"Creating project with name {project_title}")
             log_file = None
+            log_error = None
             if form.fixed_cam_checkbox.data:
-                log_error = None
                 drone_height = form.fixed_cam_drone_height.data
                 drone_lat = form.fixed_cam_drone_lat.data
                 drone_lon = form.fixed_cam_drone_lon.data
@@ -86,21 +106,10 @@ def get_new_project_form() -> tuple[Response | None, NewProjectForm]:
                 log_filename = get_random_filename("fake_drone_log.csv")
                 log_file = AppConfig.data_dir.joinpath(log_filename)
                 create_fake_drone_log(log_file, drone_height, drone_lat, drone_lon, drone_yaw, drone_pitch, drone_roll)
-                success = drone_log.test_log(log_file)
-                if not success:
-                    remove_file(log_file)
-                    log_filename = None  # type: ignore[assignment]
-                    log_error = "Error creating the artificial drone log file. Please try again."
             elif form.log_file.data:
-                log_error = None
                 log_filename = get_random_filename(form.log_file.data.filename)
                 log_file = AppConfig.data_dir.joinpath(log_filename)
                 form.log_file.data.save(log_file)
-                success = drone_log.test_log(log_file)
-                if not success:
-                    remove_file(log_file)
-                    log_filename = None
-                    log_error = "Error interpreting the drone log file. Try and upload the log file again."
             else:
                 log_error = "No drone log file added. Please add a log file or use a fixed camera."
             project = Project(
@@ -109,9 +118,12 @@ def get_new_project_form() -> tuple[Response | None, NewProjectForm]:
                 drone_id=drone_id,
                 log_file=str(log_file),
                 log_error=log_error,
+                interpolate_pose=form.interpolate_pose.data,
             )
             db.session.add(project)
             db.session.commit()
+            if log_file is not None:
+                start_log_ingestion(project)
             return flask.redirect(flask.url_for("projects.projects", project_id=project.id)), form
     return None, form
 
@@ -135,9 +147,10 @@ def get_edit_project_form() -> EditProjectForm:
             project.name = project_title
             project.description = description
             project.drone_id = drone_id
+            project.interpolate_pose = form.edit_interpolate_pose.data
+            new_log_file = None
             if form.edit_fixed_cam_checkbox.data:
-                remove_file(project.log_file)
-                log_error = None
+                remove_log_file(project.log_file)
                 drone_height = form.edit_fixed_cam_drone_height.data
                 drone_lat = form.edit_fixed_cam_drone_lat.data
                 drone_lon = form.edit_fixed_cam_drone_lon.data
@@ -145,37 +158,94 @@ def get_edit_project_form() -> EditProjectForm:
                 drone_pitch = form.edit_fixed_cam_drone_pitch.data
                 drone_roll = form.edit_fixed_cam_drone_roll.data
                 log_filename = get_random_filename("fake_drone_log.csv")
-                log_file = AppConfig.data_dir.joinpath(log_filename)
-                create_fake_drone_log(log_file, drone_height, drone_lat, drone_lon, drone_yaw, drone_pitch, drone_roll)
-                success = drone_log.test_log(log_file)
-                if success:
-                    project.log_file = str(log_file)
-                if not success:
-                    remove_file(log_file)
-                    project.log_file = None
-                    log_error = "Error creating the artificial drone log file. Please try again."
-                project.log_error = log_error
+                new_log_file = AppConfig.data_dir.joinpath(log_filename)
+                create_fake_drone_log(
+                    new_log_file, drone_height, drone_lat, drone_lon, drone_yaw, drone_pitch, drone_roll
+                )
             elif form.edit_log_file.data:
-                remove_file(project.log_file)
-                log_error = None
+                remove_log_file(project.log_file)
                 log_filename = get_random_filename(form.edit_log_file.data.filename)
-                log_file = AppConfig.data_dir.joinpath(log_filename)
-                form.edit_log_file.data.save(log_file)
-                success = drone_log.test_log(log_file)
-                if success:
-                    project.log_file = str(log_file)
-                else:
-                    remove_file(log_file)
-                    project.log_file = None
-                    log_error = "Error interpreting the drone log file. Try and upload the log file again."
-                project.log_error = log_error
+                new_log_file = AppConfig.data_dir.joinpath(log_filename)
+                form.edit_log_file.data.save(new_log_file)
+            if new_log_file is not None:
+                project.log_file = str(new_log_file)
+                project.log_error = None
             db.session.commit()
+            if new_log_file is not None:
+                start_log_ingestion(project)
     return form
 
 
+def start_log_ingestion(project: Project) -> None:
+    if project.task:
+        ingest_log_task.AsyncResult(project.task.task_id).revoke(terminate=True)
+        db.session.delete(project.task)
+    task = ingest_log_task.apply_async(args=(project.id,))
+    task_db = Task(task_id=task.id, function="ingest_log_task", project_id=project.id)
+    db.session.add(task_db)
+    db.session.commit()
+
+
+def ingest_log(project: Project) -> None:
+    """
+    Validate and parse the drone log of the project. The parsed log is
+    stored in the log cache and statistics about the log are saved on
+    the project.
+    """
+    log_file = Path(project.log_file)
+    start_time = time.perf_counter()
+    if not DroneLog.test_log(log_file):
+        raise ValueError(f"The drone log {log_file} is not in a supported format")
+    drone_log = DroneLog()
+    drone_log.get_log_data(log_file)
+    project.log_rows = len(drone_log.time_stamp)
+    project.log_start = drone_log.get_log_start_time()
+    project.log_end = to_datetime(drone_log.time_stamp.max())
+    project.log_videos = len(get_video_range_indices(drone_log.is_video))
+    project.log_parse_duration = time.perf_counter() - start_time
+    logger.debug(f"Parsed {project.log_rows} rows from {log_file} in {project.log_parse_duration:.2f} seconds")
+
+
+@shared_task(bind=True)  # type: ignore[misc]
+def ingest_log_task(self: CeleryTask, project_id: int) -> None:
+    self.update_state(state="PROCESSING")
+    project = db.get_or_404(Project, project_id)
+    try:
+        ingest_log(project)
+    except Exception as exc:
+        remove_log_file(project.log_file)
+        project.log_file = None
+        project.log_error = "Error interpreting the drone log file. Try and upload the log file again."
+        db.session.commit()
+        raise Exception(project.log_error) from exc
+    db.session.commit()
+
+
+@projects_view.route("/projects/status/<task_id>")  # type: ignore[misc]
+def task_status(task_id: int) -> Response:
+    task_db = db.get_or_404(Task, task_id)
+    task = eval(task_db.function + '.AsyncResult("' + task_db.task_id + '")')
+    if task.state == "PENDING":
+        response = {"state": task.state, "status": "Pending"}
+    elif task.state == "SUCCESS":
+        response = {"state": task.state, "status": "Done"}
+        db.session.delete(task_db)
+        db.session.commit()
+    elif task.state != "FAILURE":
+        response = {"state": task.state, "status": "Processing"}
+    else:
+        response = {"state": task.state, "status": str(task.info)}
+        project = db.get_or_404(Project, task_db.project_id)
+        project.log_error = str(task.info)
+        db.session.delete(task_db)
+        db.session.commit()
+    return flask.jsonify(response)
+
+
 @projects_view.route("/projects/<project_id>/plot")  # type: ignore[misc]
 def plot_log(project_id: int) -> Response:
     project = db.get_or_404(Project, project_id)
+    drone_log = DroneLog()
     drone_log.get_log_data(Path(project.log_file))
     plot_script, plot_div = plot_log_data.get_log_plot(drone_log.log_data())
     logger.debug(f"Render video plot for {project_id}")
@@ -184,28 +254,155 @@ def plot_log(project_id: int) -> Response:
         plot_div=plot_div,
         plot_script=plot_script,
         project_id=project_id,
-        drone_path=drone_log.pos,
+        drone_path=plot_log_data.get_drone_path(drone_log.pos),
     )
 
 
+def get_export_format() -> str:
+    """The export format requested with the format argument, csv by default."""
+    export_format = flask.request.args.get("format", "csv")
+    if export_format not in EXPORT_FORMATS:
+        flask.abort(404)
+    if export_format in ARROW_FORMATS and not has_pyarrow():
+        logger.debug(f"pyarrow is required for exporting to {export_format}")
+        flask.abort(501)
+    return export_format
+
+
 @projects_view.route("/projects/<project_id>/download")  # type: ignore[misc]
-def download(project_id: int) -> Response:
+def download(project_id: int) -> tuple[Response, int] | Response:
+    """
+    Send the exported annotations of the project if they are up to date,
+    otherwise stream them while they are computed. Parquet and arrow can
+    not be streamed, so their export is started in the background and the
+    status url is returned instead. The format argument selects csv
+    (default), parquet, arrow or geojson.
+    """
     project = db.get_or_404(Project, project_id)
+    export_format = get_export_format()
+    suffix, mimetype = EXPORT_FORMATS[export_format]
+    download_name = f"annotations{suffix}"
+    if project.log_file:
+        key = get_export_key(project, dvm.__version__)
+        export_file = get_export_file(project.id, key, export_format)
+        if export_file.exists():
+            logger.debug(f"Sending {export_file} to user.")
+            return flask.send_file(export_file, mimetype=mimetype, as_attachment=True, download_name=download_name)
+        if export_format in ARROW_FORMATS:
+            return start_export(project, export_format)
+    elif export_format in ARROW_FORMATS:
+        flask.abort(404)
+    logger.debug(f"Streaming {download_name} to user.")
+    if export_format == "geojson":
+        records = (
+            (annotation, video, project.name, dvm.__version__) for annotation, video in iter_annotations(project)
+        )
+        return get_streamed_attachment(iter_geojson(records), download_name, mimetype)
     annotations = get_all_annotations(project, dvm.__version__)
-    filename = AppConfig.data_dir / "annotations.csv"
-    save_annotations_csv(annotations, filename)
-    logger.debug("Sending annotations.csv to user.")
-    return flask.send_file(filename, as_attachment=True)
+    return get_annotations_csv_response(annotations, download_name)
+
+
+@projects_view.route("/projects/download")  # type: ignore[misc]
+def download_projects() -> Response:
+    """
+    Export several projects as one zip archive with a file per project. The
+    projects are selected with project_id arguments, or by the drones given
+    with drone_id arguments, or else all projects are exported. The format
+    argument selects the format of the files.
+    """
+    export_format = get_export_format()
+    suffix, _ = EXPORT_FORMATS[export_format]
+    query = db.select(Project).where(Project.log_file.is_not(None)).order_by(Project.id)
+    project_ids = flask.request.args.getlist("project_id", type=int)
+    if project_ids:
+        query = query.where(Project.id.in_(project_ids))
+    drone_ids = flask.request.args.getlist("drone_id", type=int)
+    if drone_ids:
+        query = query.where(Project.drone_id.in_(drone_ids))
+    projects = list(db.session.scalars(query))
+    if not projects:
+        flask.abort(404)
+    logger.debug(f"Streaming export of {len(projects)} projects to user.")
+    files = (
+        (f"{project.id}-{secure_filename(project.name) or 'project'}{suffix}", export_file)
+        for project, export_file in iter_bulk_export_files(projects, dvm.__version__, export_format)
+    )
+    return get_streamed_attachment(iter_zip_archive(files), "annotations.zip", "application/zip")
+
+
+@shared_task(bind=True)  # type: ignore[misc]
+def export_project_task(self: CeleryTask, project_id: int, pro_version: str, export_format: str = "csv") -> str:
+    project = db.get_or_404(Project, project_id)
+    key = get_export_key(project, pro_version)
+
+    def progress(current: int, total: int) -> None:
+        self.update_state(state="PROCESSING", meta={"current": current, "total": total})
+
+    write_export(project, pro_version, key, progress, export_format)
+    return export_format
+
+
+@projects_view.route("/projects/<project_id>/export", methods=["POST"])  # type: ignore[misc]
+def export(project_id: int) -> tuple[Response, int] | Response:
+    """
+    Start exporting the annotations of the project in the background, unless
+    the export is already up to date.
+    """
+    project = db.get_or_404(Project, project_id)
+    if not project.log_file:
+        flask.abort(404)
+    export_format = get_export_format()
+    download_url = flask.url_for("projects.download", project_id=project.id, format=export_format)
+    if get_export_file(project.id, get_export_key(project, dvm.__version__), export_format).exists():
+        return flask.jsonify({"state": "SUCCESS", "status": "Done", "url": download_url})
+    return start_export(project, export_format)
+
+
+def start_export(project: Project, export_format: str) -> tuple[Response, int]:
+    """Start the export task of the project and respond with 202 and the url of its status."""
+    task = export_project_task.apply_async(args=(project.id, dvm.__version__, export_format))
+    status_url = flask.url_for("projects.export_status", project_id=project.id, task_id=task.id)
+    return flask.jsonify({"state": "PENDING", "status": "Pending", "status_url": status_url}), 202
+
+
+@projects_view.route("/projects/<project_id>/export/<task_id>")  # type: ignore[misc]
+def export_status(project_id: int, task_id: str) -> Response:
+    task = export_project_task.AsyncResult(task_id)
+    if task.state == "PENDING":
+        response = {"state": task.state, "status": "Pending"}
+    elif task.state == "SUCCESS":
+        response = {
+            "state": task.state,
+            "status": "Done",
+            "url": flask.url_for("projects.download", project_id=project_id, format=task.info),
+        }
+    elif task.state != "FAILURE":
+        info = task.info if isinstance(task.info, dict) else {}
+        response = {
+            "state": task.state,
+            "status": "Processing",
+            "current": info.get("current", 0),
+            "total": info.get("total", 0),
+        }
+    else:
+        response = {"state": task.state, "status": str(task.info)}
+    return flask.jsonify(response)
 
 
 @projects_view.route("/projects/<project_id>/remove")  # type: ignore[misc]
 def remove_project(project_id: int) -> Response:
     logger.debug(f"Removing project {project_id}")
     project = db.get_or_404(Project, project_id)
-    remove_file(project.log_file)
+    if project.task:
+        ingest_log_task.AsyncResult(project.task.task_id).revoke(terminate=True)
+        db.session.delete(project.task)
+    remove_log_file(project.log_file)
+    for export_file in AppConfig.data_dir.joinpath("exports").glob(f"{project.id}-*"):
+        remove_file(export_file)
     for video in project.videos:
         remove_file(video.file)
         remove_file(video.image)
+        remove_pose_tracks(video.id)
         db.session.delete(video)
     db.session.delete(project)
     db.session.commit()
@@ -214,3 +411,10 @@ def remove_project(project_id: int) -> Response:
 
 def remove_file(file: Path) -> None:
     Path.unlink(file, missing_ok=True)
+
+
+def remove_log_file(log_file: str | None) -> None:
+    """Remove the drone log together with its parsed columns in the log cache."""
+    if log_file:
+        remove_log_cache(Path(log_file))
+        remove_file(Path(log_file))
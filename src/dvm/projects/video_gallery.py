@@ -16,7 +16,9 @@ from werkzeug.wrappers.response import Response
 import dvm
 from dvm.app_config import AppConfig, get_random_filename
 from dvm.db_model import Project, Task, Video, db
-from dvm.helper_functions import get_all_annotations, save_annotations_csv
+from dvm.helper_functions import get_all_annotations, get_annotations_csv_response
+from dvm.video.pose_track import remove_pose_tracks
+from dvm.video.video_context import video_contexts
 
 logger = logging.getLogger("app." + __name__)
 video_gallery_view = flask.Blueprint("video_gallery", __name__)
@@ -248,11 +250,9 @@ def download(video_id: int) -> Response:
     video = db.get_or_404(Video, video_id)
     project = db.get_or_404(Project, video.project_id)
     annotations = get_all_annotations(project, dvm.__version__, video)
-    filename = AppConfig.data_dir / "annotations.csv"
-    save_annotations_csv(annotations, filename)
-    logger.debug("Sending annotations.csv to user.")
+    logger.debug("Streaming annotations.csv to user.")
     annotated_filename = f"annotations - {project.name} - {video.name}.csv"
-    return flask.send_file(filename, as_attachment=True, download_name=annotated_filename)
+    return get_annotations_csv_response(annotations, annotated_filename)
 
 
 @video_gallery_view.route("/videos/<video_id>/remove")  # type: ignore[misc]
@@ -262,6 +262,8 @@ def remove_video(video_id: int) -> Response:
     project_id = video.project_id
     remove_file(video.file)
     remove_file(video.image)
+    remove_pose_tracks(video.id)
     db.session.delete(video)
     db.session.commit()
+    video_contexts.remove(video_id)
     return flask.redirect(flask.url_for("video_gallery.video_gallery", project_id=project_id))
@@ -1,11 +1,98 @@
 var current_frame = 0;
-var horizon_fabricjs_ns = null;
-var horizon_fabricjs_ew = null;
-var horizon_fabricjs_nwse = null;
-var horizon_fabricjs_nesw = null;
-var horizon_fabricjs_pitch0 = null;
-var horizon_fabricjs_pitch22 = null;
-var horizon_fabricjs_pitch45 = null;
+// Horizons by horizon_cache_key, filled by draw_horizon and prefetch_horizon.
+var horizon_cache = {};
+var horizon_cache_size = 3000;
+var horizon_prefetch_size = 150;
+var horizon_prefetch_start = 0;
+var horizon_prefetch_stop = 0;
+var horizon_prefetch_pending = false;
+// Incremented when the cached horizons become stale, responses to requests
+// from before are discarded.
+var horizon_cache_generation = 0;
+// Pose of every frame of the video, see dvm.video.pose_track.
+var pose_track = null;
+var pose_track_columns = ['time', 'height', 'yaw', 'pitch', 'roll', 'lat', 'lon', 'east', 'north'];
+
+function clear_horizon_cache() {
+  // Call whenever the start time, takeoff altitude or calibration is saved.
+  horizon_cache = {};
+  horizon_cache_generation += 1;
+  horizon_prefetch_start = 0;
+  horizon_prefetch_stop = 0;
+}
+
+function horizon_cache_key(frame) {
+  // The horizon only depends on the rotation, so once the pose track is
+  // loaded frames with the same rotation share a cached horizon.
+  var pose = get_pose(frame);
+  if (pose) {
+    return pose.yaw + ',' + pose.pitch + ',' + pose.roll;
+  };
+  return 'frame ' + frame;
+}
+
+function cache_horizon(frame, data) {
+  if (Object.keys(horizon_cache).length >= horizon_cache_size) {
+    horizon_cache = {};
+  };
+  horizon_cache[horizon_cache_key(frame)] = data;
+}
+
+function load_pose_track(url) {
+  var request = new XMLHttpRequest();
+  request.open('GET', url);
+  request.responseType = 'arraybuffer';
+  request.onload = function() {
+    if (request.status == 200) {
+      pose_track = new DataView(request.response);
+      // The cached horizons are keyed by frame until the pose track is loaded.
+      clear_horizon_cache();
+    };
+  };
+  request.send();
+}
+
+function get_pose(frame) {
+  var row_size = pose_track_columns.length * 8;
+  if (!pose_track || frame < 0 || (frame + 1) * row_size > pose_track.byteLength) {
+    return null;
+  };
+  var pose = {};
+  for (let i = 0; i < pose_track_columns.length; i++) {
+    pose[pose_track_columns[i]] = pose_track.getFloat64(frame * row_size + i * 8, true);
+  };
+  return pose;
+}
+
+// Annotation objects as last sent to the server by id, used to only send
+// the added, changed and removed objects.
+var sent_objects = {};
+var annotation_session = Math.random().toString(36).slice(2);
+var object_counter = 0;
+// Annotation objects as last saved on the server by id.
+var saved_objects = {};
+
+function get_changes(previous, objects, order) {
+  var changes = {added: [], changed: [], removed: [], order: order};
+  for (let id in objects) {
+    if (!(id in previous)) {
+      changes.added.push(JSON.parse(objects[id]));
+    } else if (previous[id] != objects[id]) {
+      changes.changed.push(JSON.parse(objects[id]));
+    }
+  };
+  for (let id in previous) {
+    if (!(id in objects)) {
+      changes.removed.push(id);
+    }
+  };
+  return changes;
+}
+
+function new_object_id() {
+  object_counter += 1;
+  return annotation_session + '-' + Date.now().toString(36) + '-' + object_counter;
+}
 
 // make points only on some frames
 fabric.FramePoint = fabric.util.createClass(fabric.Circle, {
@@ -14,12 +101,14 @@ fabric.FramePoint = fabric.util.createClass(fabric.Circle, {
     this.callSuper('initialize', options);
     this.set('frame', options.frame);
     this.set('name', options.name);
+    this.set('id', options.id || new_object_id());
     this.objectCaching = false;
   },
   toObject: function() {
     return fabric.util.object.extend(this.callSuper('toObject'), {
       frame: this.get('frame'),
       name: this.get('name'),
+      id: this.get('id'),
     });
   },
   _render: function(ctx) {
@@ -48,12 +137,14 @@ fabric.FrameLine = fabric.util.createClass(fabric.Line, {
     this.callSuper('initialize', points, options);
     this.set('frame', options.frame);
     this.set('name', options.name);
+    this.set('id', options.id || new_object_id());
     this.objectCaching = false;
   },
   toObject: function() {
     return fabric.util.object.extend(this.callSuper('toObject'), {
       frame: this.get('frame'),
       name: this.get('name'),
+      id: this.get('id'),
     });
   },
   _render: function(ctx) {
@@ -285,131 +376,78 @@ class video_annotator {
       this.overlay.fabricCanvas().remove(poly_lines[i]);
     };
     if (this.show_horizon) {
-      $.post($SCRIPT_ROOT + '/get_horizon_fabricjs', {
-        frame: current_frame,
-      }, function(data) {
-        if (data.NS) {
-          horizon_fabricjs_ns = new fabric.Polyline(data.NS, {
-            stroke: 'red',
-            fill: 'rgba(0,0,0,0)',
-            strokeWidth: 3,
-            left: data.NS_pos[0].left,
-            top: data.NS_pos[0].top,
-            selectable: false,
-            evented: false,
-            excludeFromExport: true,
-          });
-        } else {
-          horizon_fabricjs_ns = null;
-        };
-        if (data.EW) {
-          horizon_fabricjs_ew = new fabric.Polyline(data.EW, {
-            stroke: 'blue',
-            fill: 'rgba(0,0,0,0)',
-            strokeWidth: 3,
-            left: data.EW_pos[0].left,
-            top: data.EW_pos[0].top,
-            selectable: false,
-            evented: false,
-            excludeFromExport: true,
-          });
-        } else {
-          horizon_fabricjs_ew = null;
-        };
-        if (data.NESW) {
-          horizon_fabricjs_nesw = new fabric.Polyline(data.NESW, {
-            stroke: 'magenta',
-            fill: 'rgba(0,0,0,0)',
-            strokeWidth: 3,
-            left: data.NESW_pos[0].left,
-            top: data.NESW_pos[0].top,
-            selectable: false,
-            evented: false,
-            excludeFromExport: true,
-          });
-        } else {
-          horizon_fabricjs_nesw = null;
-        };
-        if (data.NWSE) {
-          horizon_fabricjs_nwse = new fabric.Polyline(data.NWSE, {
-            stroke: 'cyan',
-            fill: 'rgba(0,0,0,0)',
-            strokeWidth: 3,
-            left: data.NWSE_pos[0].left,
-            top: data.NWSE_pos[0].top,
-            selectable: false,
-            evented: false,
-            excludeFromExport: true,
-          });
-        } else {
-          horizon_fabricjs_nwse = null;
-        };
-        if (data.pitch0) {
-          horizon_fabricjs_pitch0 = new fabric.Polyline(data.pitch0, {
-            stroke: 'green',
-            fill: 'rgba(0,0,0,0)',
-            strokeWidth: 3,
-            left: data.pitch0_pos[0].left,
-            top: data.pitch0_pos[0].top,
-            selectable: false,
-            evented: false,
-            excludeFromExport: true,
-          });
-        } else {
-          horizon_fabricjs_pitch0 = null;
-        };
-        if (data.pitch22) {
-          horizon_fabricjs_pitch22 = new fabric.Polyline(data.pitch22, {
-            stroke: 'green',
-            fill: 'rgba(0,0,0,0)',
-            strokeWidth: 3,
-            left: data.pitch22_pos[0].left,
-            top: data.pitch22_pos[0].top,
-            selectable: false,
-            evented: false,
-            excludeFromExport: true,
-          });
-        } else {
-          horizon_fabricjs_pitch22 = null;
-        };
-        if (data.pitch45) {
-          horizon_fabricjs_pitch45 = new fabric.Polyline(data.pitch45, {
-            stroke: 'green',
-            fill: 'rgba(0,0,0,0)',
-            strokeWidth: 3,
-            left: data.pitch45_pos[0].left,
-            top: data.pitch45_pos[0].top,
-            selectable: false,
-            evented: false,
-            excludeFromExport: true,
-          });
-        } else {
-          horizon_fabricjs_pitch45 = null;
-        };
-      }, 'json')
-      if (horizon_fabricjs_ns) {
-        this.overlay.fabricCanvas().add(horizon_fabricjs_ns);
-      };
-      if (horizon_fabricjs_ew) {
-        this.overlay.fabricCanvas().add(horizon_fabricjs_ew);
-      };
-      if (horizon_fabricjs_nesw) {
-        this.overlay.fabricCanvas().add(horizon_fabricjs_nesw);
+      var frame = current_frame;
+      var key = horizon_cache_key(frame);
+      if (key in horizon_cache) {
+        this.add_horizon(horizon_cache[key]);
+      } else {
+        var annotator = this;
+        var generation = horizon_cache_generation;
+        $.post($SCRIPT_ROOT + '/get_horizon_fabricjs', {
+          video_id: $VIDEO_ID,
+          frame: frame,
+        }, function(data) {
+          if (generation != horizon_cache_generation) {
+            return;
+          };
+          cache_horizon(frame, data);
+          if (frame == current_frame) {
+            annotator.draw_horizon();
+          };
+        }, 'json');
       };
-      if (horizon_fabricjs_nwse) {
-        this.overlay.fabricCanvas().add(horizon_fabricjs_nwse);
+      this.prefetch_horizon(frame);
+    };
+    this.overlay.fabricCanvas().renderAll();
+  }
+
+  add_horizon(data) {
+    var lines = [['NS', 'red'], ['EW', 'blue'], ['NESW', 'magenta'], ['NWSE', 'cyan'], ['pitch0', 'green'], ['pitch22', 'green'], ['pitch45', 'green']];
+    for (let i in lines) {
+      var direction = lines[i][0];
+      if (data[direction]) {
+        this.overlay.fabricCanvas().add(new fabric.Polyline(data[direction], {
+          stroke: lines[i][1],
+          fill: 'rgba(0,0,0,0)',
+          strokeWidth: 3,
+          left: data[direction + '_pos'][0].left,
+          top: data[direction + '_pos'][0].top,
+          selectable: false,
+          evented: false,
+          excludeFromExport: true,
+        }));
       };
-      if (horizon_fabricjs_pitch0) {
-        this.overlay.fabricCanvas().add(horizon_fabricjs_pitch0);
+    };
+  }
+
+  prefetch_horizon(frame) {
+    // Fetch the horizons of the following frames in one request, when
+    // playback or scrubbing gets close to the end of the fetched frames.
+    if (horizon_prefetch_pending || (frame >= horizon_prefetch_start && frame + horizon_prefetch_size / 2 < horizon_prefetch_stop)) {
+      return;
+    };
+    horizon_prefetch_pending = true;
+    var start = (frame >= horizon_prefetch_start && frame < horizon_prefetch_stop) ? horizon_prefetch_stop : frame;
+    var stop = start + horizon_prefetch_size;
+    var generation = horizon_cache_generation;
+    $.post($SCRIPT_ROOT + '/get_horizon_range', {
+      video_id: $VIDEO_ID,
+      start: start,
+      stop: stop,
+    }, function(data) {
+      if (generation != horizon_cache_generation) {
+        return;
       };
-      if (horizon_fabricjs_pitch22) {
-        this.overlay.fabricCanvas().add(horizon_fabricjs_pitch22);
+      for (let frame_id in data.frames) {
+        cache_horizon(parseInt(frame_id), data.horizons[data.frames[frame_id]]);
       };
-      if (horizon_fabricjs_pitch45) {
-        this.overlay.fabricCanvas().add(horizon_fabricjs_pitch45);
+      if (start != horizon_prefetch_stop) {
+        horizon_prefetch_start = start;
       };
-    };
-    this.overlay.fabricCanvas().renderAll();
+      horizon_prefetch_stop = stop;
+    }, 'json').always(function() {
+      horizon_prefetch_pending = false;
+    });
   }
 
   toggle_draw() {
@@ -422,9 +460,16 @@ class video_annotator {
   }
 
   save(save_url) {
-    var json = JSON.stringify(this.overlay.fabricCanvas());
-    $.post(save_url, {
-      fabric_json: json,
+    // Only the changed annotations are sent. The server removes the
+    // annotations missing from the order, so if a save fails the next one
+    // sends all annotations again.
+    var [objects, order] = this.get_annotation_objects();
+    var changes = get_changes(saved_objects, objects, order);
+    saved_objects = objects;
+    return $.post(save_url, {
+      changes: JSON.stringify(changes),
+      }).fail(function() {
+        saved_objects = {};
       });
   }
 
@@ -432,6 +477,7 @@ class video_annotator {
     this.overlay.fabricCanvas().loadFromJSON(json_data);
     this.overlay.fabricCanvas().add(this.fabric_video);
     this.overlay.fabricCanvas().sendToBack(this.fabric_video);
+    saved_objects = this.get_annotation_objects()[0];
     this.updateModifications(true, false);
   }
 
@@ -462,8 +508,35 @@ class video_annotator {
       this.states.push(myjson);
     }
     if (save_update_on_server == true) {
-      markings_modified(myjson);
+      this.send_modifications(!add_state_to_undo_stack);
+    }
+  }
+
+  get_annotation_objects() {
+    // The serialized annotations by id and their order on the canvas.
+    var objects = {};
+    var order = [];
+    this.overlay.fabricCanvas().getObjects().forEach(function(obj) {
+      if (obj.type == 'FrameLine' || obj.type == 'FramePoint') {
+        objects[obj.id] = JSON.stringify(obj);
+        order.push(obj.id);
+      }
+    });
+    return [objects, order];
+  }
+
+  send_modifications(full = false) {
+    // Send the annotations which changed since the last call, or all of
+    // them if full is true or the server asks for it.
+    var [objects, order] = this.get_annotation_objects();
+    if (full) {
+      sent_objects = objects;
+      markings_modified(JSON.stringify(this.overlay.fabricCanvas()), null);
+      return;
     }
+    var changes = get_changes(sent_objects, objects, order);
+    sent_objects = objects;
+    markings_modified(null, JSON.stringify(changes));
   }
 
   on_undo() {
@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+from typing import Any
+
+import numpy as np
+
+from dvm.db_model import Annotation, Video
+from dvm.drone.drone_log_data import to_datetime
+from dvm.video.annotations import get_line_image_points
+from dvm.video.pose_track import get_pose_track_key
+from dvm.video.video_context import VideoContext
+
+logger = logging.getLogger("app." + __name__)
+
+ANNOTATION_TYPES = ("FrameLine", "FramePoint")
+
+
+def get_annotation_key(context: VideoContext) -> str:
+    """Hash of the log, video settings and calibration the world coordinates are computed from."""
+    pose_track_key = get_pose_track_key(context.drone_log, context.log_file)
+    return hashlib.sha256(f"{pose_track_key}:{context.fov.calibration_key}".encode()).hexdigest()[:32]
+
+
+def set_fabric_object(annotation: Annotation, obj: dict[str, Any]) -> None:
+    """Set the fabric object of the annotation and the columns taken directly from it."""
+    annotation.type = obj["type"]
+    annotation.name = obj.get("name")
+    annotation.frame = int(obj["frame"])
+    annotation.fabric_object = json.dumps(obj)
+    if obj["type"] == "FrameLine":
+        (x1, y1), (x2, y2) = get_line_image_points(obj)
+        # The center of the line is used as the position of a line.
+        annotation.image_x = (x1 + x2) / 2
+        annotation.image_y = (y1 + y2) / 2
+        annotation.image_x1, annotation.image_y1, annotation.image_x2, annotation.image_y2 = x1, y1, x2, y2
+    else:
+        annotation.image_x = obj["left"]
+        annotation.image_y = obj["top"]
+        annotation.image_x1 = annotation.image_y1 = annotation.image_x2 = annotation.image_y2 = None
+
+
+def compute_world_values(annotations: list[Annotation], context: VideoContext) -> None:
+    """
+    Set the pose and world coordinate columns of the annotations. The world
+    points of all annotations are computed in one batch, with the poses read
+    from the pose track of the video when it is stored.
+    """
+    lines = [annotation for annotation in annotations if annotation.type == "FrameLine"]
+    points = [annotation for annotation in annotations if annotation.type == "FramePoint"]
+    if not lines and not points:
+        return
+    n_lines = len(lines)
+    frames = np.array([annotation.frame for annotation in lines + points])
+    time_stamp, height, rotation, pos = context.get_log_data_from_frames(frames)
+    fov = context.fov
+    line_points = np.array(
+        [(line.image_x1, line.image_y1, line.image_x2, line.image_y2) for line in lines], dtype=np.float64
+    ).reshape(-1, 2, 2)
+    point_points = np.array([(point.image_x, point.image_y) for point in points], dtype=np.float64).reshape(-1, 2)
+    pose_idx = np.concatenate((np.arange(n_lines), np.arange(n_lines), np.arange(n_lines, n_lines + len(points))))
+    world_points, zone_numbers, zone_letters = fov.get_world_points(
+        np.concatenate((line_points[:, 0], line_points[:, 1], point_points)),
+        height[pose_idx],
+        rotation[pose_idx],
+        pos[pose_idx],
+        return_zone=True,
+    )
+    wp1 = world_points[:n_lines]
+    wp2 = world_points[n_lines : 2 * n_lines]
+    wp = np.concatenate(((wp1 + wp2) / 2, world_points[2 * n_lines :]))
+    zone_idx = np.concatenate((np.arange(n_lines), np.arange(2 * n_lines, len(world_points))))
+    zone_numbers = zone_numbers[zone_idx]
+    zone_letters = zone_letters[zone_idx]
+    lengths = np.linalg.norm(wp1 - wp2, axis=1)
+    headings = np.degrees(np.arctan2(wp2[:, 0] - wp1[:, 0], wp2[:, 1] - wp1[:, 1]))
+    lat, lon = fov.convert_utm_points(wp[:, 0], wp[:, 1], zone_numbers, zone_letters)
+    yaw = np.degrees(rotation["yaw"])
+    pitch = np.degrees(rotation["pitch"])
+    roll = np.degrees(rotation["roll"])
+    for i, annotation in enumerate(lines + points):
+        is_line = i < n_lines
+        annotation.time = to_datetime(time_stamp[i])
+        annotation.height = float(height[i])
+        annotation.yaw = float(yaw[i])
+        annotation.pitch = float(pitch[i])
+        annotation.roll = float(roll[i])
+        annotation.length = float(lengths[i]) if is_line else None
+        annotation.lat = float(lat[i])
+        annotation.lon = float(lon[i])
+        annotation.east = float(wp[i, 0])
+        annotation.north = float(wp[i, 1])
+        annotation.zone_number = int(zone_numbers[i])
+        annotation.zone_letter = str(zone_letters[i])
+        annotation.start_east = float(wp1[i, 0]) if is_line else None
+        annotation.start_north = float(wp1[i, 1]) if is_line else None
+        annotation.end_east = float(wp2[i, 0]) if is_line else None
+        annotation.end_north = float(wp2[i, 1]) if is_line else None
+        annotation.heading = float(headings[i]) if is_line else None
+
+
+def apply_annotation_changes(video: Video, changes: dict[str, Any], context: VideoContext | None) -> None:
+    """
+    Apply the added, changed and removed fabric objects to the annotations
+    of the video. If the order is given, it is stored as the position of the
+    annotations and annotations missing from it are removed. Only the world
+    coordinates of touched annotations are computed, unless the settings of
+    the video changed since they were computed.
+    """
+    existing = {annotation.object_id: annotation for annotation in video.annotations}
+    removed = {str(object_id) for object_id in changes.get("removed", [])}
+    order = changes.get("order")
+    if order is not None:
+        order = [str(object_id) for object_id in order]
+        removed.update(set(existing) - set(order))
+    touched = []
+    for obj in changes.get("added", []) + changes.get("changed", []):
+        if obj.get("type") not in ANNOTATION_TYPES:
+            continue
+        object_id = str(obj["id"])
+        annotation = existing.get(object_id)
+        if annotation is None:
+            annotation = Annotation(object_id=object_id, project_id=video.project_id, position=len(existing))
+            video.annotations.append(annotation)
+            existing[object_id] = annotation
+        set_fabric_object(annotation, obj)
+        touched.append(annotation)
+    for object_id in removed:
+        annotation = existing.pop(object_id, None)
+        if annotation is not None:
+            video.annotations.remove(annotation)
+    touched = [annotation for annotation in touched if annotation.object_id in existing]
+    if order is not None:
+        positions = {object_id: position for position, object_id in enumerate(order)}
+        for annotation in existing.values():
+            annotation.position = positions.get(annotation.object_id, len(positions))
+    if context is None:
+        video.annotation_key = None
+        return
+    key = get_annotation_key(context)
+    if video.annotation_key != key:
+        touched = list(existing.values())
+        video.annotation_key = key
+    compute_world_values(touched, context)
+
+
+def import_json_data(video: Video) -> None:
+    """
+    Move the annotations stored as fabric json in video.json_data by older
+    versions to the annotation table.
+    """
+    if not video.json_data:
+        return
+    objects = (json.loads(video.json_data) or {}).get("objects") or []
+    objects = [obj for obj in objects if obj.get("type") in ANNOTATION_TYPES]
+    for i, obj in enumerate(objects):
+        obj.setdefault("id", f"{video.id}-{i}")
+    logger.debug(f"Importing {len(objects)} annotations of video {video.id}")
+    apply_annotation_changes(video, {"added": objects, "order": [obj["id"] for obj in objects]}, None)
+    video.json_data = None
+
+
+def refresh_annotations(video: Video, context: VideoContext) -> None:
+    """Compute the world coordinates of the annotations again if the settings of the video changed."""
+    import_json_data(video)
+    key = get_annotation_key(context)
+    if video.annotation_key != key:
+        logger.debug(f"Computing world coordinates of the annotations of video {video.id}")
+        compute_world_values(list(video.annotations), context)
+        video.annotation_key = key
+
+
+def get_fabric_json(video: Video) -> dict[str, Any]:
+    """The annotations of the video as fabric json for the annotator."""
+    annotations = sorted(video.annotations, key=lambda annotation: annotation.position)
+    return {"objects": [json.loads(annotation.fabric_object) for annotation in annotations]}
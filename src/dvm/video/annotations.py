@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import json
 import logging
+from typing import Any
 
 import numpy as np
 
@@ -11,59 +12,102 @@ from dvm.drone.fov import Fov
 logger = logging.getLogger("app." + __name__)
 
 
+def get_line_image_points(obj: dict[str, Any]) -> tuple[tuple[float, float], tuple[float, float]]:
+    """The image coordinates of the two end points of a FrameLine object."""
+    xoffset = obj["left"] + obj["width"] / 2
+    yoffset = obj["top"] + obj["height"] / 2
+    image_point1 = (obj["x1"] + xoffset, obj["y1"] + yoffset)
+    image_point2 = (obj["x2"] + xoffset, obj["y2"] + yoffset)
+    return image_point1, image_point2
+
+
 class Annotations:
+    """
+    The annotation tree of a video. The annotation objects and their tree
+    text are kept by id, such that a change from the client only recomputes
+    the lengths of the objects it touches.
+    """
+
     def __init__(self, drone_log: DroneLog, fov: Fov) -> None:
         logger.debug(f"Creating Annotations instance: {self}")
         self.drone_log = drone_log
         self.fov = fov
-        self.tree_json: list[dict[str, str]] = []
-
-    def _get_length(self, obj: dict[str, int]) -> float:
-        log_data = self.drone_log.get_log_data_from_frame(obj["frame"])
-        x1 = obj["x1"]
-        x2 = obj["x2"]
-        y1 = obj["y1"]
-        y2 = obj["y2"]
-        xoffset = obj["left"] + obj["width"] / 2
-        yoffset = obj["top"] + obj["height"] / 2
-        image_point1 = (x1 + xoffset, y1 + yoffset)
-        image_point2 = (x2 + xoffset, y2 + yoffset)
-        wp1 = self.fov.get_world_point(image_point1, *log_data[1:])
-        wp2 = self.fov.get_world_point(image_point2, *log_data[1:])
-        length = float(np.sqrt((wp1[0] - wp2[0]) ** 2 + (wp1[1] - wp2[1]) ** 2))  # type: ignore[operator]
-        return length
-
-    def from_fabric_json(self, fabric_json: str) -> None:
+        # jstree nodes, folders are keyed by name and objects by position.
+        self.tree_json: list[dict[str, Any]] = []
+        self.session: str | None = None
+        self.objects: dict[str, dict[str, Any]] = {}
+        # The name and tree text of each object by id.
+        self.nodes: dict[str, tuple[str | None, str]] = {}
+        self.order: list[str] = []
+        self._key: tuple[Any, ...] | None = None
+
+    def _get_key(self) -> tuple[Any, ...]:
+        """The settings the lengths of the lines are computed from."""
+        return (
+            self.drone_log.video_start_time,
+            self.drone_log.takeoff_altitude,
+            self.drone_log.interpolate_pose,
+            self.fov.calibration_key,
+        )
+
+    def _get_lengths(self, objects: list[dict[str, Any]]) -> np.ndarray:
+        """Length in meters of each FrameLine object computed in one batch."""
+        if not objects:
+            return np.zeros(0)
+        frames = np.array([obj["frame"] for obj in objects])
+        _, height, rotation, pos = self.drone_log.get_log_data_from_frames(frames)
+        image_points = np.array([get_line_image_points(obj) for obj in objects], dtype=np.float64)
+        world_points = np.asarray(
+            self.fov.get_world_points(
+                image_points.reshape(-1, 2), np.repeat(height, 2), np.repeat(rotation, 2), np.repeat(pos, 2)
+            )
+        ).reshape(-1, 2, 2)
+        lengths: np.ndarray = np.linalg.norm(world_points[:, 0] - world_points[:, 1], axis=1)
+        return lengths
+
+    def _update_nodes(self, object_ids: list[str]) -> None:
+        """Compute the name and tree text of the given objects."""
+        line_ids = [object_id for object_id in object_ids if self.objects[object_id].get("type") == "FrameLine"]
+        lengths = dict(
+            zip(line_ids, self._get_lengths([self.objects[object_id] for object_id in line_ids]), strict=True)
+        )
+        for object_id in object_ids:
+            obj = self.objects[object_id]
+            name = obj.get("name")
+            frame = obj.get("frame")
+            if obj.get("type") == "FrameLine":
+                text = f"<span>Line; Frame: {frame}, Length: {lengths[object_id]:.2f}m</span>"
+            else:
+                text = f"Point; Frame: {frame}"
+            self.nodes[object_id] = (name, text)
+
+    def _set_objects(self, objects: list[dict[str, Any]]) -> list[str]:
+        """Store the annotation objects by id and return their ids."""
+        object_ids = []
+        for obj in objects:
+            if obj.get("type") not in ("FrameLine", "FramePoint"):
+                continue
+            object_id = str(obj.get("id", len(self.objects)))
+            self.objects[object_id] = obj
+            object_ids.append(object_id)
+        return object_ids
+
+    def _build_tree(self) -> None:
         parents = set()
-        idx = 0
         self.tree_json = []
-        json_dict = json.loads(fabric_json)
-        objects = json_dict.get("objects")
-        if objects:
-            for obj in objects:
-                if obj.get("type") == "FrameLine":
-                    name = obj.get("name")
-                    frame = obj.get("frame")
-                    length = self._get_length(obj)
-                    text = f"<span>Line; Frame: {frame}, Length: {length:.2f}m</span>"
-                elif obj.get("type") == "FramePoint":
-                    name = obj.get("name")
-                    frame = obj.get("frame")
-                    text = f"Point; Frame: {frame}"
-                else:
-                    continue
-                if name not in parents:
-                    parent = {
-                        "id": name,
-                        "parent": "#",
-                        "text": name,
-                        "icon": "far fa-folder",
-                    }
-                    self.tree_json.append(parent)
-                    parents.add(name)
-                node = {"id": idx, "parent": name, "text": text, "icon": "-"}
-                idx += 1
-                self.tree_json.append(node)
+        for idx, object_id in enumerate(self.order):
+            name, text = self.nodes[object_id]
+            if name not in parents:
+                parent: dict[str, Any] = {
+                    "id": name,
+                    "parent": "#",
+                    "text": name,
+                    "icon": "far fa-folder",
+                }
+                self.tree_json.append(parent)
+                parents.add(name)
+            node = {"id": idx, "parent": name, "text": text, "icon": "-"}
+            self.tree_json.append(node)
         if not self.tree_json:
             self.tree_json.append(
                 {
@@ -73,3 +117,37 @@ class Annotations:
                     "icon": "far fa-folder",
                 }
             )
+
+    def is_current(self, session: str | None) -> bool:
+        """True if the stored objects are those last sent by the client session."""
+        return session is not None and session == self.session
+
+    def from_fabric_json(self, fabric_json: str, session: str | None = None) -> None:
+        """Rebuild the tree from all objects of the fabric canvas."""
+        self.session = session
+        self.objects = {}
+        self.nodes = {}
+        self._key = self._get_key()
+        json_dict = json.loads(fabric_json)
+        self.order = self._set_objects(json_dict.get("objects") or [])
+        self._update_nodes(self.order)
+        self._build_tree()
+
+    def update(self, changes: dict[str, Any]) -> None:
+        """
+        Apply the added, changed and removed objects sent by the client and
+        recompute only those, unless the settings of the video changed.
+        """
+        for object_id in changes.get("removed", []):
+            self.objects.pop(str(object_id), None)
+            self.nodes.pop(str(object_id), None)
+        touched = self._set_objects(changes.get("added", []) + changes.get("changed", []))
+        if self._key != self._get_key():
+            self._key = self._get_key()
+            touched = list(self.objects)
+        self._update_nodes(touched)
+        order = changes.get("order")
+        if order is None:
+            order = list(self.objects)
+        self.order = [str(object_id) for object_id in order if str(object_id) in self.nodes]
+        self._build_tree()
@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from dvm.app_config import AppConfig
+from dvm.drone.drone_log_data import POSITION_DTYPE, ROTATION_DTYPE, DroneLog
+from dvm.drone.fov import Fov
+from dvm.drone.log_cache import log_file_hash
+
+logger = logging.getLogger("app." + __name__)
+
+# Bump when the columns or the layout of the pose track change.
+POSE_TRACK_VERSION = 2
+# The pose track has one row per frame (0 to the number of frames) with these
+# columns stored as little endian float64. time is seconds since the video
+# start time, height includes the takeoff altitude and the angles are in
+# radians.
+POSE_TRACK_COLUMNS = ("time", "height", "yaw", "pitch", "roll", "lat", "lon", "east", "north")
+POSE_TRACK_DTYPE = np.dtype("<f8")
+
+
+def compute_pose_track(drone_log: DroneLog) -> np.ndarray:
+    """The pose of every frame of the video as an (N, len(POSE_TRACK_COLUMNS)) array."""
+    time_stamp, height, rotation, pos = drone_log.get_pose_table()
+    east, north, _, _ = Fov.convert_gps_points(pos["lat"], pos["lon"])
+    seconds = (time_stamp - np.datetime64(drone_log.video_start_time, "ns")) / np.timedelta64(1, "s")
+    pose_track: np.ndarray = np.column_stack(
+        (seconds, height, rotation["yaw"], rotation["pitch"], rotation["roll"], pos["lat"], pos["lon"], east, north)
+    ).astype(POSE_TRACK_DTYPE)
+    return pose_track
+
+
+def get_pose_track_key(drone_log: DroneLog, log_file: Path) -> str:
+    """Hash of the log and the video settings the pose track is computed from."""
+    settings = (
+        POSE_TRACK_VERSION,
+        log_file_hash(log_file),
+        drone_log.video_start_time.isoformat() if drone_log.video_start_time else None,
+        drone_log.video_nb_frames,
+        drone_log.video_duration,
+        drone_log.takeoff_altitude,
+        drone_log.interpolate_pose,
+    )
+    return hashlib.sha256(repr(settings).encode()).hexdigest()[:32]
+
+
+def get_pose_track_file(video_id: int, key: str) -> Path:
+    return AppConfig.data_dir / "pose_tracks" / str(video_id) / f"{key}.bin"
+
+
+def write_pose_track(video_id: int, drone_log: DroneLog, log_file: Path) -> str:
+    """
+    Compute and store the pose track of the video unless it is already
+    stored, removing the pose tracks of earlier settings of the video.
+    Returns the key of the pose track.
+    """
+    key = get_pose_track_key(drone_log, log_file)
+    pose_track_file = get_pose_track_file(video_id, key)
+    if pose_track_file.exists():
+        return key
+    pose_track = compute_pose_track(drone_log)
+    pose_track_file.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=pose_track_file.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(pose_track.tobytes())
+        Path(temp_name).replace(pose_track_file)
+    except BaseException:
+        Path(temp_name).unlink(missing_ok=True)
+        raise
+    logger.debug(f"Saved pose track to {pose_track_file}")
+    for superseded_file in pose_track_file.parent.glob("*.bin"):
+        if superseded_file != pose_track_file:
+            superseded_file.unlink(missing_ok=True)
+    return key
+
+
+def read_pose_track(video_id: int, key: str) -> np.ndarray:
+    """The stored pose track as an (N, len(POSE_TRACK_COLUMNS)) array, memory mapped from disk."""
+    pose_track = np.memmap(get_pose_track_file(video_id, key), dtype=POSE_TRACK_DTYPE, mode="r")
+    return pose_track.reshape(-1, len(POSE_TRACK_COLUMNS))
+
+
+def get_poses_from_pose_track(
+    pose_track: np.ndarray, frames: np.ndarray, video_start_time: datetime
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    The time stamps, heights, rotations and positions of the frames in the
+    layout of DroneLog.get_log_data_from_frames.
+    """
+    rows = np.asarray(pose_track[frames])
+    seconds = rows[:, POSE_TRACK_COLUMNS.index("time")]
+    time_stamp = np.datetime64(video_start_time, "ns") + np.round(seconds * 1e9).astype("timedelta64[ns]")
+    height = rows[:, POSE_TRACK_COLUMNS.index("height")]
+    rotation = np.empty(len(rows), dtype=ROTATION_DTYPE)
+    for name in ROTATION_DTYPE.names or ():
+        rotation[name] = rows[:, POSE_TRACK_COLUMNS.index(name)]
+    pos = np.empty(len(rows), dtype=POSITION_DTYPE)
+    for name in POSITION_DTYPE.names or ():
+        pos[name] = rows[:, POSE_TRACK_COLUMNS.index(name)]
+    return time_stamp, height, rotation, pos
+
+
+def remove_pose_tracks(video_id: int) -> None:
+    shutil.rmtree(AppConfig.data_dir / "pose_tracks" / str(video_id), ignore_errors=True)
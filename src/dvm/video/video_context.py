@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import contextlib
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from typing import Any
+
+import flask
+import numpy as np
+
+from dvm.app_config import AppConfig
+from dvm.db_model import Drone, Project, Video, db
+from dvm.drone.drone_log_data import DroneLog
+from dvm.drone.fov import Fov
+from dvm.video.annotations import Annotations
+from dvm.video.pose_track import (
+    get_pose_track_file,
+    get_pose_track_key,
+    get_poses_from_pose_track,
+    read_pose_track,
+    write_pose_track,
+)
+
+logger = logging.getLogger("app." + __name__)
+
+
+class VideoContext:
+    """
+    The drone log, camera calibration, image size and start time of a
+    single video together with the annotations computed from them. The
+    context is shared between requests for the video, so it must only be
+    updated and used while holding its lock.
+    """
+
+    def __init__(self, video: Video, project: Project, drone: Drone) -> None:
+        logger.debug(f"Creating VideoContext for video {video.id}")
+        self.lock = threading.RLock()
+        self.video_id = video.id
+        self.key = self.get_key(video, project)
+        self.drone_log = DroneLog()
+        self.fov = Fov()
+        self.annotations = Annotations(self.drone_log, self.fov)
+        self.log_file = AppConfig.data_dir.joinpath(project.log_file)
+        self.drone_log.get_log_data(self.log_file)
+        self.drone_log.set_video_data(
+            video.duration,
+            video.frames,
+            (video.width, video.height),
+            (video.latitude, video.longitude),
+        )
+        self.fov.set_image_size(*self.drone_log.video_size)
+        self.update(video, project, drone)
+
+    @staticmethod
+    def get_key(video: Video, project: Project) -> tuple[Any, ...]:
+        """The values which require the log to be loaded again when they change."""
+        return (
+            project.log_file,
+            video.duration,
+            video.frames,
+            video.width,
+            video.height,
+            video.latitude,
+            video.longitude,
+        )
+
+    def update(self, video: Video, project: Project, drone: Drone) -> None:
+        """Apply the settings which can change without loading the log again."""
+        self.fov.set_camera_params(*drone.calibration)
+        self.drone_log.interpolate_pose = bool(project.interpolate_pose)
+        self.drone_log.takeoff_altitude = video.takeoff_altitude if video.takeoff_altitude is not None else 0.0
+        self.drone_log.video_start_time = video.start_time
+
+    def get_pose_track_key(self) -> str:
+        """The key of the stored pose track of the video, computing it if needed."""
+        return write_pose_track(self.video_id, self.drone_log, self.log_file)
+
+    def get_log_data_from_frames(self, frames: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        DroneLog.get_log_data_from_frames, read from the stored pose track of
+        the video if it is stored for the current settings.
+        """
+        frames = np.asarray(frames)
+        start_time = self.drone_log.video_start_time
+        if (
+            start_time is not None
+            and np.issubdtype(frames.dtype, np.integer)
+            and np.all((frames >= 0) & (frames <= self.drone_log.video_nb_frames))
+        ):
+            key = get_pose_track_key(self.drone_log, self.log_file)
+            if get_pose_track_file(self.video_id, key).exists():
+                pose_track = read_pose_track(self.video_id, key)
+                return get_poses_from_pose_track(pose_track, frames, start_time)
+        return self.drone_log.get_log_data_from_frames(frames)
+
+
+class VideoContextRegistry:
+    """
+    Least recently used cache of video contexts keyed by video id, such
+    that concurrent requests for different videos never share state.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._contexts: OrderedDict[int, VideoContext] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def use(self, video: Video, project: Project, drone: Drone) -> Iterator[VideoContext]:
+        """
+        The context of the video with the current settings of the video,
+        locked for the duration of the block such that concurrent requests
+        for the same video never compute with each other's settings.
+        """
+        video_id = int(video.id)
+        with self._lock:
+            context = self._contexts.get(video_id)
+            if context is not None:
+                self._contexts.move_to_end(video_id)
+        if context is None or context.key != VideoContext.get_key(video, project):
+            context = VideoContext(video, project, drone)
+            with self._lock:
+                self._contexts[video_id] = context
+                self._contexts.move_to_end(video_id)
+                while len(self._contexts) > self.max_size:
+                    self._contexts.popitem(last=False)
+        with context.lock:
+            context.update(video, project, drone)
+            yield context
+
+    def remove(self, video_id: int) -> None:
+        with self._lock:
+            self._contexts.pop(int(video_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._contexts.clear()
+
+
+video_contexts = VideoContextRegistry(AppConfig.video_context_cache_size)
+
+
+@contextlib.contextmanager
+def use_video_context(video_id: int) -> Iterator[VideoContext]:
+    """Use the locked context of the video, aborting with 404 if it does not exist."""
+    video = db.get_or_404(Video, video_id)
+    project = db.get_or_404(Project, video.project_id)
+    drone = db.get_or_404(Drone, project.drone_id)
+    if not project.log_file:
+        flask.abort(404)
+    with video_contexts.use(video, project, drone) as context:
+        yield context
@@ -3,26 +3,28 @@ from __future__ import annotations
 import json
 import logging
 import re
-from collections import defaultdict
+import threading
+from collections import OrderedDict, defaultdict
 from datetime import datetime, time
+from typing import Any
 
 import flask
 import numpy as np
 from werkzeug.wrappers.response import Response
 
-from dvm.app_config import AppConfig
 from dvm.db_model import Drone, Project, Video, db
 from dvm.drone import plot_log_data
-from dvm.drone.drone_log_data import drone_log
-from dvm.drone.fov import fov
-from dvm.video.annotations import Annotations
+from dvm.drone.fov import Fov
+from dvm.projects.export import bump_annotation_revision
+from dvm.video.annotation_table import ANNOTATION_TYPES, apply_annotation_changes, get_fabric_json, refresh_annotations
+from dvm.video.pose_track import get_pose_track_file
+from dvm.video.video_context import use_video_context, video_contexts
 
 logger = logging.getLogger("app." + __name__)
-annotation_class = Annotations(drone_log, fov)
 videos_view = flask.Blueprint("videos", __name__)
 
 
-def get_horizon_dict() -> dict[str, list[tuple[float, float, float]]]:
+def get_horizon_dict() -> dict[str, np.ndarray]:
     world_points = defaultdict(list)
     # Points for North - South line
     for x in np.linspace(-np.pi, np.pi, 100):
@@ -66,10 +68,41 @@ def get_horizon_dict() -> dict[str, list[tuple[float, float, float]]]:
             float(np.sin(pitch_angle)),
         )
         world_points["pitch45"].append(point)
-    return world_points
+    return {direction: np.array(points) for direction, points in world_points.items()}
 
 
 horizon_dict = get_horizon_dict()
+# The drone rotation is rounded to this resolution in degrees before the
+# horizon is computed, such that nearby rotations share a cache entry.
+HORIZON_ANGLE_RESOLUTION = 0.01
+HORIZON_CACHE_SIZE = 4096
+# Maximum number of frames returned by get_horizon_range.
+HORIZON_RANGE_SIZE = 300
+_horizon_cache: OrderedDict[tuple[Any, ...], dict[str, list[dict[str, int]]]] = OrderedDict()
+_horizon_cache_lock = threading.Lock()
+
+
+def get_horizon(
+    fov: Fov, rotation: tuple[float, float, float], calibration_key: str | None = None
+) -> dict[str, list[dict[str, int]]]:
+    """
+    The horizon and world corners of the rotation, cached on the rounded
+    rotation and the calibration and image size of the video.
+    """
+    quantized = tuple(int(value) for value in np.round(np.degrees(rotation) / HORIZON_ANGLE_RESOLUTION))
+    key = (calibration_key or fov.calibration_key, *quantized)
+    with _horizon_cache_lock:
+        horizon = _horizon_cache.get(key)
+        if horizon is not None:
+            _horizon_cache.move_to_end(key)
+            return horizon
+    yaw, pitch, roll = np.radians(np.array(quantized) * HORIZON_ANGLE_RESOLUTION).tolist()
+    horizon = dict(fov.get_horizon_and_world_corners(horizon_dict, (yaw, pitch, roll)))
+    with _horizon_cache_lock:
+        _horizon_cache[key] = horizon
+        while len(_horizon_cache) > HORIZON_CACHE_SIZE:
+            _horizon_cache.popitem(last=False)
+    return horizon
 
 
 @videos_view.route("/<video_id>/annotate")  # type: ignore[misc]
@@ -78,39 +111,29 @@ def video(video_id: int) -> Response:
     video = db.get_or_404(Video, video_id)
     project = db.get_or_404(Project, video.project_id)
     drone = db.get_or_404(Drone, project.drone_id)
-    fov.set_camera_params(*drone.calibration)
-    log_file = AppConfig.data_dir.joinpath(project.log_file)
-    drone_log.get_log_data(log_file)
-    drone_log.set_video_data(
-        video.duration,
-        video.frames,
-        (video.width, video.height),
-        (video.latitude, video.longitude),
-    )
     if video.takeoff_altitude is None:
         video.takeoff_altitude = 0.0
-    drone_log.takeoff_altitude = video.takeoff_altitude
-    fov.set_image_size(*drone_log.video_size)
-    json_data = video.json_data if type(video.json_data) is str else "{}"
-    video_start_time = video.start_time
-    if video_start_time:
-        drone_log.video_start_time = video_start_time
-    else:
-        video_start_time, message = drone_log.match_log_and_video()
-        if message:
-            flask.flash(message, "warning")
-        video.start_time = video_start_time
+    with video_contexts.use(video, project, drone) as context:
+        drone_log = context.drone_log
+        video_start_time = video.start_time
+        if not video_start_time:
+            video_start_time, message = drone_log.match_log_and_video()
+            if message:
+                flask.flash(message, "warning")
+            video.start_time = video_start_time
+        refresh_annotations(video, context)
         db.session.commit()
-    plot_script, plot_div = plot_log_data.get_log_plot_with_video(
-        drone_log.log_data(),
-        video_start_time,
-        drone_log.video_duration,
-        drone_log.video_nb_frames,
-    )
+        pose_track_url = flask.url_for("videos.pose_track", video_id=video.id, key=context.get_pose_track_key())
+        plot_script, plot_div = plot_log_data.get_log_plot_with_video(
+            drone_log.log_data(),
+            video_start_time,
+            drone_log.video_duration,
+            drone_log.video_nb_frames,
+        )
     args = {
         "project_id": project.id,
         "video": video,
-        "json_data": json.loads(json_data),
+        "json_data": get_fabric_json(video),
         "plot_script": plot_script,
         "plot_div": plot_div,
         "video_width": drone_log.video_size[0],
@@ -119,17 +142,51 @@ def video(video_id: int) -> Response:
         "fps": drone_log.video_nb_frames / drone_log.video_duration,
         "takeoff_altitude": video.takeoff_altitude,
         "video_start_time": video_start_time,
+        "pose_track_url": pose_track_url,
     }
     logger.debug(f"Render video {video.file}")
     return flask.render_template("videos/video.html", **args)
 
 
+@videos_view.route("/<video_id>/pose_track/<key>")  # type: ignore[misc]
+def pose_track(video_id: int, key: str) -> Response:
+    """
+    The per frame pose track of the video as little endian float64 with the
+    columns of POSE_TRACK_COLUMNS. The key changes whenever the pose track
+    changes, so the response can be cached indefinitely.
+    """
+    video = db.get_or_404(Video, video_id)
+    pose_track_file = get_pose_track_file(video.id, key)
+    if not re.fullmatch(r"[0-9a-f]{32}", key) or not pose_track_file.exists():
+        flask.abort(404)
+    response = flask.send_file(pose_track_file, mimetype="application/octet-stream", max_age=31536000)
+    response.cache_control.immutable = True
+    return response
+
+
 @videos_view.route("/<video_id>/save", methods=["POST"])  # type: ignore[misc]
 def save_fabric_json(video_id: int) -> Response:
-    logger.debug(f"Saving annotations to json file for {video_id}")
-    json_data = flask.request.form.get("fabric_json")
+    """
+    Save the annotations of the video. Either the changes since the last
+    save or the whole fabric json can be sent.
+    """
+    logger.debug(f"Saving annotations for {video_id}")
     video = db.get_or_404(Video, video_id)
-    video.json_data = json_data
+    changes = flask.request.form.get("changes")
+    fabric_json = flask.request.form.get("fabric_json")
+    if changes is None and fabric_json is None:
+        flask.abort(400)
+    with use_video_context(video.id) as context:
+        if changes is not None:
+            apply_annotation_changes(video, json.loads(changes), context)
+        elif fabric_json is not None:
+            objects = (json.loads(fabric_json) or {}).get("objects") or []
+            objects = [obj for obj in objects if obj.get("type") in ANNOTATION_TYPES]
+            # Clients running an older video_annotator.js do not give the objects an id.
+            for i, obj in enumerate(objects):
+                obj.setdefault("id", f"{video.id}-{i}")
+            apply_annotation_changes(video, {"added": objects, "order": [obj["id"] for obj in objects]}, context)
+    bump_annotation_revision(video.project_id)
     db.session.commit()
     return ""
 
@@ -137,20 +194,62 @@ def save_fabric_json(video_id: int) -> Response:
 @videos_view.route("/markings_modified", methods=["POST"])  # type: ignore[misc]
 def markings_modified() -> Response:
     logger.debug("markings_modified called")
-    fabric_json = flask.request.form.get("fabric_json")
-    annotation_class.from_fabric_json(fabric_json)
-    return flask.jsonify(annotation_class.tree_json)
+    video_id = int(flask.request.form.get("video_id"))
+    session = flask.request.form.get("session")
+    changes = flask.request.form.get("changes")
+    with use_video_context(video_id) as context:
+        annotations = context.annotations
+        if changes is not None:
+            if not annotations.is_current(session):
+                return flask.jsonify({"resync": True})
+            annotations.update(json.loads(changes))
+        else:
+            annotations.from_fabric_json(flask.request.form.get("fabric_json"), session)
+        return flask.jsonify(annotations.tree_json)
 
 
 @videos_view.route("/get_horizon_fabricjs", methods=["POST"])  # type: ignore[misc]
 def get_horizon_fabricjs() -> Response:
     logger.debug("get_horizon_fabricjs called")
+    video_id = int(flask.request.form.get("video_id"))
     frame = int(flask.request.form.get("frame"))
-    _, _, rotation, _ = drone_log.get_log_data_from_frame(frame)
-    horizon_points = fov.get_horizon_and_world_corners(horizon_dict, rotation)
+    with use_video_context(video_id) as context:
+        _, _, rotation, _ = context.drone_log.get_log_data_from_frame(frame)
+        horizon_points = get_horizon(context.fov, rotation)
     return flask.jsonify(horizon_points)
 
 
+@videos_view.route("/get_horizon_range", methods=["POST"])  # type: ignore[misc]
+def get_horizon_range() -> Response:
+    """
+    The horizons of the frames from start up to stop, such that the client
+    can prefetch them. Frames with the same horizon share an entry in
+    horizons and frames maps each frame to its entry.
+    """
+    logger.debug("get_horizon_range called")
+    try:
+        video_id = int(flask.request.form["video_id"])
+        start = max(int(flask.request.form["start"]), 0)
+        stop = int(flask.request.form["stop"])
+    except (KeyError, ValueError):
+        flask.abort(400)
+    horizons: list[dict[str, list[dict[str, int]]]] = []
+    horizon_ids: dict[int, int] = {}
+    frame_horizons = {}
+    with use_video_context(video_id) as context:
+        stop = min(stop, start + HORIZON_RANGE_SIZE, context.drone_log.video_nb_frames)
+        frames = np.arange(start, max(stop, start))
+        _, _, rotations, _ = context.drone_log.get_log_data_from_frames(frames)
+        calibration_key = context.fov.calibration_key
+        for frame, rotation in zip(frames.tolist(), rotations.tolist(), strict=True):
+            horizon = get_horizon(context.fov, rotation, calibration_key)
+            if id(horizon) not in horizon_ids:
+                horizon_ids[id(horizon)] = len(horizons)
+                horizons.append(horizon)
+            frame_horizons[frame] = horizon_ids[id(horizon)]
+    return flask.jsonify({"frames": frame_horizons, "horizons": horizons})
+
+
 @videos_view.route("/<video_id>/save_start_time", methods=["POST"])  # type: ignore[misc]
 def save_start_time(video_id: int) -> Response:
     logger.debug(f"save_start_time called for {video_id}")
@@ -172,20 +271,23 @@ def save_start_time(video_id: int) -> Response:
         new_video_start_time = datetime.combine(video_start_time, start_time)
         video.start_time = new_video_start_time
         logger.debug(f"video.start_time: {video.start_time}")
+        bump_annotation_revision(video.project_id)
         db.session.commit()
-        drone_log.video_start_time = new_video_start_time
     elif start_time_str == "1":
         logger.debug("Attempting automatic matching of video with logfile")
-        drone_log.video_start_time = None
-        new_video_start_time, message = drone_log.match_log_and_video()
+        with use_video_context(video_id) as context:
+            context.drone_log.video_start_time = None
+            new_video_start_time, message = context.drone_log.match_log_and_video()
         if message:
             flask.flash(message, "warning")
         video.start_time = new_video_start_time
+        bump_annotation_revision(video.project_id)
         db.session.commit()
     elif start_time_str == "0":
         logger.debug("Set video start time to start of logfile")
-        minimum = min([(x, x) for x in drone_log.time_stamp], key=lambda z: z[0])
-        video.start_time = minimum[0]
+        with use_video_context(video_id) as context:
+            video.start_time = context.drone_log.get_log_start_time()
+        bump_annotation_revision(video.project_id)
         db.session.commit()
     else:
         flask.flash("Error setting the video time.", "error")
@@ -203,7 +305,7 @@ def save_takeoff_altitude(video_id: int) -> Response:
         new_takeoff_altitude = float(takeoff_altitude_str)
         video.takeoff_altitude = new_takeoff_altitude
         logger.debug(f"video.takeoff_altitude: {video.takeoff_altitude}")
-        drone_log.takeoff_altitude = new_takeoff_altitude
+        bump_annotation_revision(video.project_id)
         db.session.commit()
     except Exception:
         flask.flash("Error setting the takeoff altitude.", "error")
@@ -4,12 +4,17 @@ from pathlib import Path
 
 import pytest
 
+import cv2
 import numpy as np
 
 from flask.testing import FlaskClient
 
-from dvm.calibration.calibration import CalibrateCamera
+from dvm.app_config import AppConfig
+from dvm.calibration.MarkerTracker import MarkerTracker
+from dvm.calibration.peak_enumerator import PeakEnumerator
+from dvm.calibration.calibration import CalibrateCamera, iter_in_thread
 from dvm.calibration.corner_detector import ChessBoardCornerDetector
+from dvm.calibration.debug_images import DebugImageSink
 
 
 def test_init_calibrate_camera() -> None:
@@ -46,3 +51,119 @@ def test_calibrate_from_call(client: FlaskClient) -> None:
     assert pytest.approx(fov_y) == 32.815780
     assert pytest.approx(float(stds[0])) == 0.1161184
     assert n_images == 1
+
+
+def test_calibrate_from_images_in_threads(client: FlaskClient) -> None:
+    image_file = Path("./tests/test_data/calibration.jpg").resolve()
+    image_files = [image_file, image_file, image_file]
+    serial = CalibrateCamera(workers=1).calibrate_camera_from_images(image_files)
+    threaded = CalibrateCamera(workers=2).calibrate_camera_from_images(image_files)
+    assert serial is not None
+    assert threaded is not None
+    np.testing.assert_allclose(threaded[0], serial[0])
+    np.testing.assert_allclose(threaded[1], serial[1])
+    assert threaded[2] == (2048, 1080)
+    assert threaded[3] == 3
+
+
+def test_marker_tracker_dft() -> None:
+    img = cv2.imread("./tests/test_data/calibration.jpg", cv2.IMREAD_GRAYSCALE)[:400, :600]
+    tracker = MarkerTracker(order=2, kernel_size=101, scale_factor=40)
+    response = tracker.apply_convolution_with_complex_kernel(img)
+    frame_real = cv2.filter2D(img, cv2.CV_32F, tracker.mat_real)
+    frame_imag = cv2.filter2D(img, cv2.CV_32F, tracker.mat_imag)
+    assert response.shape == img.shape
+    np.testing.assert_allclose(tracker.frame_real, frame_real, atol=1e-3 * np.abs(frame_real).max())
+    np.testing.assert_allclose(tracker.frame_imag, frame_imag, atol=1e-3 * np.abs(frame_imag).max())
+
+
+def test_detect_corners_downscaled() -> None:
+    img = cv2.imread("./tests/test_data/calibration.jpg")
+    corners, coverage, _ = ChessBoardCornerDetector().detect_chess_board_corners(img)
+    detector = ChessBoardCornerDetector()
+    detector.max_detection_size = 512
+    assert detector.get_detection_scale(img) == 0.25
+    downscaled_corners, downscaled_coverage, _ = detector.detect_chess_board_corners(img)
+    points = np.array([point for row in corners.values() for point in row.values()])
+    downscaled_points = np.array([point for row in downscaled_corners.values() for point in row.values()])
+    assert len(downscaled_points) == len(points)
+    assert downscaled_coverage == coverage
+    distances = np.linalg.norm(points[:, None] - downscaled_points[None], axis=2).min(axis=1)
+    assert distances.max() < 1
+
+
+def test_max_detection_size_setting(monkeypatch: pytest.MonkeyPatch) -> None:
+    assert CalibrateCamera().detector.max_detection_size is None
+    monkeypatch.setattr(AppConfig, "calibration_max_detection_size", 512)
+    assert CalibrateCamera().detector.max_detection_size == 512
+
+
+def test_read_video_frames(tmp_path: Path) -> None:
+    video_file = tmp_path / "calibration.avi"
+    writer = cv2.VideoWriter(str(video_file), cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+    for i in range(50):
+        writer.write(np.full((48, 64, 3), 5 * i, dtype=np.uint8))
+    writer.release()
+    cc = CalibrateCamera(n_images=10)
+    frames = list(iter_in_thread(cc.read_video_frames(video_file), 2))
+    assert [count for count, _ in frames] == list(range(0, 50, 5))
+    for count, frame in frames:
+        assert abs(int(frame.mean()) - 5 * count) <= 2
+
+
+def test_select_video_frames() -> None:
+    img = cv2.imread("./tests/test_data/calibration.jpg")
+    cc = CalibrateCamera(n_images=2)
+    count, sharpness, greyscale_image, grid = cc.score_frame((0, img))
+    _, blurred_sharpness, _, _ = cc.score_frame((1, cv2.GaussianBlur(img, (0, 0), 6)))
+    assert max(greyscale_image.shape) == cc.scoring_size
+    assert blurred_sharpness < 0.5 * sharpness
+    assert np.count_nonzero(grid) >= cc.min_percentage_coverage
+    left = np.zeros((10, 10), dtype=bool)
+    left[:5] = True
+    right = ~left
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 255, (48, 64), dtype=np.uint8) for _ in range(4)]
+    scores = [
+        (0, 100.0, images[0], left),
+        (1, 100.0, images[0], right),  # Same image as the previous frame.
+        (2, 10.0, images[1], right),  # Blurry.
+        (3, 90.0, images[2], left),  # Adds nothing to frame 0.
+        (4, 80.0, images[3], right),
+    ]
+    assert cc.select_video_frames(iter(scores)) == [0, 4]
+
+
+def test_debug_image_sink(tmp_path: Path) -> None:
+    img = cv2.imread("./tests/test_data/calibration.jpg")
+    detector = ChessBoardCornerDetector()
+    with DebugImageSink(every=2, max_size=512) as detector.debug_sink:
+        for name in ("first", "second", "third"):
+            detector.detect_chess_board_corners(
+                img, debug=True, path_to_image=Path(f"{name}.png"), path_to_output_folder=tmp_path
+            )
+    written = sorted(path.relative_to(tmp_path).as_posix() for path in tmp_path.rglob("*.jpg"))
+    assert len(written) == 10
+    assert "5_local_maxima/first_local_maxima.jpg" in written
+    assert "5_local_maxima/third_local_maxima.jpg" in written
+    assert cv2.imread(str(tmp_path / "1_response/first_response.jpg")).shape == (270, 512, 3)
+
+
+def test_peak_enumerator() -> None:
+    x, y = np.meshgrid(np.arange(12), np.arange(9))
+    points = np.stack((x.ravel(), y.ravel()), axis=1).astype(np.float64)
+    homography = np.array([[30, 3, 100], [2, 28, 80], [1e-4, 2e-4, 1]])
+    projected = np.c_[points, np.ones(len(points))] @ homography.T
+    centers = projected[:, :2] / projected[:, 2:]
+    pe = PeakEnumerator(centers)
+    central = pe.select_central_peak_location()
+    calibration_points = pe.enumerate_peaks()
+    assert np.array_equal(calibration_points[0][0], central)
+    grid_points = [(i, j, point) for i, row in calibration_points.items() for j, point in row.items()]
+    assert len(grid_points) == len(centers)
+    # The grid indices are the board indices up to a rotation or reflection and a shift.
+    index_of = {tuple(center): k for k, center in enumerate(centers)}
+    board = np.array([points[index_of[tuple(point)]] for _, _, point in grid_points])
+    indices = np.array([(i, j) for i, j, _ in grid_points], dtype=np.float64)
+    transform, *_ = np.linalg.lstsq(np.c_[indices, np.ones(len(indices))], board, rcond=None)
+    np.testing.assert_allclose(np.c_[indices, np.ones(len(indices))] @ transform, board, atol=1e-9)
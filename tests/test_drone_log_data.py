@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from dvm.app_config import AppConfig
+from dvm.drone.drone_log_data import DroneLog, get_video_range_indices, get_video_ranges, open_log
+from dvm.drone.log_cache import read_log_cache, remove_log_cache
+
+log_file = Path("./tests/test_data/test_drone_log.csv").resolve()
+
+
+def test_get_log_data_txt_to_log_csv_file() -> None:
+    drone_log = DroneLog()
+    drone_log.get_log_data(log_file)
+    assert drone_log.time_stamp.dtype == np.dtype("datetime64[ns]")
+    assert len(drone_log.time_stamp) == 2437
+    assert len(drone_log.height) == len(drone_log.rotation) == len(drone_log.pos) == len(drone_log.is_video)
+    assert drone_log.time_stamp[0] == np.datetime64("2018-07-04T09:19:31.701")
+    assert pytest.approx(drone_log.pos["lat"][0]) == 55.507158
+    assert pytest.approx(drone_log.pos["lon"][0]) == 10.717078
+    assert pytest.approx(drone_log.rotation["yaw"][0]) == 135.4 * np.pi / 180
+    time_stamp, height, yaw, pitch, roll, is_video = drone_log.log_data()
+    assert pytest.approx(yaw[0]) == 135.4
+    video_ranges = list(get_video_ranges(is_video, time_stamp))
+    assert video_ranges == [
+        (datetime(2018, 7, 4, 9, 22, 23, 412000), datetime(2018, 7, 4, 9, 22, 40, 805000)),
+        (datetime(2018, 7, 4, 9, 22, 55, 391000), datetime(2018, 7, 4, 9, 23, 16, 405000)),
+    ]
+
+
+def test_get_log_data_air_data_com(tmp_path: Path) -> None:
+    air_data_log = tmp_path / "air_data.csv"
+    air_data_log.write_text(
+        "time(millisecond),datetime(utc),latitude,longitude,height_above_takeoff(meters),isVideo,"
+        "gimbal_heading(degrees),gimbal_pitch(degrees),gimbal_roll(degrees)\n"
+        "0,2020-01-01 12:00:00,55.1,10.1,0.0,0,90,-90,0\n"
+        "100,2020-01-01 12:00:00,55.1,10.1,1.0,1,90,-90,0\n"
+        "200,2020-01-01 12:00:00,55.1,10.1,not a number,1,90,-90,0\n"
+        "300,2020-01-01 12:00:00,55.1,10.1,3.0,0,90,-90,0\n"
+    )
+    drone_log = DroneLog()
+    drone_log.get_log_data_air_data_com(air_data_log)
+    np.testing.assert_array_equal(
+        drone_log.time_stamp,
+        np.array(["2020-01-01T12:00:00", "2020-01-01T12:00:00.1", "2020-01-01T12:00:00.3"], dtype="datetime64[ns]"),
+    )
+    np.testing.assert_allclose(drone_log.height, [0.0, 1.0, 3.0])
+    np.testing.assert_array_equal(drone_log.is_video, [False, True, False])
+
+
+def test_get_video_range_indices() -> None:
+    is_video = np.array([False, True, True, False, False, True])
+    np.testing.assert_array_equal(get_video_range_indices(is_video), [[1, 3], [5, 5]])
+    assert get_video_range_indices(np.zeros(4, dtype=bool)).shape == (0, 2)
+
+
+def test_get_time_indices() -> None:
+    drone_log = DroneLog()
+    drone_log.get_log_data(log_file)
+    rng = np.random.default_rng(42)
+    offsets = rng.integers(-10_000, 300_000, 500).astype("timedelta64[ms]")
+    times = drone_log.time_stamp[0] + offsets
+    expected = [int(np.argmin(np.abs(drone_log.time_stamp - time))) for time in times]
+    np.testing.assert_array_equal(drone_log.get_time_indices(times), expected)
+
+
+def test_get_log_data_from_frames() -> None:
+    drone_log = DroneLog()
+    drone_log.get_log_data(log_file)
+    drone_log.set_video_data(10.0, 300, (1920, 1080), (55.5, 10.7))
+    drone_log.video_start_time = datetime(2018, 7, 4, 9, 22, 23, 412000)
+    drone_log.takeoff_altitude = 2.0
+    frames = np.arange(0, 300, 7)
+    # A single frame is looked up without computing the pose table.
+    singles = [drone_log.get_log_data_from_frame(int(frame)) for frame in frames]
+    assert drone_log._pose_table is None
+    time_stamp, height, rotation, pos = drone_log.get_log_data_from_frames(frames)
+    assert drone_log._pose_table is not None
+    for i, frame in enumerate(frames):
+        assert drone_log.get_log_data_from_frame(int(frame)) == singles[i]
+        single = singles[i]
+        assert np.datetime64(single[0], "ns") == time_stamp[i]
+        assert single[1] == height[i]
+        assert single[2] == rotation[i].item()
+        assert single[3] == pos[i].item()
+    assert height[0] == drone_log.height[drone_log.get_time_idx(drone_log.video_start_time)] + 2.0
+
+
+def test_interpolate_log_data() -> None:
+    drone_log = DroneLog()
+    drone_log.set_log_columns(
+        np.array(["2020-01-01T12:00:00", "2020-01-01T12:00:01"], dtype="datetime64[ns]"),
+        np.array([10.0, 20.0]),
+        np.array([170.0, -170.0]),
+        np.array([-90.0, -80.0]),
+        np.array([0.0, 0.0]),
+        np.array([55.0, 55.001]),
+        np.array([10.0, 10.001]),
+        np.array([True, True]),
+    )
+    drone_log.set_video_data(1.0, 30, (1920, 1080), (55.0, 10.0))
+    drone_log.video_start_time = datetime(2020, 1, 1, 12, 0, 0)
+    drone_log.interpolate_pose = True
+    _, height, rotation, pos = drone_log.get_log_data_from_frames(np.array([0, 15, 30]))
+    np.testing.assert_allclose(height, [10.0, 15.0, 20.0])
+    np.testing.assert_allclose(np.abs(np.degrees(rotation["yaw"][1])), 180.0)
+    np.testing.assert_allclose(np.degrees(rotation["pitch"]), [-90.0, -85.0, -80.0])
+    np.testing.assert_allclose(pos["lat"][1], 55.0005)
+    drone_log.interpolate_pose = False
+    _, height, _, _ = drone_log.get_log_data_from_frames(np.array([0, 14, 16, 30]))
+    np.testing.assert_allclose(height, [10.0, 10.0, 20.0, 20.0])
+
+
+def test_log_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(AppConfig, "data_dir", tmp_path)
+    drone_log = DroneLog()
+    drone_log.get_log_data(log_file)
+    assert len(list((tmp_path / "log_cache").glob("*.npz"))) == 1
+    cached = read_log_cache(log_file)
+    assert cached is not None
+    cached_log = DroneLog()
+    cached_log.set_columns(cached)
+    for name, column in drone_log.get_columns().items():
+        np.testing.assert_array_equal(cached_log.get_columns()[name], column)
+    assert cached_log.get_time_idx(datetime(2018, 7, 4, 9, 22, 23)) == drone_log.get_time_idx(
+        datetime(2018, 7, 4, 9, 22, 23)
+    )
+    remove_log_cache(log_file)
+    assert not list((tmp_path / "log_cache").glob("*.npz"))
+
+
+def test_open_log_filters_null_bytes(tmp_path: Path) -> None:
+    log_with_null_bytes = tmp_path / "null_bytes.csv"
+    content = log_file.read_bytes()
+    log_with_null_bytes.write_bytes(content[:1000] + b"\x00" * 100_000 + content[1000:].replace(b",", b",\x00"))
+    with open_log(log_with_null_bytes) as file:
+        assert "\x00" not in file.read()
+    assert DroneLog.test_log(log_with_null_bytes)
+    drone_log = DroneLog()
+    drone_log.get_log_data(log_with_null_bytes, use_cache=False)
+    assert len(drone_log.time_stamp) == 2437
+    assert log_with_null_bytes.read_bytes().count(b"\x00") > 100_000
+
+
+def test_read_log_without_zero_padding(tmp_path: Path) -> None:
+    log = tmp_path / "log.csv"
+    log.write_text(
+        "CUSTOM.updateTime,GIMBAL.yaw,GIMBAL.pitch,GIMBAL.roll,OSD.height [m],CUSTOM.isVideo,OSD.latitude,OSD.longitude\n"
+        "2020/1/1 2:00:00.123,90,-90,0,1.0,,55.1,10.1\n"
+        "2020/01/01 02:00:01,90,-90,0,2.0,Recording,55.1,10.1\n"
+        "2020/1/1 2:00:02.5,90,-90,0\n"
+    )
+    drone_log = DroneLog()
+    drone_log.get_log_data_txt_to_log_csv_file(log)
+    np.testing.assert_array_equal(
+        drone_log.time_stamp,
+        np.array(["2020-01-01T02:00:00.123", "2020-01-01T02:00:01"], dtype="datetime64[ns]"),
+    )
+    np.testing.assert_array_equal(drone_log.is_video, [False, True])
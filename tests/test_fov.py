@@ -3,6 +3,7 @@ from __future__ import annotations  # noqa: I001
 import numpy as np
 
 import pytest
+import utm
 
 from dvm.drone.fov import Fov
 
@@ -102,3 +103,66 @@ def test_gps_point() -> None:
     gps = fov.get_gps_point((1500, 1000), 20, (30, 20, 10), (55, 10))
     assert pytest.approx(gps[0], rel=1e-3) == 55
     assert pytest.approx(gps[1], rel=1e-3) == 10
+
+
+def test_world_points_batch() -> None:
+    fov = Fov()
+    mtx = np.array([[1.83427403e03, 0, 9.87014485e02], [0, 1.83308269e03, 5.78589467e02], [0, 0, 1]])
+    dist = np.array([[6.489003e-02, -6.948572e-01, -3.838770e-04, 8.868022e-04, 2.579142]])
+    fov.set_camera_params(mtx, dist, 58.330549, 32.815780, 1)
+    fov.set_image_size(3000, 2000)
+    rng = np.random.default_rng(1)
+    image_points = rng.uniform((0, 0), (3000, 2000), (50, 2))
+    heights = rng.uniform(5, 50, 50)
+    rotations = np.column_stack(
+        (rng.uniform(-np.pi, np.pi, 50), rng.uniform(-1.5, -0.5, 50), rng.uniform(-0.1, 0.1, 50))
+    )
+    positions = np.column_stack((rng.uniform(55, 55.01, 50), rng.uniform(10, 10.01, 50)))
+    world_points, zone_numbers, zone_letters = fov.get_world_points(
+        image_points, heights, rotations, positions, return_zone=True
+    )
+    for i in range(50):
+        yaw, pitch, roll = rotations[i]
+        rotated_vector = fov.rotation(-yaw, pitch, roll) @ fov.get_unit_vector(tuple(image_points[i]))
+        east, north, zone_number, zone_letter = utm.from_latlon(*positions[i])
+        world_point = rotated_vector[:2] / rotated_vector[2] * -heights[i] + (east, north)
+        np.testing.assert_allclose(world_points[i], world_point)
+        assert (zone_numbers[i], zone_letters[i]) == (zone_number, zone_letter)
+
+
+def test_convert_gps_points() -> None:
+    lat = np.array([55.0, 55.1, 55.0, -33.9, 60.0])
+    lon = np.array([5.9, 6.1, 10.0, 18.4, 5.0])
+    east, north, zone_numbers, zone_letters = Fov.convert_gps_points(lat, lon)
+    for i in range(len(lat)):
+        assert (east[i], north[i], zone_numbers[i], zone_letters[i]) == pytest.approx(utm.from_latlon(lat[i], lon[i]))
+    lat_back, lon_back = Fov.convert_utm_points(east, north, zone_numbers, zone_letters)
+    np.testing.assert_allclose(lat_back, lat)
+    np.testing.assert_allclose(lon_back, lon)
+
+
+def test_horizon_and_world_corners() -> None:
+    fov = Fov()
+    mtx = np.array([[1.83427403e03, 0, 9.87014485e02], [0, 1.83308269e03, 5.78589467e02], [0, 0, 1]])
+    dist = np.array([[6.489003e-02, -6.948572e-01, -3.838770e-04, 8.868022e-04, 2.579142]])
+    fov.set_camera_params(mtx, dist, 58.330549, 32.815780, 1)
+    fov.set_image_size(1920, 1080)
+    angles = np.linspace(-np.pi, np.pi, 100)
+    world_points = np.column_stack((np.cos(angles), np.sin(angles), np.zeros(100)))
+    yaw_pitch_roll = (0.3, -0.1, 0.05)
+    horizon = fov.get_horizon_and_world_corners({"pitch0": world_points}, yaw_pitch_roll)
+    rotation_matrix = fov.rotation(-yaw_pitch_roll[0], yaw_pitch_roll[1], yaw_pitch_roll[2])
+    expected = []
+    for world_point in world_points:
+        rotated_vector = rotation_matrix.T @ world_point
+        if rotated_vector[1] >= 0:
+            vector = mtx @ fov.rotation(0, np.pi / 2, 0) @ rotated_vector
+            x, y = int(vector[0] / vector[2]), int(vector[1] / vector[2])
+            if -200 <= x <= 1920 + 200 and -200 <= y <= 1080 + 200:
+                expected.append((x, y))
+    assert expected
+    left = horizon["pitch0_pos"][0]["left"]
+    top = horizon["pitch0_pos"][0]["top"]
+    points = [(point["x"] + left, point["y"] + top) for point in horizon["pitch0"]]
+    assert sorted(points) == sorted(expected)
+    assert points[0][0] == max(x for x, _ in expected)
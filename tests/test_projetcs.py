@@ -1,14 +1,28 @@
 from __future__ import annotations
 
+import io
+import json
+import zipfile
+from datetime import datetime
 from pathlib import Path
+from typing import Any
 
 import numpy as np
+import pytest
+from celery import Task as CeleryTask
+from flask import Flask
 from flask.testing import FlaskClient
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.file import FileStorage
 
-from dvm.db_model import Drone, Project, db
+import dvm
+from dvm import create_app, helper_functions
+from dvm.app_config import AppConfig, TestConfig
+from dvm.db_model import Annotation, Drone, Project, Video, db
 from dvm.forms import EditProjectForm, NewDroneForm, NewProjectForm
+from dvm.helper_functions import ANNOTATION_CSV_HEADER, iter_annotations_csv
+from dvm.projects.export import get_export_file, get_export_key, write_export
+from dvm.projects.projects import export_project_task, ingest_log, ingest_log_task
 
 
 def test_empty_project_page(client: FlaskClient, database: SQLAlchemy) -> None:
@@ -34,10 +48,17 @@ def test_empty_project_page(client: FlaskClient, database: SQLAlchemy) -> None:
     assert b"fa-exclamation-triangle" not in response.data
 
 
-def test_add_project_form(client: FlaskClient, database: SQLAlchemy) -> None:
+def test_add_project_form(client: FlaskClient, database: SQLAlchemy, monkeypatch: pytest.MonkeyPatch) -> None:
+    class MockTask:
+        id = "ingest-log-1"
+
+    def mock_apply_async(*args: Any, **kwargs: Any) -> MockTask:
+        return MockTask()
+
     drone = Drone.query.all()[0]
     log_file = Path("./tests/test_data/test_drone_log.csv").resolve()
-    with log_file.open("br") as file:
+    with log_file.open("br") as file, monkeypatch.context() as mp:
+        mp.setattr(ingest_log_task, "apply_async", mock_apply_async)
         project_form = NewProjectForm(
             formdata=None,
             name="Test-Project-12",
@@ -50,9 +71,38 @@ def test_add_project_form(client: FlaskClient, database: SQLAlchemy) -> None:
     assert b"Test-Project-12" in response.data
     assert b"Test Project number 12" in response.data
     assert b"fa-exclamation-triangle" not in response.data
+    assert b"task-status" in response.data
+
+
+def test_ingest_log(client: FlaskClient, database: SQLAlchemy, monkeypatch: pytest.MonkeyPatch) -> None:
+    class MockTask:
+        state = "SUCCESS"
+
+    def mock_AsyncResult(*args: Any, **kwargs: Any) -> MockTask:
+        return MockTask()
+
+    project = Project.query.all()[0]
+    ingest_log(project)
+    db.session.commit()
+    assert project.log_rows == 1
+    assert project.log_videos == 1
+    assert project.log_start == project.log_end
+    assert project.log_parse_duration >= 0
+    with monkeypatch.context() as mp:
+        mp.setattr(CeleryTask, "AsyncResult", mock_AsyncResult)
+        response = client.get(f"/projects/status/{project.task.id}")
+    assert response.status_code == 200
+    assert response.json["state"] == "SUCCESS"
+    assert project.task is None
 
 
-def test_edit_project_form(client: FlaskClient, database: SQLAlchemy) -> None:
+def test_edit_project_form(client: FlaskClient, database: SQLAlchemy, monkeypatch: pytest.MonkeyPatch) -> None:
+    class MockTask:
+        id = "ingest-log-2"
+
+    def mock_apply_async(*args: Any, **kwargs: Any) -> MockTask:
+        return MockTask()
+
     project = Project.query.all()[0]
     drone = Drone.query.all()[0]
     project_form = EditProjectForm(
@@ -62,7 +112,9 @@ def test_edit_project_form(client: FlaskClient, database: SQLAlchemy) -> None:
         edit_project_before="Test-Project-12",
         edit_drone=drone.id,
     )
-    response = client.post("/projects", data=project_form.data)
+    with monkeypatch.context() as mp:
+        mp.setattr(ingest_log_task, "apply_async", mock_apply_async)
+        response = client.post("/projects", data=project_form.data)
     assert response.status_code == 200
     assert b"Test-Project-11" in response.data
 
@@ -76,10 +128,228 @@ def test_project_plot(client: FlaskClient, database: SQLAlchemy) -> None:
 def test_project_download(client: FlaskClient, database: SQLAlchemy) -> None:
     response = client.get("/projects/1/download")
     assert response.status_code == 200
+    assert response.is_streamed
+    assert response.headers["Content-Disposition"] == 'attachment; filename="annotations.csv"'
     assert b"name,time,frame" in response.data
+    assert not (AppConfig.data_dir / "annotations.csv").exists()
+
+
+def test_iter_annotations_csv() -> None:
+    rows = ([i] * len(ANNOTATION_CSV_HEADER) for i in range(5))
+    chunks = list(iter_annotations_csv(rows, batch_size=2))
+    assert chunks[0].startswith("name,time,frame")
+    assert chunks[0].count("\n") == 1
+    assert [chunk.count("\n") for chunk in chunks[1:]] == [2, 2, 1]
+
+
+def test_annotation_table(client: FlaskClient, database: SQLAlchemy) -> None:
+    line = {
+        "type": "FrameLine",
+        "frame": 10,
+        "name": "Car",
+        "left": 500,
+        "top": 400,
+        "width": 200,
+        "height": 100,
+        "x1": -100,
+        "y1": -50,
+        "x2": 100,
+        "y2": 50,
+    }
+    point = {"type": "FramePoint", "id": "p", "frame": 20, "name": "Tree", "left": 300, "top": 200}
+    # Annotations saved as fabric json by older versions are imported on export.
+    video = Video(
+        name="Test-Video",
+        file="test_video.mp4",
+        image="test_video.jpg",
+        project_id=1,
+        duration=10.0,
+        frames=300,
+        width=1920,
+        height=1080,
+        start_time=datetime(2018, 7, 4, 9, 22, 23),
+        json_data=json.dumps({"objects": [line]}),
+    )
+    db.session.add(video)
+    db.session.commit()
+    response = client.get("/projects/1/download")
+    assert response.status_code == 200
+    assert b"Car," in response.data
+    assert video.json_data is None
+    assert [annotation.object_id for annotation in video.annotations] == [f"{video.id}-0"]
+    length = video.annotations[0].length
+    assert length > 0
+    assert video.annotations[0].zone_number == 32
+    # Only the changes are sent on save.
+    changes = {"added": [point], "changed": [], "removed": [], "order": ["p", f"{video.id}-0"]}
+    response = client.post(f"/{video.id}/save", data={"changes": json.dumps(changes)})
+    assert response.status_code == 200
+    annotations = db.session.execute(db.select(Annotation).order_by(Annotation.position)).scalars().all()
+    assert [(annotation.type, annotation.length) for annotation in annotations] == [
+        ("FramePoint", None),
+        ("FrameLine", length),
+    ]
+    response = client.get(f"/videos/{video.id}/download")
+    assert b"Tree," in response.data
+    assert b",NA," in response.data
+    response = client.get("/projects/1/download?format=geojson")
+    features = {feature["properties"]["name"]: feature for feature in response.json["features"]}
+    assert features["Tree"]["geometry"]["type"] == "Point"
+    assert features["Tree"]["properties"]["length"] is None
+    assert features["Car"]["geometry"]["type"] == "LineString"
+    assert features["Car"]["properties"]["length"] == pytest.approx(length)
+    response = client.post(f"/{video.id}/save", data={"changes": json.dumps({"removed": ["p"], "order": []})})
+    assert response.status_code == 200
+    assert not Annotation.query.all()
+
+
+def test_export_skips_failed_video(client: FlaskClient, database: SQLAlchemy, monkeypatch: pytest.MonkeyPatch) -> None:
+    video = db.session.execute(db.select(Video)).scalars().first()
+    point = {"type": "FramePoint", "id": "p", "frame": 20, "name": "Tree", "left": 300, "top": 200}
+    client.post(f"/{video.id}/save", data={"changes": json.dumps({"added": [point], "order": ["p"]})})
+
+    def refresh_outside_log(*args: Any, **kwargs: Any) -> None:
+        raise ValueError("The video is outside the log.")
 
+    # The rows of a video whose world values can not be refreshed would
+    # carry values computed from earlier settings, so the video is skipped.
+    with monkeypatch.context() as mp:
+        mp.setattr(helper_functions, "refresh_annotations", refresh_outside_log)
+        response = client.get("/projects/1/download")
+    assert response.status_code == 200
+    assert response.data.startswith(b"name,time,frame")
+    assert b"Tree," not in response.data
+    response = client.get("/projects/1/download")
+    assert b"Tree," in response.data
+    client.post(f"/{video.id}/save", data={"changes": json.dumps({"order": []})})
+
+
+def test_save_fabric_json(client: FlaskClient, database: SQLAlchemy) -> None:
+    video = db.session.execute(db.select(Video)).scalars().first()
+    # Older clients send the whole fabric json with objects without an id.
+    point = {"type": "FramePoint", "frame": 20, "name": "Tree", "left": 300, "top": 200}
+    fabric_json = {"objects": [{"type": "image"}, point, dict(point, name="Rock")]}
+    response = client.post(f"/{video.id}/save", data={"fabric_json": json.dumps(fabric_json)})
+    assert response.status_code == 200
+    annotations = db.session.execute(db.select(Annotation).order_by(Annotation.position)).scalars().all()
+    assert [(annotation.object_id, annotation.name) for annotation in annotations] == [
+        (f"{video.id}-0", "Tree"),
+        (f"{video.id}-1", "Rock"),
+    ]
+    assert client.post(f"/{video.id}/save").status_code == 400
+    client.post(f"/{video.id}/save", data={"changes": json.dumps({"order": []})})
+    assert not Annotation.query.all()
+
+
+def test_parquet_export(client: FlaskClient, database: SQLAlchemy, monkeypatch: pytest.MonkeyPatch) -> None:
+    pq = pytest.importorskip("pyarrow.parquet")
+    video = db.session.execute(db.select(Video)).scalars().first()
+    point = {"type": "FramePoint", "id": "p", "frame": 20, "name": "Tree", "left": 300, "top": 200}
+    client.post(f"/{video.id}/save", data={"changes": json.dumps({"added": [point], "order": ["p"]})})
+
+    class MockTask:
+        id = "export-task"
+
+    task_args: list[Any] = []
+
+    def mock_apply_async(*args: Any, **kwargs: Any) -> MockTask:
+        task_args.append(kwargs["args"])
+        return MockTask()
+
+    with monkeypatch.context() as mp:
+        mp.setattr(export_project_task, "apply_async", mock_apply_async)
+        response = client.get("/projects/1/download?format=parquet")
+    # The export is not written in the request, but started in the background.
+    assert response.status_code == 202
+    assert response.json["status_url"] == "/projects/1/export/export-task"
+    assert task_args == [(1, dvm.__version__, "parquet")]
+    project = db.get_or_404(Project, 1)
+    write_export(project, dvm.__version__, get_export_key(project, dvm.__version__), export_format="parquet")
+    response = client.get("/projects/1/download?format=parquet")
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.data))
+    assert table.column("name").to_pylist() == ["Tree"]
+    assert table.column("length").to_pylist() == [None]
+    assert str(table.schema.field("frame").type) == "int32"
+    client.post(f"/{video.id}/save", data={"changes": json.dumps({"order": []})})
 
-def test_remove_project(client: FlaskClient, database: SQLAlchemy) -> None:
-    response = client.get("/projects/1/remove", follow_redirects=True)
+
+def test_export(client: FlaskClient, database: SQLAlchemy, monkeypatch: pytest.MonkeyPatch) -> None:
+    class MockTask:
+        id = "export-task"
+
+    def mock_apply_async(*args: Any, **kwargs: Any) -> MockTask:
+        return MockTask()
+
+    with monkeypatch.context() as mp:
+        mp.setattr(export_project_task, "apply_async", mock_apply_async)
+        response = client.post("/projects/1/export")
+    assert response.status_code == 202
+    assert response.json["status_url"] == "/projects/1/export/export-task"
+    project = db.get_or_404(Project, 1)
+    key = get_export_key(project, dvm.__version__)
+    progress: list[tuple[int, int]] = []
+    export_file = write_export(project, dvm.__version__, key, lambda *args: progress.append(args))
+    assert progress[-1] == (len(project.videos), len(project.videos))
+    response = client.post("/projects/1/export")
+    assert response.json == {"state": "SUCCESS", "status": "Done", "url": "/projects/1/download?format=csv"}
+    response = client.get("/projects/1/download")
+    assert response.data == export_file.read_bytes()
+    assert response.data.startswith(b"name,time,frame")
+    response = client.get("/projects/download?project_id=1")
+    assert response.mimetype == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        assert archive.namelist() == [f"1-{project.name}.csv"]
+        assert archive.read(f"1-{project.name}.csv") == export_file.read_bytes()
+    assert client.get("/projects/download?drone_id=1000").status_code == 404
+    # Changing the takeoff altitude of a video invalidates the export.
+    response = client.post(f"/{project.videos[0].id}/save_takeoff_altitude", data={"new_takeoff_altitude": "2.5"})
+    assert response.status_code == 200
+    db.session.expire_all()
+    assert get_export_key(project, dvm.__version__) != key
+
+
+def test_remove_project(client: FlaskClient, database: SQLAlchemy, monkeypatch: pytest.MonkeyPatch) -> None:
+    class MockTask:
+        def revoke(self, *args: Any, **kwargs: Any) -> None:
+            pass
+
+    def mock_AsyncResult(*args: Any, **kwargs: Any) -> MockTask:
+        return MockTask()
+
+    with monkeypatch.context() as mp:
+        mp.setattr(CeleryTask, "AsyncResult", mock_AsyncResult)
+        response = client.get("/projects/1/remove", follow_redirects=True)
     assert response.status_code == 200
     assert not Project.query.all()
+
+
+def test_bulk_export_in_processes(app: Flask, monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    # The spawned export workers can not see an in-memory database, so this app uses a database file.
+    monkeypatch.setattr(TestConfig, "SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path / 'export.db'}")
+    monkeypatch.setattr(AppConfig, "export_workers", 2)
+    export_app = create_app(testing=True)
+    app.extensions["celery"].set_default()
+    log_file = Path("./tests/test_data/test_drone_log.csv").resolve()
+    with export_app.app_context():
+        db.create_all()
+        calibration = (np.array([[2850, 0, 2043], [0, 2852, 1082], [0, 0, 1]]), np.zeros(5), 71.4, 41.48, 31)
+        drones = [Drone(name=f"Export-Drone-{i}", calibration=calibration) for i in range(2)]
+        projects = [
+            Project(name=f"Export-Project-{i}", log_file=str(log_file), drone=drone) for i, drone in enumerate(drones)
+        ]
+        db.session.add_all(projects)
+        db.session.commit()
+        export_files = {
+            f"{project.id}-{project.name}.csv": get_export_file(
+                project.id, get_export_key(project, dvm.__version__), "csv"
+            )
+            for project in projects
+        }
+        response = export_app.test_client().get("/projects/download")
+        with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+            assert sorted(archive.namelist()) == sorted(export_files)
+            for name, export_file in export_files.items():
+                # The workers wrote the exports to the data directory of this app.
+                assert archive.read(name) == export_file.read_bytes()
+                assert archive.read(name).startswith(b"name,time,frame")
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import pytest
+from flask.testing import FlaskClient
+
+from dvm.app_config import AppConfig
+from dvm.db_model import Drone, Project, Video
+from dvm.video.pose_track import POSE_TRACK_COLUMNS, get_pose_track_file, read_pose_track, remove_pose_tracks
+from dvm.video.video_context import VideoContext, VideoContextRegistry
+
+log_file = Path("./tests/test_data/test_drone_log.csv").resolve()
+calibration = (
+    np.array([[2850, 0, 2043], [0, 2852, 1082], [0, 0, 1]]),
+    np.array([0.01918, -0.06466, -0.00013, 0.00027, 0.07863]),
+    71.4,
+    41.48,
+    31,
+)
+
+
+def make_video(video_id: int, start_time: datetime) -> Video:
+    return Video(
+        id=video_id,
+        duration=10.0,
+        frames=300,
+        width=1920,
+        height=1080,
+        start_time=start_time,
+        takeoff_altitude=None,
+    )
+
+
+def test_video_context_registry() -> None:
+    project = Project(log_file=str(log_file), interpolate_pose=False)
+    drone = Drone(calibration=calibration)
+    registry = VideoContextRegistry(2)
+    video_1 = make_video(1, datetime(2018, 7, 4, 9, 22, 23))
+    video_2 = make_video(2, datetime(2018, 7, 4, 9, 22, 55))
+    with registry.use(video_1, project, drone) as context_1, registry.use(video_2, project, drone) as context_2:
+        assert context_1 is not context_2
+        assert context_1.drone_log.video_start_time == datetime(2018, 7, 4, 9, 22, 23)
+        assert context_2.drone_log.video_start_time == datetime(2018, 7, 4, 9, 22, 55)
+        assert context_1.drone_log.takeoff_altitude == 0.0
+    # Settings are refreshed from the database rows on every use.
+    video_1.takeoff_altitude = 3.0
+    with registry.use(video_1, project, drone) as context:
+        assert context is context_1
+        assert context_1.drone_log.takeoff_altitude == 3.0
+    # Changing the video dimensions creates a new context.
+    video_1.frames = 301
+    with registry.use(video_1, project, drone) as context:
+        assert context is not context_1
+    # The least recently used context is evicted.
+    with registry.use(make_video(3, datetime(2018, 7, 4, 9, 22, 55)), project, drone):
+        pass
+    with registry.use(video_2, project, drone) as context:
+        assert context is not context_2
+
+
+def test_video_context_lock() -> None:
+    project = Project(log_file=str(log_file), interpolate_pose=False)
+    drone = Drone(calibration=calibration)
+    registry = VideoContextRegistry(2)
+    video = make_video(1, datetime(2018, 7, 4, 9, 22, 23))
+    other_video = make_video(1, datetime(2018, 7, 4, 9, 22, 23))
+    other_video.takeoff_altitude = 5.0
+    altitudes = []
+
+    def use_other_video() -> None:
+        with registry.use(other_video, project, drone) as context:
+            altitudes.append(context.drone_log.takeoff_altitude)
+
+    with registry.use(video, project, drone) as context:
+        thread = threading.Thread(target=use_other_video)
+        thread.start()
+        thread.join(0.2)
+        # The settings of the other request are not applied while in use.
+        assert thread.is_alive()
+        assert context.drone_log.takeoff_altitude == 0.0
+    thread.join()
+    assert altitudes == [5.0]
+
+
+def test_pose_track(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(AppConfig, "data_dir", tmp_path)
+    project = Project(log_file=str(log_file), interpolate_pose=False)
+    drone = Drone(calibration=calibration)
+    context = VideoContext(make_video(1, datetime(2018, 7, 4, 9, 22, 23)), project, drone)
+    frames = np.array([0, 150, 300])
+    expected = context.drone_log.get_log_data_from_frames(frames)
+    key = context.get_pose_track_key()
+    assert context.get_pose_track_key() == key
+    pose_track = read_pose_track(1, key)
+    assert pose_track.shape == (301, len(POSE_TRACK_COLUMNS))
+    time_stamp, height, rotation, pos = expected
+    np.testing.assert_allclose(pose_track[frames, POSE_TRACK_COLUMNS.index("height")], height)
+    np.testing.assert_allclose(pose_track[frames, POSE_TRACK_COLUMNS.index("yaw")], rotation["yaw"])
+    np.testing.assert_allclose(pose_track[frames, POSE_TRACK_COLUMNS.index("lat")], pos["lat"])
+    # The poses read from the stored pose track match the log lookup.
+    stored = context.get_log_data_from_frames(frames)
+    np.testing.assert_array_equal(stored[0], time_stamp)
+    for stored_values, values in zip(stored[1:], expected[1:], strict=True):
+        np.testing.assert_array_equal(stored_values, values)
+    # Pose tracks of earlier settings are removed.
+    context.drone_log.takeoff_altitude = 2.0
+    new_key = context.get_pose_track_key()
+    assert new_key != key
+    assert not get_pose_track_file(1, key).exists()
+    assert get_pose_track_file(1, new_key).exists()
+    remove_pose_tracks(1)
+    assert not get_pose_track_file(1, new_key).exists()
+
+
+def make_line(object_id: str, frame: int, name: str, x2: float) -> dict[str, Any]:
+    return {
+        "type": "FrameLine",
+        "id": object_id,
+        "frame": frame,
+        "name": name,
+        "left": 500,
+        "top": 400,
+        "width": x2,
+        "height": 100,
+        "x1": -x2 / 2,
+        "y1": -50,
+        "x2": x2 / 2,
+        "y2": 50,
+    }
+
+
+def test_annotations_update() -> None:
+    project = Project(log_file=str(log_file), interpolate_pose=False)
+    drone = Drone(calibration=calibration)
+    context = VideoContext(make_video(1, datetime(2018, 7, 4, 9, 22, 23)), project, drone)
+    objects = [
+        make_line("a", 10, "Car", 200),
+        {"type": "FramePoint", "id": "b", "frame": 20, "name": "Tree"},
+        make_line("c", 30, "Car", 300),
+    ]
+    annotations = context.annotations
+    annotations.from_fabric_json(json.dumps({"objects": objects}), "session")
+    assert annotations.is_current("session")
+    assert not annotations.is_current("other")
+    assert [node["id"] for node in annotations.tree_json] == ["Car", 0, "Tree", 1, 2]
+    objects[2] = make_line("c", 40, "Car", 400)
+    objects.pop(1)
+    objects.append(make_line("d", 50, "Bike", 100))
+    annotations.update({"added": [objects[2]], "changed": [objects[1]], "removed": ["b"], "order": ["a", "c", "d"]})
+    expected = VideoContext(make_video(1, datetime(2018, 7, 4, 9, 22, 23)), project, drone).annotations
+    expected.from_fabric_json(json.dumps({"objects": objects}))
+    assert annotations.tree_json == expected.tree_json
+    assert "Frame: 40" in annotations.tree_json[2]["text"]
+    # Lengths are recomputed when the settings of the video change.
+    context.drone_log.takeoff_altitude = 10.0
+    annotations.update({"order": ["a", "c", "d"]})
+    assert annotations.tree_json != expected.tree_json
+
+
+def test_get_horizon_range_bad_request(client: FlaskClient) -> None:
+    assert client.post("/get_horizon_range", data={"video_id": "1", "start": "a", "stop": "10"}).status_code == 400
+    assert client.post("/get_horizon_range", data={"video_id": "1", "start": "0"}).status_code == 400